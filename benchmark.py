@@ -0,0 +1,370 @@
+import argparse
+import multiprocessing
+import time
+from collections import OrderedDict
+from typing import Callable, Sized, Tuple
+
+import torch
+from transformers import (
+    BertTokenizer,
+    BertTokenizerFast,
+    GPT2Tokenizer,
+    GPT2TokenizerFast,
+    PreTrainedTokenizer,
+)
+
+from dataset import TextDataset, TokenMasker
+from score import SentenceScorer, read_sentences
+
+num_workers = multiprocessing.cpu_count()
+default_kind = "gpt2"
+max_tokens = 4096
+batch_size = 8
+block_size = 512
+num_steps = 100
+num_threads = torch.get_num_threads()
+
+tokenisers = {
+    "bert": (BertTokenizer, BertTokenizerFast),
+    "gpt2": (GPT2Tokenizer, GPT2TokenizerFast),
+}
+
+
+def measure(
+    fn: Callable[[], Sized],
+    name: str,
+    num_lines: int,
+    count_tokens: Callable[[Sized], int] = len,
+) -> Sized:
+    start_time = time.time()
+    tokens = fn()
+    time_elapsed = time.time() - start_time
+    print(
+        (
+            "{name:<24} {time:>8.2f}s "
+            "{lines:>12.0f} lines/s {tokens:>14.0f} tokens/s"
+        ).format(
+            name=name,
+            time=time_elapsed,
+            lines=num_lines / time_elapsed,
+            tokens=count_tokens(tokens) / time_elapsed,
+        )
+    )
+    return tokens
+
+
+def benchmark_encoding(options: argparse.Namespace):
+    tokeniser_class, fast_tokeniser_class = tokenisers[options.kind]
+    tokeniser = tokeniser_class.from_pretrained(options.tokeniser)
+    fast_tokeniser = fast_tokeniser_class.from_pretrained(options.tokeniser)
+    with open(options.input, "r", encoding="utf8") as fd:
+        num_lines = sum(1 for _ in fd)
+
+    modes = OrderedDict(
+        [
+            ("Line by line", dict(batch_encoding=False)),
+            (
+                "Batched (fast)",
+                dict(batch_encoding=True, fast_tokeniser=fast_tokeniser),
+            ),
+            (
+                "Batched ({} processes)".format(options.num_workers),
+                dict(batch_encoding=True, num_workers=options.num_workers),
+            ),
+        ]
+    )
+    reference = None
+    for name, kwargs in modes.items():
+        tokens = measure(
+            lambda: TextDataset.tokenise(options.input, tokeniser, **kwargs),
+            name,
+            num_lines,
+        )
+        if reference is None:
+            reference = tokens
+        elif tokens != reference:
+            print("  -> Tokens differ from the line by line encoding")
+
+
+def benchmark_scoring(options: argparse.Namespace):
+    torch.set_num_threads(options.num_threads)
+    use_cuda = torch.cuda.is_available() and not options.no_cuda
+    device = torch.device("cuda" if use_cuda else "cpu")
+    sentences = [line for chunk in read_sentences(options.input) for line in chunk]
+    for share_prefixes in [False, True]:
+        scorer = SentenceScorer.from_checkpoint(
+            options.checkpoint,
+            device,
+            max_tokens=options.max_tokens,
+            share_prefixes=share_prefixes,
+        )
+        # Warm up, which excludes the one-time initialisation from the measurement.
+        scorer.score(sentences[:10])
+        measure(
+            lambda: scorer.score(sentences),
+            "Shared prefixes" if share_prefixes else "Batched by length",
+            len(sentences),
+            count_tokens=lambda results: sum(
+                len(result["token_scores"]) for result in results
+            ),
+        )
+
+
+def mask_tokens_lists(
+    tokens: torch.Tensor,
+    tokeniser: PreTrainedTokenizer,
+    prob: float = 0.15,
+    ignore_label: int = -100,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Masking with the special tokens mask created from Python lists for each batch,
+    which was used before the TokenMasker, as a reference for the benchmark.
+    """
+    labels = tokens.clone()
+    probability_matrix = torch.full_like(labels, prob, dtype=torch.float)
+    special_tokens_mask = torch.tensor(
+        [
+            tokeniser.get_special_tokens_mask(label, already_has_special_tokens=True)
+            for label in labels.tolist()
+        ],
+        dtype=torch.bool,
+    ).to(tokens.device)
+    probability_matrix[special_tokens_mask] = 0.0
+    mask_indices = torch.bernoulli(probability_matrix).to(torch.bool)
+    labels[~mask_indices] = ignore_label
+    replace_indices = (
+        torch.bernoulli(torch.full_like(labels, 0.8, dtype=torch.float)).to(torch.bool)
+        & mask_indices
+    )
+    tokens[replace_indices] = tokeniser.convert_tokens_to_ids(tokeniser.mask_token)
+    random_indices = (
+        torch.bernoulli(torch.full_like(labels, 0.5, dtype=torch.float)).to(torch.bool)
+        & mask_indices
+        & ~replace_indices
+    )
+    tokens[random_indices] = torch.randint_like(
+        tokens[random_indices], 0, len(tokeniser)
+    )
+    return tokens, labels
+
+
+def benchmark_masking(options: argparse.Namespace):
+    torch.set_num_threads(options.num_threads)
+    use_cuda = torch.cuda.is_available() and not options.no_cuda
+    device = torch.device("cuda" if use_cuda else "cpu")
+    tokeniser = BertTokenizer.from_pretrained(options.tokeniser)
+    # Random blocks of text with the special tokens at the start and end.
+    special_ids = set(tokeniser.all_special_ids)
+    word_ids = torch.tensor(
+        [i for i in range(len(tokeniser)) if i not in special_ids], device=device
+    )
+    words = word_ids[
+        torch.randint(
+            len(word_ids), (options.batch_size, options.block_size - 2), device=device
+        )
+    ]
+    blocks = torch.cat(
+        [
+            words.new_full((options.batch_size, 1), tokeniser.cls_token_id),
+            words,
+            words.new_full((options.batch_size, 1), tokeniser.sep_token_id),
+        ],
+        dim=1,
+    )
+    masker = TokenMasker(tokeniser)
+    modes = OrderedDict(
+        [
+            ("Python lists", lambda tokens: mask_tokens_lists(tokens, tokeniser)),
+            ("TokenMasker", masker),
+        ]
+    )
+    mask_token_id = tokeniser.convert_tokens_to_ids(tokeniser.mask_token)
+    for name, mask in modes.items():
+        # Warm up, which excludes the one-time initialisation from the measurement.
+        mask(blocks.clone())
+
+        def run_steps() -> torch.Tensor:
+            # Number of masked tokens, replaced by the mask token and kept as is.
+            counts = torch.zeros(3, dtype=torch.long, device=device)
+            for _ in range(options.num_steps):
+                inputs, labels = mask(blocks.clone())
+                masked = labels != -100
+                counts += torch.stack(
+                    [
+                        masked.sum(),
+                        (masked & (inputs == mask_token_id)).sum(),
+                        (masked & (inputs == blocks)).sum(),
+                    ]
+                )
+            if use_cuda:
+                torch.cuda.synchronize()
+            return counts
+
+        counts = measure(
+            run_steps,
+            name,
+            options.num_steps * options.batch_size,
+            count_tokens=lambda _: options.num_steps * blocks.numel(),
+        )
+        num_masked, num_replaced, num_kept = counts.tolist()
+        print(
+            (
+                "  -> {masked:.2%} masked: {replaced:.2%} mask token, "
+                "{random:.2%} random, {kept:.2%} original"
+            ).format(
+                masked=num_masked
+                / (options.num_steps * (blocks.numel() - 2 * len(blocks))),
+                replaced=num_replaced / num_masked,
+                random=(num_masked - num_replaced - num_kept) / num_masked,
+                kept=num_kept / num_masked,
+            )
+        )
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    encoding_parser = subparsers.add_parser(
+        "encoding", help="Throughput of the different encodings of a TSV file"
+    )
+    encoding_parser.set_defaults(run=benchmark_encoding)
+    encoding_parser.add_argument(
+        "-i",
+        "--input",
+        dest="input",
+        required=True,
+        type=str,
+        help="Path to TSV file of the sentences",
+    )
+    encoding_parser.add_argument(
+        "-t",
+        "--tokeniser",
+        dest="tokeniser",
+        required=True,
+        type=str,
+        help="Name or directory of the (pre-trained) tokeniser",
+    )
+    encoding_parser.add_argument(
+        "-k",
+        "--kind",
+        dest="kind",
+        default=default_kind,
+        choices=tokenisers.keys(),
+        help="Which kind of tokeniser to use [Default: {}]".format(default_kind),
+    )
+    encoding_parser.add_argument(
+        "-w",
+        "--workers",
+        dest="num_workers",
+        default=num_workers,
+        type=int,
+        help="Number of processes for the batch encoding [Default: {}]".format(
+            num_workers
+        ),
+    )
+
+    scoring_parser = subparsers.add_parser(
+        "scoring", help="Throughput of scoring the sentences of a TSV file"
+    )
+    scoring_parser.set_defaults(run=benchmark_scoring)
+    scoring_parser.add_argument(
+        "-i",
+        "--input",
+        dest="input",
+        required=True,
+        type=str,
+        help="Path to TSV file of the sentences",
+    )
+    scoring_parser.add_argument(
+        "-c",
+        "--checkpoint",
+        dest="checkpoint",
+        required=True,
+        type=str,
+        help="Path to the checkpoint of the (causal) language model",
+    )
+    scoring_parser.add_argument(
+        "--max-tokens",
+        dest="max_tokens",
+        default=max_tokens,
+        type=int,
+        help=(
+            "Maximum number of tokens (including padding) per batch "
+            "[Default: {}]".format(max_tokens)
+        ),
+    )
+    scoring_parser.add_argument(
+        "-t",
+        "--threads",
+        dest="num_threads",
+        default=num_threads,
+        type=int,
+        help="Number of threads used on the CPU [Default: {}]".format(num_threads),
+    )
+    scoring_parser.add_argument(
+        "--no-cuda",
+        dest="no_cuda",
+        action="store_true",
+        help="Do not use CUDA even if it's available",
+    )
+
+    masking_parser = subparsers.add_parser(
+        "masking",
+        help="Time per batch of the masking for masked language modelling",
+    )
+    masking_parser.set_defaults(run=benchmark_masking)
+    masking_parser.add_argument(
+        "-t",
+        "--tokeniser",
+        dest="tokeniser",
+        required=True,
+        type=str,
+        help="Name or directory of the (pre-trained) BERT tokeniser",
+    )
+    masking_parser.add_argument(
+        "-b",
+        "--batch-size",
+        dest="batch_size",
+        default=batch_size,
+        type=int,
+        help="Size of data batches [Default: {}]".format(batch_size),
+    )
+    masking_parser.add_argument(
+        "--block-size",
+        dest="block_size",
+        default=block_size,
+        type=int,
+        help="Size of the blocks of text [Default: {}]".format(block_size),
+    )
+    masking_parser.add_argument(
+        "-n",
+        "--num-steps",
+        dest="num_steps",
+        default=num_steps,
+        type=int,
+        help="Number of batches to mask [Default: {}]".format(num_steps),
+    )
+    masking_parser.add_argument(
+        "--threads",
+        dest="num_threads",
+        default=num_threads,
+        type=int,
+        help="Number of threads used on the CPU [Default: {}]".format(num_threads),
+    )
+    masking_parser.add_argument(
+        "--no-cuda",
+        dest="no_cuda",
+        action="store_true",
+        help="Do not use CUDA even if it's available",
+    )
+    return parser.parse_args()
+
+
+def main():
+    options = parse_args()
+    options.run(options)
+
+
+if __name__ == "__main__":
+    main()
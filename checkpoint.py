@@ -1,12 +1,31 @@
+import inspect
 import os
+import queue
+import random
+import shutil
+import threading
 import time
 from collections import OrderedDict
-from typing import Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional, Set
 
 import lavd
+import numpy as np
 import torch
 import torch.nn as nn
-from transformers import PreTrainedModel, PreTrainedTokenizer
+from transformers import (
+    WEIGHTS_NAME,
+    BertConfig,
+    BertForMaskedLM,
+    BertTokenizer,
+    BertTokenizerFast,
+    GPT2Config,
+    GPT2LMHeadModel,
+    GPT2Tokenizer,
+    GPT2TokenizerFast,
+    PreTrainedModel,
+    PreTrainedTokenizer,
+    XLNetTokenizer,
+)
 
 default_checkpoint = {
     "epoch": 0,
@@ -32,12 +51,109 @@ def load_checkpoint(path: str, cuda: bool = False) -> Dict:
     return torch.load(path, map_location=device)
 
 
+def load_pretrained(path: str, model_kind: Optional[str] = None) -> Dict:
+    """
+    Loads the model and tokeniser of a checkpoint directory.
+
+    Args:
+        path (str): Directory of the checkpoint
+        model_kind (str, optional): Kind of the model, if it is not stored in the
+            stats of the checkpoint.
+
+    Returns:
+        pretrained (Dict): The model and tokeniser, the class of the fast tokeniser
+            (None if there is none), whether the model is a masked language model and
+            how the special tokens are added (use_special and manual_special, see
+            TextDataset).
+    """
+    stats_path = os.path.join(path, "stats.pt")
+    if model_kind is None and os.path.exists(stats_path):
+        model_kind = load_checkpoint(stats_path)["model"].get("kind")
+    fast_tokeniser_class = None
+    masked_lm = True
+    use_special = True
+    manual_special = False
+    if model_kind == "bert" or model_kind == "bert-scratch":
+        config = BertConfig.from_pretrained(path)
+        model = BertForMaskedLM.from_pretrained(path, config=config)
+        tokeniser = BertTokenizer.from_pretrained(path)
+        fast_tokeniser_class = BertTokenizerFast
+    elif model_kind == "gpt2" or model_kind == "gpt2-scratch":
+        config = GPT2Config.from_pretrained(path)
+        model = GPT2LMHeadModel.from_pretrained(path, config=config)
+        tokeniser = GPT2Tokenizer.from_pretrained(path)
+        fast_tokeniser_class = GPT2TokenizerFast
+        masked_lm = False
+        use_special = False
+    elif model_kind == "gpt2-german":
+        config = GPT2Config.from_pretrained(path)
+        model = GPT2LMHeadModel.from_pretrained(path, config=config)
+        # The special tokens are stored with the tokeniser of the checkpoint.
+        tokeniser = XLNetTokenizer.from_pretrained(path, keep_accents=True)
+        masked_lm = False
+        use_special = False
+        manual_special = True
+    else:
+        raise Exception("No model available for {}".format(model_kind))
+    return OrderedDict(
+        kind=model_kind,
+        model=model,
+        tokeniser=tokeniser,
+        fast_tokeniser_class=fast_tokeniser_class,
+        masked_lm=masked_lm,
+        use_special=use_special,
+        manual_special=manual_special,
+    )
+
+
+# The training state (optimiser, scaler, random number generators and position in the
+# epoch) is stored next to the stats. Checkpoints without it can only be used to
+# resume at the start of an epoch with a new optimiser.
+def load_training_state(checkpoint_dir: str) -> Optional[Dict]:
+    path = os.path.join(checkpoint_dir, "training_state.pt")
+    if not os.path.exists(path):
+        return None
+    # The state of numpy's random number generator is not a tensor, which torch.load
+    # refuses to unpickle by default since version 2.6. Versions before 1.13 do not
+    # have the option and always unpickle everything.
+    kwargs = (
+        dict(weights_only=False)
+        if "weights_only" in inspect.signature(torch.load).parameters
+        else {}
+    )
+    return torch.load(path, map_location=torch.device("cpu"), **kwargs)
+
+
+def get_rng_state() -> Dict:
+    return OrderedDict(
+        python=random.getstate(),
+        numpy=np.random.get_state(),
+        torch=torch.get_rng_state(),
+        cuda=torch.cuda.get_rng_state() if torch.cuda.is_available() else None,
+    )
+
+
+def set_rng_state(state: Dict):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if state["cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state(state["cuda"])
+
+
 def log_top_checkpoints(
     logger: lavd.Logger,
     results: Dict[str, Dict],
     criterion: List[OrderedDict],
     k: int = 5,
-):
+) -> Set[int]:
+    """
+    Logs the top k checkpoints of each validation and metric.
+
+    Returns:
+        top_epochs (Set[int]): Epochs of all the listed checkpoints.
+    """
+    top_epochs = set()
     lines = []
     for name, result in results.items():
         lines.append("")
@@ -55,6 +171,7 @@ def log_top_checkpoints(
             for i, (value, index) in enumerate(zip(*sorted_metric)):
                 if i >= k:
                     break
+                top_epochs.add(result["start"] + index.item() + 1)
                 lines.append(
                     "{i}. {path} - {value:.5f}\n".format(
                         i=i + 1,
@@ -66,6 +183,7 @@ def log_top_checkpoints(
                 )
     markdown = "\n".join(lines)
     logger.log_markdown(markdown, "best")
+    return top_epochs
 
 
 def log_experiment(logger: lavd.Logger, experiment: Dict):
@@ -80,20 +198,247 @@ def log_experiment(logger: lavd.Logger, experiment: Dict):
     logger.log_summary(infos, options=experiment["options"])
 
 
+def checkpoint_dir(logger: lavd.Logger, step: Optional[int] = None) -> str:
+    # Checkpoints in the middle of an epoch (without a step) replace each other in
+    # the latest directory, whereas every epoch gets its own directory.
+    out_dir = (
+        logger.get_file_path("latest")
+        if step is None
+        else logger.get_file_path("stats", step=step, extension=".pt").parent
+    )
+    return str(out_dir)
+
+
+def to_cpu(obj: Any) -> Any:
+    """
+    Copies all tensors in (nested) dicts, lists and tuples to the CPU, which creates
+    a snapshot that is not affected by further training.
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    elif isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    else:
+        return obj
+
+
+def write_checkpoint(
+    out_dir: str,
+    model: PreTrainedModel,
+    tokeniser: PreTrainedTokenizer,
+    stats: Dict,
+    state_dict: Optional[Dict] = None,
+    training_state: Optional[Dict] = None,
+):
+    """
+    Writes the checkpoint into a temporary directory, which is then renamed to out_dir,
+    so that an interrupted write never leaves an incomplete checkpoint behind.
+
+    Args:
+        out_dir (str): Directory of the checkpoint
+        model (PreTrainedModel): Model whose configuration is saved
+        tokeniser (PreTrainedTokenizer): Tokeniser of the model
+        stats (Dict): Stats of the training
+        state_dict (Dict, optional): Weights to save instead of the current weights
+            of the model, e.g. a snapshot on the CPU.
+        training_state (Dict, optional): State to resume the training
+    """
+    tmp_dir = out_dir + ".tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    torch.save(stats, os.path.join(tmp_dir, "stats.pt"))
+    if training_state is not None:
+        torch.save(training_state, os.path.join(tmp_dir, "training_state.pt"))
+    if state_dict is None:
+        model.save_pretrained(tmp_dir)
+    else:
+        # Same as save_pretrained, but with the given weights.
+        model.config.save_pretrained(tmp_dir)
+        torch.save(state_dict, os.path.join(tmp_dir, WEIGHTS_NAME))
+    tokeniser.save_pretrained(tmp_dir)
+    # A directory cannot be replaced atomically, therefore the old one is moved out of
+    # the way first.
+    old_dir = out_dir + ".old"
+    if os.path.exists(out_dir):
+        if os.path.exists(old_dir):
+            shutil.rmtree(old_dir)
+        os.rename(out_dir, old_dir)
+    os.rename(tmp_dir, out_dir)
+    if os.path.exists(old_dir):
+        shutil.rmtree(old_dir)
+
+
 def save_checkpoint(
     logger: lavd.Logger,
     model: PreTrainedModel,
     tokeniser: PreTrainedTokenizer,
     stats: Dict,
-    step: int,
+    step: Optional[int] = None,
+    training_state: Optional[Dict] = None,
 ):
     if not logger.disabled:
-        logger.save_obj(stats, "stats", step=step)
-        stats_path = logger.get_file_path("stats", step=step, extension=".pt")
-        out_dir = stats_path.parent
-        out_dir.mkdir(parents=True, exist_ok=True)
-        model.save_pretrained(out_dir)
-        tokeniser.save_pretrained(out_dir)
+        write_checkpoint(
+            checkpoint_dir(logger, step),
+            model,
+            tokeniser,
+            stats,
+            training_state=training_state,
+        )
+
+
+def remove_checkpoints(checkpoint_dirs: List[str]):
+    for out_dir in checkpoint_dirs:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def existing_steps(logger: lavd.Logger) -> List[int]:
+    """
+    Finds the epochs with a checkpoint in the log directory, in ascending order.
+    """
+    log_dir = logger.get_file_path("")
+    if not os.path.isdir(log_dir):
+        return []
+    steps = []
+    for name in os.listdir(log_dir):
+        if not name.isdigit():
+            continue
+        step = int(name)
+        out_dir = checkpoint_dir(logger, step)
+        if os.path.basename(out_dir) == name and os.path.exists(
+            os.path.join(out_dir, "stats.pt")
+        ):
+            steps.append(step)
+    return sorted(steps)
+
+
+class CheckpointWriter:
+    """
+    Writes the checkpoints on a background thread, so that the training does not wait
+    for them. The weights and the training state are copied to the CPU before the
+    training continues.
+
+    Only the last keep_last checkpoints of the epochs and the ones listed as the best
+    are kept, when keep_last is given. This includes the epochs that were already in
+    the log directory, e.g. before resuming the training, which are only removed once
+    the best ones are known.
+    """
+
+    def __init__(self, logger: lavd.Logger, keep_last: Optional[int] = None):
+        """
+        Args:
+            logger (lavd.Logger): Logger of the experiment, which determines where
+                the checkpoints are saved. Nothing is saved if it is disabled.
+            keep_last (int, optional): Number of most recent epoch checkpoints to
+                keep, in addition to the best ones. If not given, all checkpoints
+                are kept.
+        """
+        self.logger = logger
+        self.keep_last = keep_last
+        self.saved_steps: List[int] = (
+            [] if logger.disabled or keep_last is None else existing_steps(logger)
+        )
+        # Nothing is removed before the best checkpoints are known.
+        self.best_steps: Optional[Set[int]] = None
+        # At most one checkpoint waits to be written, so that the snapshots cannot pile
+        # up in memory when writing is slower than training.
+        self.queue: queue.Queue = queue.Queue(maxsize=1)
+        self.error: Optional[BaseException] = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    return
+                if self.error is None:
+                    task()
+            except BaseException as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _submit(self, task: Optional[Callable[[], None]]):
+        # Errors of the background thread are raised in the training process.
+        if self.error is not None:
+            raise self.error
+        self.queue.put(task)
+
+    def save(
+        self,
+        model: PreTrainedModel,
+        tokeniser: PreTrainedTokenizer,
+        stats: Dict,
+        step: Optional[int] = None,
+        training_state: Optional[Dict] = None,
+    ):
+        """
+        Saves a checkpoint in the background.
+
+        Args:
+            model (PreTrainedModel): Model to save
+            tokeniser (PreTrainedTokenizer): Tokeniser of the model
+            stats (Dict): Stats of the training
+            step (int, optional): Epoch of the checkpoint. If not given, the
+                checkpoint is saved as the latest one in the middle of an epoch.
+            training_state (Dict, optional): State to resume the training
+        """
+        if self.logger.disabled:
+            return
+        out_dir = checkpoint_dir(self.logger, step)
+        state_dict = to_cpu(model.state_dict())
+        stats = to_cpu(stats)
+        training_state = to_cpu(training_state)
+        self._submit(
+            lambda: write_checkpoint(
+                out_dir,
+                model,
+                tokeniser,
+                stats,
+                state_dict=state_dict,
+                training_state=training_state,
+            )
+        )
+        if step is not None:
+            # An existing checkpoint of the same epoch is overwritten.
+            self.saved_steps = [s for s in self.saved_steps if s != step] + [step]
+            self.prune()
+
+    def set_best(self, steps: Set[int]):
+        self.best_steps = set(steps)
+        self.prune()
+
+    def prune(self):
+        """
+        Removes the checkpoints that are neither among the last keep_last nor the best
+        ones, after the pending checkpoints have been written.
+        """
+        if self.logger.disabled or self.keep_last is None or self.best_steps is None:
+            return
+        num_last = max(len(self.saved_steps) - self.keep_last, 0)
+        keep = set(self.saved_steps[num_last:]) | self.best_steps
+        remove_dirs = [
+            checkpoint_dir(self.logger, step)
+            for step in self.saved_steps
+            if step not in keep
+        ]
+        if len(remove_dirs) == 0:
+            return
+        self.saved_steps = [step for step in self.saved_steps if step in keep]
+        self._submit(lambda: remove_checkpoints(remove_dirs))
+
+    def close(self):
+        """
+        Waits until all checkpoints have been written.
+        """
+        self._submit(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
 
 
 def log_results(
@@ -108,6 +453,11 @@ def log_results(
     logger.log_scalar(
         train_result["stats"]["perplexity"], "train/perplexity", step=epoch
     )
+    for key in ["tokens_per_second", "step_time", "host_syncs", "non_finite"]:
+        if key in train_result["stats"]:
+            logger.log_scalar(
+                train_result["stats"][key], "train/{}".format(key), step=epoch
+            )
     for result in validation_results:
         logger.log_scalar(
             result["stats"]["loss"], "{}/loss".format(result["name"]), epoch
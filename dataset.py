@@ -1,10 +1,209 @@
 import csv
+import hashlib
+import json
+import multiprocessing
 import os
-from typing import List, Optional, Tuple
+import random
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 
+import numpy as np
 import torch
-from torch.utils.data import Dataset
-from transformers import PreTrainedTokenizer
+from torch.utils.data import (
+    DataLoader,
+    Dataset,
+    IterableDataset,
+    Sampler,
+    get_worker_info,
+)
+from torch.utils.data.distributed import DistributedSampler
+from transformers import PreTrainedTokenizer, PreTrainedTokenizerFast
+
+
+def word_start_table(tokeniser: PreTrainedTokenizer) -> torch.Tensor:
+    """
+    Creates a table over the vocabulary, whether a token starts a new word, which is
+    every token except for the continuations of WordPiece (starting with ##, as in the
+    vocabularies of prepare_vocab.py).
+    """
+    table = torch.ones(len(tokeniser), dtype=torch.bool)
+    continuation_ids = [
+        i
+        for token, i in tokeniser.get_vocab().items()
+        if token.startswith("##") and i < len(table)
+    ]
+    table[continuation_ids] = False
+    return table
+
+
+masking_strategies = ["token", "whole-word", "span"]
+
+
+class TokenMasker:
+    """
+    Prepares tokens for masked language modelling (MLM)
+    80% Mask, 10% random, 10% original
+
+    The tokens to mask are chosen with one of the strategies:
+        - token: Each token independently
+        - whole-word: Each word independently, masking all of its tokens
+        - span: Spans of whole words, with a geometric distribution of the number of
+          words (as in SpanBERT)
+
+    The special tokens are looked up in a table over the whole vocabulary, which is
+    created once per tokeniser, so that the masks are created with tensor operations
+    on the device of the tokens. It can also be used in the DataLoader workers to
+    create batches that are already masked (see BlockCollate and SentenceCollate).
+    """
+
+    def __init__(
+        self,
+        tokeniser: PreTrainedTokenizer,
+        prob: float = 0.15,
+        ignore_label: int = -100,
+        strategy: str = "token",
+        max_span: int = 10,
+        span_prob: float = 0.2,
+    ):
+        """
+        Args:
+            tokeniser (PreTrainedTokenizer): Tokeniser used for the model.
+            prob (float): Probability of a token to be masked [Default: 0.15]
+            ignore_label (int): Label that is ignored by the loss [Default: -100]
+            strategy (str): How the tokens to mask are chosen, one of token,
+                whole-word or span [Default: token]
+            max_span (int): Maximum number of words of a span [Default: 10]
+            span_prob (float): Parameter of the geometric distribution of the number
+                of words of a span [Default: 0.2]
+        """
+        assert strategy in masking_strategies, "Unknown masking strategy {}".format(
+            strategy
+        )
+        self.prob = prob
+        self.ignore_label = ignore_label
+        self.strategy = strategy
+        self.mask_token_id = tokeniser.convert_tokens_to_ids(tokeniser.mask_token)
+        self.vocab_size = len(tokeniser)
+        self.tables = OrderedDict(
+            is_special=torch.zeros(self.vocab_size, dtype=torch.bool)
+        )
+        self.tables["is_special"][tokeniser.all_special_ids] = True
+        if strategy != "token":
+            # Only used if the word boundaries are not given with the tokens.
+            self.tables["is_word_start"] = word_start_table(tokeniser)
+        if strategy == "span":
+            lengths = torch.arange(1, max_span + 1, dtype=torch.float)
+            length_probs = span_prob * (1 - span_prob) ** (lengths - 1)
+            length_probs /= length_probs.sum()
+            self.tables["span_cdf"] = length_probs.cumsum(dim=0)
+            # The spans start at this rate, so that the expected number of masked
+            # words is the same as for the other strategies.
+            self.span_start_prob = prob / (lengths * length_probs).sum().item()
+        # Copies of the tables on the devices other than the CPU.
+        self.device_tables: Dict[Tuple[str, torch.device], torch.Tensor] = {}
+
+    def table(self, name: str, device: torch.device) -> torch.Tensor:
+        table = self.tables[name]
+        if device != table.device:
+            key = (name, device)
+            table = self.device_tables.get(key)
+            if table is None:
+                table = self.tables[name].to(device)
+                self.device_tables[key] = table
+        return table
+
+    def special_tokens_mask(self, tokens: torch.Tensor) -> torch.Tensor:
+        return self.table("is_special", tokens.device)[tokens.long()]
+
+    def word_mask(
+        self, word_starts: torch.Tensor, special_tokens_mask: torch.Tensor
+    ) -> torch.Tensor:
+        """
+        Chooses the tokens to mask as whole words or spans of whole words.
+
+        Args:
+            word_starts (torch.Tensor): Whether each token starts a new word
+                [Dimension: batch_size x seq_len]
+            special_tokens_mask (torch.Tensor): Whether each token is a special
+                token, which never starts a chosen word or span
+                [Dimension: batch_size x seq_len]
+
+        Returns:
+            mask (torch.Tensor): Whether each token is masked
+                [Dimension: batch_size x seq_len]
+        """
+        device = word_starts.device
+        # The pieces following a special token (cut off by the start of a block)
+        # belong to its word, but are not masked since the word is never chosen.
+        choosable = word_starts & ~special_tokens_mask
+        if self.strategy == "whole-word":
+            positions = torch.arange(word_starts.size(1), device=device).expand_as(
+                word_starts
+            )
+            # Position of the first token of the word that each token belongs to.
+            # Tokens before the first word start (a word cut off by the start of the
+            # block) point to the first token, which is not chosen.
+            start_positions = torch.cummax(
+                positions.masked_fill(~word_starts, 0), dim=1
+            )[0]
+            chosen = (
+                torch.rand(word_starts.size(), device=device) < self.prob
+            ) & choosable
+            return chosen.gather(1, start_positions)
+        # Number of the word that each token belongs to, where the tokens before the
+        # first word start belong to the word 0, which is never part of a span.
+        word_indices = word_starts.long().cumsum(dim=1)
+        span_cdf = self.table("span_cdf", device)
+        lengths = torch.searchsorted(
+            span_cdf, torch.rand(word_starts.size(), device=device)
+        ).clamp(max=span_cdf.size(0) - 1)
+        starts = (
+            torch.rand(word_starts.size(), device=device) < self.span_start_prob
+        ) & choosable
+        # The furthest end (exclusive word number) of the spans started so far, the
+        # token is in a span if its word comes before it.
+        span_ends = (word_indices + lengths + 1).masked_fill(~starts, 0)
+        return word_indices < torch.cummax(span_ends, dim=1)[0]
+
+    def __call__(
+        self, tokens: torch.Tensor, word_starts: Optional[torch.Tensor] = None
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Args:
+            tokens (torch.Tensor): Tokens to mask [Dimension: batch_size x seq_len]
+            word_starts (torch.Tensor, optional): Whether each token starts a new
+                word, for the whole-word and span strategies. If not given, it is
+                looked up from the tokens.
+                [Dimension: batch_size x seq_len]
+
+        Returns:
+            inputs (torch.Tensor): Masked tokens [Dimension: batch_size x seq_len]
+            labels (torch.Tensor): Original tokens of the masked ones, and the ignore
+                label for the rest [Dimension: batch_size x seq_len]
+        """
+        special_tokens_mask = self.special_tokens_mask(tokens)
+        if self.strategy == "token":
+            mask_indices = torch.rand(tokens.size(), device=tokens.device) < self.prob
+        else:
+            if word_starts is None:
+                word_starts = self.table("is_word_start", tokens.device)[tokens.long()]
+            mask_indices = self.word_mask(
+                word_starts.to(tokens.device).bool(), special_tokens_mask
+            )
+        # The special tokens are never masked.
+        mask_indices &= ~special_tokens_mask
+        # Non-masked labels are not used for the loss
+        labels = tokens.masked_fill(~mask_indices, self.ignore_label)
+        # 80% of the masked inputs are replaced with the Mask token, 10% with a random
+        # word and the remaining 10% are left as is.
+        choice = torch.rand(tokens.size(), device=tokens.device)
+        replace_indices = mask_indices & (choice < 0.8)
+        random_indices = mask_indices & (choice >= 0.8) & (choice < 0.9)
+        inputs = tokens.masked_fill(replace_indices, self.mask_token_id)
+        inputs = torch.where(
+            random_indices, torch.randint_like(tokens, 0, self.vocab_size), inputs
+        )
+        return inputs, labels
 
 
 def mask_tokens(
@@ -16,41 +215,164 @@ def mask_tokens(
     """
     Prepares tokens for masked language modelling (MLM)
     80% Mask, 10% random, 10% original
+
+    Creates the lookup of the special tokens for every call, hence a TokenMasker
+    should be used instead when masking many batches.
     """
-    labels = tokens.clone()
-    probability_matrix = torch.full_like(labels, prob, dtype=torch.float)
-    special_tokens_mask = torch.tensor(
-        [
-            tokeniser.get_special_tokens_mask(label, already_has_special_tokens=True)
-            for label in labels.tolist()
-        ],
-        dtype=torch.bool,
-    )
-    # Set the probabilities of the special tokens to 0.
-    probability_matrix[special_tokens_mask] = 0.0
-    mask_indices = torch.bernoulli(probability_matrix).to(torch.bool)
-    # Non-masked labels are not used for the loss
-    labels[~mask_indices] = ignore_label
-    # 80% of the masked inputs are replaced with the Mask token.
-    replace_indices = (
-        torch.bernoulli(torch.full_like(labels, 0.8, dtype=torch.float)).to(torch.bool)
-        & mask_indices
-    )
-    tokens[replace_indices] = tokeniser.convert_tokens_to_ids(tokeniser.mask_token)
-    # 10% of the masked inputs (i.e. 50% of the remaining ones) are replaced with
-    # a random word.
-    random_indices = (
-        torch.bernoulli(torch.full_like(labels, 0.5, dtype=torch.float)).to(torch.bool)
-        & mask_indices
-        & ~replace_indices
-    )
+    return TokenMasker(tokeniser, prob=prob, ignore_label=ignore_label)(tokens)
 
-    tokens[random_indices] = torch.randint_like(
-        tokens[random_indices], 0, len(tokeniser)
+
+# Bump whenever the layout of the cached token files changes, so that stale caches are
+# not picked up.
+cache_version = 2
+
+
+def file_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    Computes the SHA-256 of a file's content, reading it in chunks to avoid loading
+    the whole file into memory.
+    """
+    sha = hashlib.sha256()
+    with open(path, "rb") as fd:
+        for chunk in iter(lambda: fd.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def tokeniser_identity(tokeniser: PreTrainedTokenizer) -> str:
+    """
+    Creates an identifier of the tokeniser, which changes whenever the tokeniser
+    would produce different tokens (kind of tokeniser, vocabulary or special tokens).
+    """
+    identity = OrderedDict(
+        kind=type(tokeniser).__name__,
+        vocab=sorted(tokeniser.get_vocab().items()),
+        special=sorted(tokeniser.special_tokens_map.items()),
     )
+    return hashlib.sha256(
+        json.dumps(identity, ensure_ascii=False).encode("utf8")
+    ).hexdigest()
+
+
+def save_array_atomic(path: str, array: np.ndarray):
+    """
+    Saves a numpy array to a temporary file first and then renames it, so that an
+    interrupted write (or a concurrent reader) never sees a partial file.
+    """
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as fd:
+        np.save(fd, array)
+    os.replace(tmp_path, path)
+
+
+def read_lines(path: str, chunk_size: int = 10000) -> Iterator[List[str]]:
+    """
+    Reads the text column of a TSV file lazily in chunks of lines.
+    """
+    with open(path, "r", encoding="utf8") as fd:
+        reader = csv.reader(fd, delimiter="\t", quoting=csv.QUOTE_NONE, quotechar="")
+        chunk = []
+        for line in reader:
+            chunk.append(line[0])
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if len(chunk) > 0:
+            yield chunk
+
+
+# Tokeniser of the pool workers, which is set once per worker by the initialiser rather
+# than being serialised for every chunk.
+_worker_tokeniser: Optional[PreTrainedTokenizer] = None
+
+
+def _init_encode_worker(tokeniser: PreTrainedTokenizer):
+    global _worker_tokeniser
+    _worker_tokeniser = tokeniser
+
 
-    # The remaining 10% are left as is
-    return tokens, labels
+def _encode_chunk(lines: List[str]) -> List[List[int]]:
+    assert _worker_tokeniser is not None, "Encode worker has not been initialised"
+    return [_worker_tokeniser.encode(line, add_special_tokens=False) for line in lines]
+
+
+def encode_lines(
+    chunks: Iterator[List[str]],
+    tokeniser: PreTrainedTokenizer,
+    fast_tokeniser: Optional[PreTrainedTokenizerFast] = None,
+    num_workers: Optional[int] = None,
+) -> Iterator[List[List[int]]]:
+    """
+    Encodes chunks of lines in batches, yielding the encoded chunks in order.
+
+    The fast (Rust) tokeniser encodes a whole chunk in a single call. Without a fast
+    tokeniser, the chunks are distributed over a pool of processes that each use the
+    regular tokeniser.
+
+    Args:
+        chunks (Iterator[List[str]]): Chunks of lines to encode
+        tokeniser (PreTrainedTokenizer): Tokeniser used for the model.
+        fast_tokeniser (PreTrainedTokenizerFast, optional): Fast version of the
+            tokeniser, which must produce the same tokens as the tokeniser.
+        num_workers (int, optional): Number of processes used when no fast tokeniser
+            is available [Default: Number of CPUs]
+
+    Returns:
+        encoded (Iterator[List[List[int]]]): Token ids of each line, per chunk
+    """
+    if fast_tokeniser is not None:
+        for chunk in chunks:
+            yield fast_tokeniser.batch_encode_plus(
+                chunk,
+                add_special_tokens=False,
+                return_attention_mask=False,
+                return_token_type_ids=False,
+            )["input_ids"]
+    else:
+        with multiprocessing.Pool(
+            num_workers, initializer=_init_encode_worker, initargs=(tokeniser,)
+        ) as pool:
+            yield from pool.imap(_encode_chunk, chunks)
+
+
+def encode_file(
+    path: str,
+    tokeniser: PreTrainedTokenizer,
+    batch_encoding: bool = False,
+    fast_tokeniser: Optional[PreTrainedTokenizerFast] = None,
+    num_workers: Optional[int] = None,
+) -> Iterator[List[int]]:
+    """
+    Encodes the lines of a TSV file (without special tokens), either line by line or in
+    batches (see encode_lines).
+    """
+    if batch_encoding:
+        for chunk in encode_lines(
+            read_lines(path),
+            tokeniser,
+            fast_tokeniser=fast_tokeniser,
+            num_workers=num_workers,
+        ):
+            yield from chunk
+    else:
+        for chunk in read_lines(path):
+            for line in chunk:
+                yield tokeniser.encode(line, add_special_tokens=False)
+
+
+def cache_file_path(
+    cache_dir: str, name: str, path: str, tokeniser: PreTrainedTokenizer, *options
+) -> str:
+    """
+    Path of the cache entry for the file, keyed by the file's content, the identity of
+    the tokeniser and any options that change the cached data.
+    """
+    cache_key = hashlib.sha256(
+        json.dumps(
+            [cache_version, file_hash(path), tokeniser_identity(tokeniser), *options]
+        ).encode("utf8")
+    ).hexdigest()
+    return os.path.join(cache_dir, "{}-{}".format(name, cache_key[:16]))
 
 
 class TextDataset(Dataset):
@@ -64,6 +386,11 @@ class TextDataset(Dataset):
         manual_special: bool = False,
         block_size: int = 512,
         name: Optional[str] = None,
+        cache_dir: Optional[str] = None,
+        batch_encoding: bool = False,
+        fast_tokeniser: Optional[PreTrainedTokenizerFast] = None,
+        num_workers: Optional[int] = None,
+        word_boundaries: bool = False,
     ):
         """
         Args:
@@ -80,6 +407,25 @@ class TextDataset(Dataset):
             block_size (int): Size of the blocks of text [Default: 512]
             name (string, optional): Name of the dataset
                 [Default: Name of the ground truth file and its parent directory]
+            cache_dir (string, optional): Directory where the tokenised blocks are
+                cached. The cache is keyed by the hash of the file, the identity of the
+                tokeniser and the block options, so subsequent runs (and all other
+                processes) memory-map the tokens instead of tokenising the file again.
+                [Default: No caching]
+            batch_encoding (bool): Whether to encode the file in chunks of lines,
+                either with the fast tokeniser or with a pool of processes.
+                The tokens are identical to encoding it line by line.
+                [Default: False]
+            fast_tokeniser (PreTrainedTokenizerFast, optional): Fast version of the
+                tokeniser used for the batch encoding. Without it, the batch encoding
+                uses a pool of processes instead.
+            num_workers (int, optional): Number of processes for the batch encoding
+                when no fast tokeniser is given [Default: Number of CPUs]
+            word_boundaries (bool): Whether to store which tokens start a new word
+                alongside the blocks, for the whole-word and span masking
+                (see TokenMasker). The samples are then dictionaries of the
+                input_ids and word_starts.
+                [Default: False]
         """
         super(TextDataset, self).__init__()
         self.block_size = min(block_size, tokeniser.max_len_single_sentence)
@@ -100,38 +446,880 @@ class TextDataset(Dataset):
                 "when using manual_special=True"
             )
 
-        with open(path, "r", encoding="utf8") as fd:
-            reader = csv.reader(
-                fd, delimiter="\t", quoting=csv.QUOTE_NONE, quotechar=""
+        cache_path = None
+        if cache_dir is not None:
+            cache_path = "{}.blocks.npy".format(
+                cache_file_path(
+                    cache_dir,
+                    self.name,
+                    path,
+                    tokeniser,
+                    self.block_size,
+                    use_special,
+                    manual_special,
+                )
             )
-            tokenised_ids: List[int] = []
+
+        # All blocks are stored in a single 2D tensor of shape [num_blocks, block_len],
+        # so that each block is a view into it rather than a separate object.
+        # int32 is the smallest integer type that fits the vocabularies and that can be
+        # used by torch without any conversion.
+        self.blocks: torch.Tensor
+        if cache_path is not None and os.path.exists(cache_path):
+            # Memory-mapped, hence the blocks are shared by all processes through the
+            # page cache rather than each process having its own copy.
+            # The copy-on-write mode is only used because torch requires a writable
+            # array, but the blocks are never modified.
+            self.blocks = torch.from_numpy(np.load(cache_path, mmap_mode="c"))
+        else:
+            tokenised_ids = self.tokenise(
+                path,
+                tokeniser,
+                manual_special,
+                batch_encoding=batch_encoding,
+                fast_tokeniser=fast_tokeniser,
+                num_workers=num_workers,
+            )
+            blocks = self.build_blocks(
+                tokenised_ids, tokeniser, use_special, manual_special
+            )
+            if cache_path is not None:
+                os.makedirs(cache_dir, exist_ok=True)
+                save_array_atomic(cache_path, blocks)
+            # Moves the blocks into shared memory, so that the DataLoader workers use
+            # the same memory instead of getting their own copy.
+            self.blocks = torch.from_numpy(blocks).share_memory_()
+
+        # The word boundaries are computed once with a lookup of all tokens, and are
+        # cached and shared the same way as the blocks.
+        self.word_starts: Optional[torch.Tensor] = None
+        if word_boundaries:
+            words_path = (
+                None
+                if cache_path is None
+                else cache_path.replace(".blocks.npy", ".words.npy")
+            )
+            if words_path is not None and os.path.exists(words_path):
+                self.word_starts = torch.from_numpy(np.load(words_path, mmap_mode="c"))
+            else:
+                word_starts = word_start_table(tokeniser).numpy()[self.blocks.numpy()]
+                if words_path is not None:
+                    os.makedirs(cache_dir, exist_ok=True)
+                    save_array_atomic(words_path, word_starts)
+                self.word_starts = torch.from_numpy(word_starts).share_memory_()
+
+    @staticmethod
+    def tokenise(
+        path: str,
+        tokeniser: PreTrainedTokenizer,
+        manual_special: bool = False,
+        batch_encoding: bool = False,
+        fast_tokeniser: Optional[PreTrainedTokenizerFast] = None,
+        num_workers: Optional[int] = None,
+    ) -> List[int]:
+        """
+        Tokenises the whole file into one stream of token ids.
+        """
+        tokenised_ids: List[int] = []
+        if manual_special:
+            tokenised_ids.append(tokeniser.eos_token_id)
+
+        for encoded in encode_file(
+            path,
+            tokeniser,
+            batch_encoding=batch_encoding,
+            fast_tokeniser=fast_tokeniser,
+            num_workers=num_workers,
+        ):
+            tokenised_ids.extend(encoded)
             if manual_special:
                 tokenised_ids.append(tokeniser.eos_token_id)
+        return tokenised_ids
 
-            for line in reader:
-                #print(line[0])
-                encoded = tokeniser.encode(line[0], add_special_tokens=False)
-                #print(max(tokeniser.added_tokens_encoder.values()))
-                #print(encoded)
-                #raise Exception
-                tokenised_ids.extend(encoded)
-                if manual_special:
-                    tokenised_ids.append(tokeniser.eos_token_id)
-
-        self.text_blocks: List[List[int]] = []
-        # Group into blocks of text, discarding the last incomplete text.
-        for i in range(0, len(tokenised_ids) - self.block_size + 1, self.block_size):
-            token_block = tokenised_ids[i : i + self.block_size]
-            if use_special:
-                token_block = (
-                    [tokeniser.bos_token_id] + token_block + [tokeniser.eos_token_id]
-                    if manual_special
-                    else tokeniser.build_inputs_with_special_tokens(token_block)
-                )
-            self.text_blocks.append(token_block)
+    def build_blocks(
+        self,
+        tokenised_ids: List[int],
+        tokeniser: PreTrainedTokenizer,
+        use_special: bool = True,
+        manual_special: bool = False,
+    ) -> np.ndarray:
+        """
+        Groups the token stream into blocks of text, discarding the last incomplete
+        text.
+
+        Returns:
+            blocks (np.ndarray): Blocks (including their special tokens) with shape
+                [num_blocks, block_len]
+        """
+        num_blocks = len(tokenised_ids) // self.block_size
+        blocks = np.array(
+            tokenised_ids[: num_blocks * self.block_size], dtype=np.int32
+        ).reshape(num_blocks, self.block_size)
+        if use_special and num_blocks > 0:
+            blocks = np.array(
+                [
+                    (
+                        [tokeniser.bos_token_id] + block + [tokeniser.eos_token_id]
+                        if manual_special
+                        else tokeniser.build_inputs_with_special_tokens(block)
+                    )
+                    for block in blocks.tolist()
+                ],
+                dtype=np.int32,
+            ).reshape(num_blocks, -1)
+        return blocks
 
     def __len__(self) -> int:
-        return len(self.text_blocks)
+        return self.blocks.size(0)
+
+    def __getitem__(self, i: int) -> Union[torch.Tensor, Dict[str, torch.Tensor]]:
+        # A view into the blocks, which is converted to the long type only after being
+        # moved to the device.
+        if self.word_starts is None:
+            return self.blocks[i]
+        return OrderedDict(input_ids=self.blocks[i], word_starts=self.word_starts[i])
+
+
+def shuffle_buffered(
+    items: Iterator[torch.Tensor], buffer_size: int, rng: random.Random
+) -> Iterator[torch.Tensor]:
+    """
+    Approximately shuffles a stream by keeping a buffer of items, from which a random
+    one is emitted whenever a new item arrives.
+    """
+    buffer: List[torch.Tensor] = []
+    for item in items:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        index = rng.randrange(buffer_size)
+        yield buffer[index]
+        buffer[index] = item
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+class StreamingTextDataset(IterableDataset):
+    """
+    Dataset of text that is read and tokenised lazily, for corpora that do not fit into
+    memory.
+
+    The lines are sharded across the DataLoader workers and the distributed processes,
+    and each shard groups its own lines into blocks of text.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        tokeniser: PreTrainedTokenizer,
+        use_special: bool = True,
+        manual_special: bool = False,
+        block_size: int = 512,
+        name: Optional[str] = None,
+        shuffle_buffer: int = 0,
+        seed: int = 0,
+        rank: int = 0,
+        num_replicas: int = 1,
+    ):
+        """
+        Args:
+            path (string): Path to fiel with the text
+            tokeniser (PreTrainedTokenizer): Tokeniser used for the model.
+            use_special (bool): Whether the tokeniser uses speical tokens.
+                [Default: True]
+            manual_special (bool): Whether to manually add special tokens to the start
+                and end of the sequence rather than using the tokeniser's specific
+                implementation. See TextDataset.
+                [Default: False]
+            block_size (int): Size of the blocks of text [Default: 512]
+            name (string, optional): Name of the dataset
+                [Default: Name of the ground truth file and its parent directory]
+            shuffle_buffer (int): Number of blocks kept in the buffer to shuffle them.
+                With 0 or 1 the blocks are not shuffled.
+                [Default: 0]
+            seed (int): Seed for the shuffling, which is combined with the epoch.
+                [Default: 0]
+            rank (int): Rank of the current process in the distributed training.
+                [Default: 0]
+            num_replicas (int): Number of processes in the distributed training.
+                [Default: 1]
+        """
+        super(StreamingTextDataset, self).__init__()
+        self.block_size = min(block_size, tokeniser.max_len_single_sentence)
+        self.path = path
+        self.tokeniser = tokeniser
+        self.use_special = use_special
+        self.manual_special = manual_special
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.rank = rank
+        self.num_replicas = num_replicas
+        self.epoch = 0
+        if name is None:
+            filename = os.path.splitext(os.path.basename(path))[0]
+            self.name = filename
+        else:
+            self.name = name
+
+        if manual_special:
+            assert (
+                tokeniser.bos_token_id is not None
+                and tokeniser.eos_token_id is not None
+            ), (
+                "tokeniser must have set a bos_token and eos_token "
+                "when using manual_special=True"
+            )
+
+    def set_epoch(self, epoch: int):
+        """
+        Sets the epoch, which changes the order of the shuffled blocks. Must be called
+        before creating the iterator of the DataLoader.
+        """
+        self.epoch = epoch
+
+    def iter_blocks(self, shard: int, num_shards: int) -> Iterator[torch.Tensor]:
+        """
+        Groups the lines of the given shard into blocks of text, carrying the tokens
+        that do not fill a whole block over to the next line. The last incomplete text
+        is discarded.
+        """
+        tokeniser = self.tokeniser
+        buffer: List[int] = []
+        if self.manual_special:
+            buffer.append(tokeniser.eos_token_id)
+        line_index = 0
+        for chunk in read_lines(self.path):
+            for line in chunk:
+                line_index += 1
+                if (line_index - 1) % num_shards != shard:
+                    continue
+                buffer.extend(tokeniser.encode(line, add_special_tokens=False))
+                if self.manual_special:
+                    buffer.append(tokeniser.eos_token_id)
+                while len(buffer) >= self.block_size:
+                    token_block = buffer[: self.block_size]
+                    buffer = buffer[self.block_size :]
+                    if self.use_special:
+                        token_block = (
+                            [tokeniser.bos_token_id]
+                            + token_block
+                            + [tokeniser.eos_token_id]
+                            if self.manual_special
+                            else tokeniser.build_inputs_with_special_tokens(token_block)
+                        )
+                    yield torch.tensor(token_block)
+
+    def __iter__(self) -> Iterator[torch.Tensor]:
+        worker_info = get_worker_info()
+        num_workers = 1 if worker_info is None else worker_info.num_workers
+        worker_id = 0 if worker_info is None else worker_info.id
+        num_shards = self.num_replicas * num_workers
+        shard = self.rank * num_workers + worker_id
+        blocks = self.iter_blocks(shard, num_shards)
+        if self.shuffle_buffer > 1:
+            rng = random.Random("{}-{}-{}".format(self.seed, self.epoch, shard))
+            blocks = shuffle_buffered(blocks, self.shuffle_buffer, rng)
+        return blocks
+
+
+class SentenceDataset(Dataset):
+    """
+    Dataset of text, where each sentence (line) is kept separately rather than being
+    grouped into blocks of text. Sentences longer than the block size are truncated.
+
+    Meant to be used with the BucketBatchSampler and SentenceCollate, which batch
+    sentences of similar lengths together and pad them.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        tokeniser: PreTrainedTokenizer,
+        use_special: bool = True,
+        manual_special: bool = False,
+        block_size: int = 512,
+        name: Optional[str] = None,
+        cache_dir: Optional[str] = None,
+        batch_encoding: bool = False,
+        fast_tokeniser: Optional[PreTrainedTokenizerFast] = None,
+        num_workers: Optional[int] = None,
+    ):
+        """
+        Args:
+            See TextDataset, where block_size is the maximum length of a sentence.
+        """
+        super(SentenceDataset, self).__init__()
+        self.block_size = min(block_size, tokeniser.max_len_single_sentence)
+        self.path = path
+        self.tokeniser = tokeniser
+        if name is None:
+            filename = os.path.splitext(os.path.basename(path))[0]
+            self.name = filename
+        else:
+            self.name = name
+
+        if manual_special:
+            assert (
+                tokeniser.bos_token_id is not None
+                and tokeniser.eos_token_id is not None
+            ), (
+                "tokeniser must have set a bos_token and eos_token "
+                "when using manual_special=True"
+            )
+
+        cache_prefix = None
+        if cache_dir is not None:
+            cache_prefix = cache_file_path(
+                cache_dir,
+                self.name,
+                path,
+                tokeniser,
+                "sentences",
+                self.block_size,
+                use_special,
+                manual_special,
+            )
+
+        # The sentences are concatenated in a flat tensor and the offsets mark the
+        # start of each sentence, with an extra entry marking the end of the last one.
+        self.tokens: torch.Tensor
+        self.offsets: torch.Tensor
+        if cache_prefix is not None and os.path.exists(
+            "{}.tokens.npy".format(cache_prefix)
+        ):
+            self.tokens = torch.from_numpy(
+                np.load("{}.tokens.npy".format(cache_prefix), mmap_mode="c")
+            )
+            self.offsets = torch.from_numpy(
+                np.load("{}.offsets.npy".format(cache_prefix), mmap_mode="c")
+            )
+        else:
+            sentences = []
+            for encoded in encode_file(
+                path,
+                tokeniser,
+                batch_encoding=batch_encoding,
+                fast_tokeniser=fast_tokeniser,
+                num_workers=num_workers,
+            ):
+                if len(encoded) == 0:
+                    continue
+                encoded = encoded[: self.block_size]
+                if use_special:
+                    encoded = (
+                        [tokeniser.bos_token_id] + encoded + [tokeniser.eos_token_id]
+                        if manual_special
+                        else tokeniser.build_inputs_with_special_tokens(encoded)
+                    )
+                sentences.append(np.array(encoded, dtype=np.int32))
+            offsets = np.zeros(len(sentences) + 1, dtype=np.int64)
+            np.cumsum([len(sentence) for sentence in sentences], out=offsets[1:])
+            tokens = (
+                np.concatenate(sentences)
+                if len(sentences) > 0
+                else np.zeros(0, dtype=np.int32)
+            )
+            if cache_prefix is not None:
+                os.makedirs(cache_dir, exist_ok=True)
+                # The tokens are written last, as their existence marks a complete
+                # cache entry.
+                save_array_atomic("{}.offsets.npy".format(cache_prefix), offsets)
+                save_array_atomic("{}.tokens.npy".format(cache_prefix), tokens)
+            self.tokens = torch.from_numpy(tokens).share_memory_()
+            self.offsets = torch.from_numpy(offsets).share_memory_()
+        self.lengths = (self.offsets[1:] - self.offsets[:-1]).tolist()
+
+    def __len__(self) -> int:
+        return len(self.lengths)
 
     def __getitem__(self, i: int) -> torch.Tensor:
-        return torch.tensor(self.text_blocks[i])
+        return self.tokens[self.offsets[i] : self.offsets[i + 1]]
+
+
+class SlidingWindowDataset(Dataset):
+    """
+    Dataset of overlapping windows over the whole text, for the evaluation of causal
+    language models. Each window predicts the tokens following the previous window,
+    given the preceding tokens of the text as context, such that every token (except
+    the very first one) is predicted exactly once, with at least block_size - stride
+    tokens of context.
+
+    Each sample consists of the context, whose keys and values only need to be
+    computed by the transformer, the inputs for the predicted tokens and their labels.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        tokeniser: PreTrainedTokenizer,
+        stride: int = 256,
+        manual_special: bool = False,
+        block_size: int = 512,
+        name: Optional[str] = None,
+        cache_dir: Optional[str] = None,
+        batch_encoding: bool = False,
+        fast_tokeniser: Optional[PreTrainedTokenizerFast] = None,
+        num_workers: Optional[int] = None,
+    ):
+        """
+        Args:
+            stride (int): Number of tokens that are predicted per window, the
+                rest of the window is the context. Smaller strides give more context
+                at a higher cost. [Default: 256]
+            See TextDataset for the remaining arguments, where block_size is the
+            size of the windows.
+        """
+        super(SlidingWindowDataset, self).__init__()
+        self.block_size = min(block_size, tokeniser.max_len_single_sentence)
+        assert (
+            0 < stride <= self.block_size
+        ), "stride must be between 1 and the block size ({})".format(self.block_size)
+        self.stride = stride
+        self.path = path
+        self.tokeniser = tokeniser
+        if name is None:
+            filename = os.path.splitext(os.path.basename(path))[0]
+            self.name = filename
+        else:
+            self.name = name
+
+        cache_path = None
+        if cache_dir is not None:
+            cache_path = "{}.stream.npy".format(
+                cache_file_path(
+                    cache_dir, self.name, path, tokeniser, "stream", manual_special
+                )
+            )
+
+        # The whole text as a single stream of tokens, in which the windows are views.
+        self.tokens: torch.Tensor
+        if cache_path is not None and os.path.exists(cache_path):
+            self.tokens = torch.from_numpy(np.load(cache_path, mmap_mode="c"))
+        else:
+            tokens = np.array(
+                TextDataset.tokenise(
+                    path,
+                    tokeniser,
+                    manual_special,
+                    batch_encoding=batch_encoding,
+                    fast_tokeniser=fast_tokeniser,
+                    num_workers=num_workers,
+                ),
+                dtype=np.int32,
+            )
+            if cache_path is not None:
+                os.makedirs(cache_dir, exist_ok=True)
+                save_array_atomic(cache_path, tokens)
+            self.tokens = torch.from_numpy(tokens).share_memory_()
+        self.windows = self.create_windows(
+            self.tokens.size(0), self.block_size, self.stride
+        )
+
+    @staticmethod
+    def create_windows(
+        num_tokens: int, block_size: int, stride: int
+    ) -> List[Tuple[int, int, int]]:
+        """
+        Creates the windows over the text, where the first window predicts a whole
+        block and each following one the next stride tokens.
+
+        Returns:
+            windows (List[Tuple[int, int, int]]): Start of the context, start and end
+                of the predicted tokens of each window.
+        """
+        windows = []
+        # The first token cannot be predicted, as there is nothing before it.
+        start = 1
+        end = min(block_size + 1, num_tokens)
+        while start < end:
+            # The inputs are shifted by one token, as they predict the next token.
+            context_start = max(end - 1 - block_size, 0)
+            windows.append((context_start, start, end))
+            start = end
+            end = min(end + stride, num_tokens)
+        return windows
+
+    def batches(
+        self, batch_size: int, rank: int = 0, num_replicas: int = 1
+    ) -> List[List[int]]:
+        """
+        Groups consecutive windows of the same shape into batches, which are
+        distributed amongst the processes. Apart from the first and the last window,
+        all windows have the same shape.
+        """
+        batches: List[List[int]] = []
+        batch_shape = None
+        for i in range(len(self.windows)):
+            shape = self.window_shape(i)
+            if (
+                len(batches) == 0
+                or shape != batch_shape
+                or len(batches[-1]) >= batch_size
+            ):
+                batches.append([])
+                batch_shape = shape
+            batches[-1].append(i)
+        return batches[rank::num_replicas]
+
+    def window_shape(self, i: int) -> Tuple[int, int]:
+        context_start, start, end = self.windows[i]
+        return start - 1 - context_start, end - start
+
+    def __len__(self) -> int:
+        return len(self.windows)
+
+    def __getitem__(self, i: int) -> Dict[str, torch.Tensor]:
+        context_start, start, end = self.windows[i]
+        return OrderedDict(
+            context=self.tokens[context_start : start - 1],
+            input_ids=self.tokens[start - 1 : end - 1],
+            labels=self.tokens[start:end],
+        )
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Creates batches of sentences with similar lengths, such that the padded batch has
+    at most max_tokens tokens.
+
+    The (optionally shuffled) sentences are split into buckets, which are sorted by
+    length before being cut into batches. The batches are then shuffled again and
+    distributed amongst the processes, where every process gets the same number of
+    batches, unless even is False (e.g. for an exact evaluation without DDP).
+    """
+
+    def __init__(
+        self,
+        lengths: List[int],
+        max_tokens: int,
+        shuffle: bool = True,
+        bucket_size: int = 100000,
+        seed: int = 0,
+        rank: int = 0,
+        num_replicas: int = 1,
+        even: bool = True,
+    ):
+        """
+        Args:
+            lengths (List[int]): Length of each sentence
+            max_tokens (int): Maximum number of tokens in a batch, including the
+                padding. A sentence longer than that is put in a batch on its own.
+            shuffle (bool): Whether to shuffle the sentences and batches
+                [Default: True]
+            bucket_size (int): Number of sentences that are sorted together
+                [Default: 100000]
+            seed (int): Seed for the shuffling, which is combined with the epoch.
+                [Default: 0]
+            rank (int): Rank of the current process in the distributed training.
+                [Default: 0]
+            num_replicas (int): Number of processes in the distributed training.
+                [Default: 1]
+            even (bool): Whether every process gets the same number of batches, by
+                dropping the remaining ones. Otherwise all batches are used.
+                [Default: True]
+        """
+        self.lengths = lengths
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.seed = seed
+        self.rank = rank
+        self.num_replicas = num_replicas
+        self.even = even
+        self.epoch = 0
+        self.start = 0
+        self._batches: Optional[List[List[int]]] = None
+
+    def set_epoch(self, epoch: int):
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self._batches = None
+
+    def skip(self, num_batches: int):
+        """
+        Skips the first batches of the next iteration, in order to resume in the middle
+        of an epoch. The length stays the one of the full epoch.
+        """
+        self.start = num_batches
+
+    def create_batches(self) -> List[List[int]]:
+        """
+        Creates the batches of the current process for the current epoch.
+        """
+        if self._batches is not None:
+            return self._batches
+        rng = random.Random("{}-{}".format(self.seed, self.epoch))
+        indices = list(range(len(self.lengths)))
+        if self.shuffle:
+            rng.shuffle(indices)
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = sorted(
+                indices[start : start + self.bucket_size], key=self.lengths.__getitem__
+            )
+            batch: List[int] = []
+            max_len = 0
+            for i in bucket:
+                new_max_len = max(max_len, self.lengths[i])
+                if len(batch) > 0 and new_max_len * (len(batch) + 1) > self.max_tokens:
+                    batches.append(batch)
+                    batch = []
+                    new_max_len = self.lengths[i]
+                batch.append(i)
+                max_len = new_max_len
+            if len(batch) > 0:
+                batches.append(batch)
+        if self.shuffle:
+            rng.shuffle(batches)
+        self._batches = batches[self.rank :: self.num_replicas]
+        if self.even:
+            # Every process needs the same number of batches, otherwise the processes
+            # would wait for each other forever.
+            num_batches = len(batches) // self.num_replicas
+            self._batches = self._batches[:num_batches]
+        return self._batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        start = self.start
+        self.start = 0
+        return iter(self.create_batches()[start:])
+
+    def __len__(self) -> int:
+        return len(self.create_batches())
+
+
+class ResumableDistributedSampler(DistributedSampler):
+    """
+    A DistributedSampler that can skip the first samples of an epoch, in order to resume
+    in the middle of it. The order only depends on the seed and the epoch, hence it is
+    also used for a single process instead of random sampling.
+    """
+
+    def __init__(
+        self,
+        dataset: Dataset,
+        num_replicas: int = 1,
+        rank: int = 0,
+        shuffle: bool = True,
+        seed: int = 0,
+    ):
+        """
+        Args:
+            dataset (Dataset): Dataset to sample from
+            num_replicas (int): Number of processes in the distributed training.
+                [Default: 1]
+            rank (int): Rank of the current process in the distributed training.
+                [Default: 0]
+            shuffle (bool): Whether to shuffle the samples [Default: True]
+            seed (int): Seed for the shuffling, which is combined with the epoch.
+                [Default: 0]
+        """
+        super().__init__(
+            dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle, seed=seed
+        )
+        self.start = 0
+
+    def skip(self, num_samples: int):
+        """
+        Skips the first samples of the next iteration. The length stays the one of the
+        full epoch.
+        """
+        self.start = num_samples
+
+    def __iter__(self) -> Iterator[int]:
+        start = self.start
+        self.start = 0
+        return iter(list(super().__iter__())[start:])
+
+
+class ShardedSampler(Sampler):
+    """
+    Splits the dataset amongst the processes without shuffling and, unlike the
+    DistributedSampler, without repeating any samples to make the shards even. Every
+    sample is used exactly once, which is needed for an exact evaluation.
+    """
+
+    def __init__(self, dataset: Dataset, num_replicas: int = 1, rank: int = 0):
+        """
+        Args:
+            dataset (Dataset): Dataset to sample from
+            num_replicas (int): Number of processes in the distributed evaluation.
+                [Default: 1]
+            rank (int): Rank of the current process in the distributed evaluation.
+                [Default: 0]
+        """
+        self.dataset = dataset
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.indices = range(rank, len(dataset), num_replicas)  # type: ignore
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.indices)
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+
+class SentenceCollate:
+    """
+    Pads a list of sentences to the longest one, creating the attention mask and the
+    labels, where the padding is ignored.
+    """
+
+    def __init__(
+        self,
+        pad_token_id: Optional[int] = None,
+        ignore_label: int = -100,
+        masker: Optional[TokenMasker] = None,
+    ):
+        """
+        Args:
+            pad_token_id (int, optional): Token used for the padding. Since the padding
+                is masked, it only matters for models that expect a specific token.
+                [Default: 0]
+            ignore_label (int): Label that is ignored by the loss [Default: -100]
+            masker (TokenMasker, optional): Masks the tokens for masked language
+                modelling, which is then done in the DataLoader workers rather than
+                on the device.
+        """
+        self.pad_token_id = 0 if pad_token_id is None else pad_token_id
+        self.ignore_label = ignore_label
+        self.masker = masker
+
+    def __call__(self, sentences: List[torch.Tensor]) -> Dict[str, torch.Tensor]:
+        max_len = max(len(sentence) for sentence in sentences)
+        input_ids = torch.full(
+            (len(sentences), max_len), self.pad_token_id, dtype=torch.long
+        )
+        attention_mask = torch.zeros((len(sentences), max_len), dtype=torch.long)
+        for i, sentence in enumerate(sentences):
+            input_ids[i, : len(sentence)] = sentence
+            attention_mask[i, : len(sentence)] = 1
+        if self.masker is None:
+            labels = input_ids.masked_fill(attention_mask == 0, self.ignore_label)
+            return OrderedDict(
+                input_ids=input_ids, attention_mask=attention_mask, labels=labels
+            )
+        input_ids, labels = self.masker(input_ids)
+        labels = labels.masked_fill(attention_mask == 0, self.ignore_label)
+        return OrderedDict(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            labels=labels,
+            masked=True,
+        )
+
+
+class BlockCollate:
+    """
+    Stacks blocks of text into a batch and masks them for masked language modelling,
+    so that the masking is done in the DataLoader workers rather than on the device.
+    """
+
+    def __init__(self, masker: TokenMasker):
+        """
+        Args:
+            masker (TokenMasker): Masks the tokens of the blocks
+        """
+        self.masker = masker
+
+    def __call__(
+        self, blocks: List[Union[torch.Tensor, Dict[str, torch.Tensor]]]
+    ) -> Dict[str, torch.Tensor]:
+        word_starts = None
+        if isinstance(blocks[0], dict):
+            word_starts = torch.stack([block["word_starts"] for block in blocks])
+            blocks = [block["input_ids"] for block in blocks]
+        input_ids, labels = self.masker(
+            torch.stack(blocks).long(), word_starts=word_starts  # type: ignore
+        )
+        return OrderedDict(input_ids=input_ids, labels=labels, masked=True)
+
+
+def sentence_data_loader(
+    dataset: SentenceDataset,
+    max_tokens: int,
+    num_workers: int = 0,
+    shuffle: bool = True,
+    seed: int = 0,
+    rank: int = 0,
+    num_replicas: int = 1,
+    even: bool = True,
+    masker: Optional[TokenMasker] = None,
+) -> DataLoader:
+    """
+    Creates a DataLoader that batches sentences of similar lengths, up to the maximum
+    number of tokens per batch. See BucketBatchSampler for the arguments. If a masker
+    is given, the batches are masked in the workers (see SentenceCollate).
+    """
+    batch_sampler = BucketBatchSampler(
+        dataset.lengths,
+        max_tokens=max_tokens,
+        shuffle=shuffle,
+        seed=seed,
+        rank=rank,
+        num_replicas=num_replicas,
+        even=even,
+    )
+    return DataLoader(
+        dataset,
+        batch_sampler=batch_sampler,
+        num_workers=num_workers,
+        collate_fn=SentenceCollate(dataset.tokeniser.pad_token_id, masker=masker),
+        pin_memory=True,
+    )
+
+
+def prepare_batch(
+    batch: Union[torch.Tensor, Dict[str, torch.Tensor]],
+    tokeniser: PreTrainedTokenizer,
+    device: torch.device,
+    masked_lm: bool = True,
+    ignore_label: int = -100,
+    masker: Optional[TokenMasker] = None,
+) -> Tuple[torch.Tensor, torch.Tensor, Optional[torch.Tensor]]:
+    """
+    Moves a batch onto the device and creates the inputs and labels for the model.
+
+    The batch is either a tensor of blocks of text, a dictionary of blocks with their
+    word boundaries, or a dictionary of padded sentences from the SentenceCollate or
+    of blocks from the BlockCollate, which may have already been masked.
+
+    Returns:
+        inputs (torch.Tensor): Inputs of the model
+        labels (torch.Tensor): Labels for the loss
+        attention_mask (torch.Tensor, optional): Attention mask for padded sentences
+    """
+    if masked_lm and masker is None:
+        masker = TokenMasker(tokeniser, ignore_label=ignore_label)
+    if isinstance(batch, dict):
+        inputs = batch["input_ids"].to(device).long()
+        attention_mask = batch.get("attention_mask")
+        if attention_mask is not None:
+            attention_mask = attention_mask.to(device)
+        # Blocks with word boundaries have no labels yet.
+        labels = batch["labels"].to(device) if "labels" in batch else inputs
+        if masked_lm and not batch.get("masked", False):
+            word_starts = batch.get("word_starts")
+            if word_starts is not None:
+                word_starts = word_starts.to(device)
+            inputs, labels = masker(inputs, word_starts=word_starts)  # type: ignore
+            if attention_mask is not None:
+                labels = labels.masked_fill(attention_mask == 0, ignore_label)
+        return inputs, labels, attention_mask
+    d = batch.to(device).long()
+    inputs, labels = masker(d) if masked_lm else (d, d)  # type: ignore
+    return inputs, labels, None
+
+
+def num_loss_tokens(
+    labels: torch.Tensor, masked_lm: bool = True, ignore_label: int = -100
+) -> torch.Tensor:
+    """
+    Counts the tokens that the loss of the model is averaged over, in order to turn it
+    back into the sum of the negative log-likelihoods. Causal language models predict
+    the next token, so the first label of every sequence is never predicted.
+    """
+    if not masked_lm:
+        labels = labels[:, 1:]
+    return (labels != ignore_label).sum()
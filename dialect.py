@@ -0,0 +1,373 @@
+import argparse
+import math
+import os
+import sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+from checkpoint import load_pretrained
+from dataset import tokeniser_identity
+from score import SentenceScorer, read_sentences
+
+max_tokens = 4096
+chunk_size = 1000
+num_threads = torch.get_num_threads()
+
+# Difference of the weights of a fine-tuned model to the base model, for each weight
+# that differs, as the (quantised) difference and the scale to restore it.
+WeightDelta = Dict[str, Tuple[torch.Tensor, Optional[float]]]
+
+
+def compress_delta(
+    base_state: Dict[str, torch.Tensor],
+    state: Dict[str, torch.Tensor],
+    dtype: str = "float16",
+) -> WeightDelta:
+    """
+    Computes the difference of the weights to the base weights, which is stored with
+    lower precision, since the fine-tuned weights only differ little from the base.
+
+    Args:
+        base_state (Dict[str, torch.Tensor]): Weights of the base model
+        state (Dict[str, torch.Tensor]): Weights of the fine-tuned model
+        dtype (str): Type in which the differences are stored, either float16 or
+            int8, where int8 is quantised with one scale per weight.
+            [Default: float16]
+
+    Returns:
+        delta (WeightDelta): Difference of each weight that is not identical
+    """
+    delta = OrderedDict()
+    for key, base_value in base_state.items():
+        value = state[key].to(base_value.device)
+        if torch.equal(value, base_value):
+            continue
+        diff = value.float() - base_value.float()
+        if dtype == "int8":
+            scale = diff.abs().max().item() / 127
+            delta[key] = (torch.round(diff / scale).to(torch.int8), scale)
+        elif dtype == "float16":
+            delta[key] = (diff.half(), None)
+        else:
+            raise Exception("No delta type available for {}".format(dtype))
+    return delta
+
+
+def to_host(tensor: torch.Tensor, pin: bool = False) -> torch.Tensor:
+    """
+    Copies the tensor to the CPU, in pinned memory if it is copied to a GPU later,
+    which makes these copies faster.
+    """
+    tensor = tensor.detach().to("cpu", copy=True)
+    return tensor.pin_memory() if pin else tensor
+
+
+@torch.no_grad()
+def apply_delta(
+    model: torch.nn.Module, base_state: Dict[str, torch.Tensor], delta: WeightDelta
+):
+    """
+    Sets the weights of the model to the base weights plus the difference. The base
+    weights and the difference may be on another device (the CPU), and are only
+    copied to the device of the model one weight at a time.
+    """
+    state = model.state_dict()
+    for key, base_value in base_state.items():
+        value = state[key]
+        value.copy_(base_value, non_blocking=True)
+        if key in delta:
+            diff, scale = delta[key]
+            diff = diff.to(value.device, non_blocking=True).float()
+            if scale is not None:
+                diff *= scale
+            value.add_(diff.to(value.dtype))
+
+
+class DialectScorer:
+    """
+    Scores sentences with the language models of multiple dialects, in order to
+    classify them as the dialect whose model gives the lowest perplexity.
+
+    All models are loaded once and must share the same tokeniser, so every sentence
+    is only tokenised and batched once. The models are either distributed over the
+    given devices, where the models of different devices run in parallel and the
+    ones on the same device one after another, or stored as differences to a base
+    model in the memory of the CPU. Then only a single model is on the device, which
+    gets the weights of one dialect at a time.
+    """
+
+    def __init__(
+        self,
+        checkpoints: Dict[str, str],
+        devices: List[torch.device],
+        max_tokens: int = max_tokens,
+        base: Optional[str] = None,
+        delta_dtype: str = "float16",
+    ):
+        """
+        Args:
+            checkpoints (Dict[str, str]): Name of the dialect and path to the
+                checkpoint of its model
+            devices (List[torch.device]): Devices on which the models are run, which
+                are assigned in turns. With a base model, only the first device is
+                used for the single model, whereas the differences are kept on the
+                CPU.
+            max_tokens (int): Maximum number of tokens per batch, including the
+                padding [Default: 4096]
+            base (str, optional): Path to the checkpoint of the base model, from
+                which all models have been fine-tuned. If given, the models are only
+                kept as their difference to the base model.
+            delta_dtype (str): Type of the differences to the base model, either
+                float16 or int8 [Default: float16]
+        """
+        self.names = list(checkpoints.keys())
+        self.base_state: Optional[Dict[str, torch.Tensor]] = None
+        self.deltas: Dict[str, WeightDelta] = OrderedDict()
+        self.scorers: Dict[str, SentenceScorer] = OrderedDict()
+        if base is None:
+            for i, (name, path) in enumerate(checkpoints.items()):
+                self.scorers[name] = SentenceScorer.from_checkpoint(
+                    path, devices[i % len(devices)], max_tokens=max_tokens
+                )
+        else:
+            base_scorer = SentenceScorer.from_checkpoint(
+                base, devices[0], max_tokens=max_tokens
+            )
+            # The base weights and the differences stay on the CPU, so that the
+            # device only holds the single model, regardless of the number of
+            # dialects.
+            pin = devices[0].type == "cuda"
+            self.base_state = OrderedDict(
+                (key, to_host(value, pin=pin))
+                for key, value in base_scorer.model.state_dict().items()
+            )
+            for name, path in checkpoints.items():
+                pretrained = load_pretrained(path)
+                if tokeniser_identity(pretrained["tokeniser"]) != tokeniser_identity(
+                    base_scorer.tokeniser
+                ):
+                    raise Exception(
+                        "Tokeniser of {} differs from the base model".format(path)
+                    )
+                # The model is discarded once its difference has been computed.
+                delta = compress_delta(
+                    self.base_state, pretrained["model"].state_dict(), delta_dtype
+                )
+                self.deltas[name] = OrderedDict(
+                    (key, (to_host(diff, pin=pin), scale))
+                    for key, (diff, scale) in delta.items()
+                )
+                self.scorers[name] = base_scorer
+        identities = {
+            tokeniser_identity(scorer.tokeniser) for scorer in self.scorers.values()
+        }
+        if len(identities) > 1:
+            raise Exception("All dialect models must use the same tokeniser")
+
+    @staticmethod
+    def score_encoded(
+        scorer: SentenceScorer, encoded: List[List[int]], batches: List[List[int]]
+    ) -> List[float]:
+        """
+        Computes the perplexity of the encoded sentences with the given scorer.
+        """
+        perplexities = [math.nan] * len(encoded)
+        for batch in batches:
+            batch_scores = scorer.score_batch([encoded[i] for i in batch])
+            for i, scores in zip(batch, batch_scores):
+                if len(scores) > 0:
+                    perplexities[i] = math.exp(-sum(scores) / len(scores))
+        return perplexities
+
+    def score(self, sentences: List[str]) -> Dict:
+        """
+        Scores the sentences with the model of each dialect.
+
+        Args:
+            sentences (List[str]): Sentences to score
+
+        Returns:
+            result (Dict): Names of the dialects, the dialect with the lowest
+                perplexity for each sentence (None for empty sentences) and the
+                perplexities [Dimension: num_sentences x num_dialects]
+        """
+        first_scorer = self.scorers[self.names[0]]
+        encoded = first_scorer.encode(sentences)
+        batches = first_scorer.create_batches(encoded)
+        if self.base_state is not None:
+            # Only one model exists at a time, which gets the weights of each dialect.
+            columns = []
+            for name in self.names:
+                scorer = self.scorers[name]
+                apply_delta(scorer.model, self.base_state, self.deltas[name])
+                columns.append(self.score_encoded(scorer, encoded, batches))
+        else:
+            # The computations release the GIL, hence the models of different devices
+            # run in parallel. The models on the same device run one after another,
+            # since they would only compete for it, e.g. for the threads of the CPU.
+            names_per_device: Dict[torch.device, List[str]] = OrderedDict()
+            for name in self.names:
+                device = self.scorers[name].device
+                names_per_device.setdefault(device, []).append(name)
+
+            def score_device(names: List[str]) -> List[List[float]]:
+                return [
+                    self.score_encoded(self.scorers[name], encoded, batches)
+                    for name in names
+                ]
+
+            with ThreadPoolExecutor(max_workers=len(names_per_device)) as executor:
+                device_columns = executor.map(score_device, names_per_device.values())
+                columns_per_name = {
+                    name: column
+                    for names, cols in zip(names_per_device.values(), device_columns)
+                    for name, column in zip(names, cols)
+                }
+            columns = [columns_per_name[name] for name in self.names]
+        perplexities = torch.tensor(columns, dtype=torch.double).t()
+        labels = [
+            None if torch.isnan(row).all() else self.names[row.argmin().item()]
+            for row in perplexities
+        ]
+        return OrderedDict(names=self.names, labels=labels, perplexities=perplexities)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-m",
+        "--models",
+        dest="models",
+        nargs="+",
+        metavar="NAME=PATH",
+        required=True,
+        type=str,
+        help="Name of each dialect and the checkpoint of its (causal) language model",
+    )
+    parser.add_argument(
+        "-i",
+        "--input",
+        dest="input",
+        default="-",
+        type=str,
+        help="Path to TSV file of the sentences to classify [Default: - (stdin)]",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        dest="output",
+        default="-",
+        type=str,
+        help=(
+            "Path to the output TSV file with the sentence, the dialect and the "
+            "perplexity of each model [Default: - (stdout)]"
+        ),
+    )
+    parser.add_argument(
+        "-d",
+        "--devices",
+        dest="devices",
+        nargs="+",
+        default=["cpu"],
+        type=str,
+        help=(
+            "Devices on which the models are run, e.g. cuda:0 cuda:1. The models of "
+            "different devices run in parallel, the ones on the same device one "
+            "after another [Default: cpu]"
+        ),
+    )
+    parser.add_argument(
+        "--base",
+        dest="base",
+        type=str,
+        help=(
+            "Checkpoint of the base model that all dialect models have been "
+            "fine-tuned from. The dialect models are then only kept as their "
+            "difference to it in the memory of the CPU, so that the device only holds "
+            "a single model, but they are run one after another"
+        ),
+    )
+    parser.add_argument(
+        "--delta-dtype",
+        dest="delta_dtype",
+        default="float16",
+        choices=["float16", "int8"],
+        help="Type of the differences to the base model [Default: float16]",
+    )
+    parser.add_argument(
+        "--max-tokens",
+        dest="max_tokens",
+        default=max_tokens,
+        type=int,
+        help=(
+            "Maximum number of tokens (including padding) per batch "
+            "[Default: {}]".format(max_tokens)
+        ),
+    )
+    parser.add_argument(
+        "--chunk-size",
+        dest="chunk_size",
+        default=chunk_size,
+        type=int,
+        help=(
+            "Number of sentences that are read and batched together "
+            "[Default: {}]".format(chunk_size)
+        ),
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        dest="num_threads",
+        default=num_threads,
+        type=int,
+        help=(
+            "Number of threads used on the CPU, by one model at a time "
+            "[Default: {}]".format(num_threads)
+        ),
+    )
+    return parser.parse_args()
+
+
+def main():
+    options = parse_args()
+    torch.set_num_threads(options.num_threads)
+    checkpoints = OrderedDict()
+    for model in options.models:
+        name, path = model.split("=", 1)
+        # Expand the ~ to the full path as it won't be done automatically since it's
+        # not at the beginning of the word.
+        checkpoints[name.strip()] = os.path.expanduser(path)
+    scorer = DialectScorer(
+        checkpoints,
+        [torch.device(device) for device in options.devices],
+        max_tokens=options.max_tokens,
+        base=options.base,
+        delta_dtype=options.delta_dtype,
+    )
+    out_fd = (
+        sys.stdout
+        if options.output == "-"
+        else open(options.output, "w", encoding="utf8")
+    )
+    out_fd.write("\t".join(["sentence", "dialect"] + scorer.names))
+    out_fd.write("\n")
+    for sentences in read_sentences(options.input, chunk_size=options.chunk_size):
+        result = scorer.score(sentences)
+        for sentence, label, perplexities in zip(
+            sentences, result["labels"], result["perplexities"].tolist()
+        ):
+            out_fd.write(
+                "\t".join(
+                    [sentence, label or ""] + [str(value) for value in perplexities]
+                )
+            )
+            out_fd.write("\n")
+    if out_fd is not sys.stdout:
+        out_fd.close()
+
+
+if __name__ == "__main__":
+    main()
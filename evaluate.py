@@ -1,34 +1,43 @@
 import argparse
+import csv
 import multiprocessing
 import os
 import time
 from collections import OrderedDict
-from typing import Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
 
 import lavd
 import torch
 import torch.distributed as dist
 import torch.multiprocessing as mp
 import torch.nn as nn
-from torch.nn.parallel import DistributedDataParallel
+import torch.nn.functional as F
 from torch.utils.data import DataLoader
 from torch.utils.data.distributed import DistributedSampler
-from transformers import (
-    BertConfig,
-    BertForMaskedLM,
-    BertTokenizer,
-    GPT2Config,
-    GPT2LMHeadModel,
-    GPT2Tokenizer,
+from transformers import PreTrainedTokenizerFast
+
+from checkpoint import load_pretrained, log_epoch_stats, metrics
+from dataset import (
+    BucketBatchSampler,
+    SentenceDataset,
+    ShardedSampler,
+    SlidingWindowDataset,
+    TextDataset,
+    TokenMasker,
+    num_loss_tokens,
+    prepare_batch,
+    sentence_data_loader,
+    tokeniser_identity,
 )
-
-from checkpoint import load_checkpoint, log_epoch_stats, metrics
-from dataset import TextDataset, mask_tokens
+from kv_cache import compute_past, forward_with_past
 
 batch_size = 1
 num_workers = multiprocessing.cpu_count()
 num_gpus = torch.cuda.device_count()
 seed = 1234
+max_tokens = 4096
+block_size = 512
 
 
 def evaluate(
@@ -45,56 +54,114 @@ def evaluate(
 
     sampler = (
         data_loader.sampler  # type: ignore
-        if isinstance(data_loader.sampler, DistributedSampler)  # type: ignore
+        if isinstance(data_loader.sampler, (DistributedSampler, ShardedSampler))
         else None
     )
-
-    losses = []
+    batch_sampler = (
+        data_loader.batch_sampler
+        if isinstance(data_loader.batch_sampler, BucketBatchSampler)
+        else None
+    )
+    num_replicas = 1
+    if sampler is not None:
+        num_replicas = sampler.num_replicas  # type: ignore
+    elif batch_sampler is not None:
+        num_replicas = batch_sampler.num_replicas
+
+    # The loss of each batch is the mean over its tokens, which is turned back into the
+    # sum of the negative log-likelihoods, so that the result is the exact mean over all
+    # tokens, regardless of the batch size and the number of processes.
+    nll_sum = torch.zeros((), dtype=torch.double, device=device)
+    num_tokens = torch.zeros((), dtype=torch.double, device=device)
     pbar = logger.progress_bar(
         name, total=len(data_loader.dataset), leave=False, dynamic_ncols=True
     )
     tokeniser = data_loader.dataset.tokeniser  # type: ignore
+    masker = TokenMasker(tokeniser) if masked_lm else None
     for d in data_loader:
-        d = d.to(device)
-        inputs, labels = mask_tokens(d, tokeniser) if masked_lm else (d, d)
+        inputs, labels, attention_mask = prepare_batch(
+            d, tokeniser, device, masked_lm=masked_lm, masker=masker
+        )
         # The last batch may not be a full batch
         curr_batch_size = inputs.size(0)
 
         output = (
-            model(inputs, masked_lm_labels=labels)
+            model(inputs, attention_mask=attention_mask, masked_lm_labels=labels)
             if masked_lm
-            else model(inputs, labels=labels)
+            else model(inputs, attention_mask=attention_mask, labels=labels)
         )
         loss = output[0]
-        losses.append(loss.item())
-
-        pbar.update(
-            curr_batch_size
-            if sampler is None
-            else curr_batch_size * sampler.num_replicas  # type: ignore
+        batch_tokens = num_loss_tokens(labels, masked_lm=masked_lm)
+        # A batch without any tokens to predict has a NaN loss, which is ignored.
+        nll_sum += torch.where(
+            batch_tokens > 0, loss.double() * batch_tokens, nll_sum.new_zeros(())
         )
+        num_tokens += batch_tokens
+
+        pbar.update(curr_batch_size * num_replicas)
 
     pbar.close()
 
-    loss = torch.mean(torch.tensor(losses, device=device))
+    # Sum the negative log-likelihoods and tokens of all processes.
+    if num_replicas > 1:
+        totals = torch.stack([nll_sum, num_tokens])
+        dist.all_reduce(totals)
+        nll_sum, num_tokens = totals[0], totals[1]
+    loss = nll_sum / num_tokens
+    perplexity = torch.exp(loss)
+    return OrderedDict(
+        loss=loss.item(), perplexity=perplexity.item(), tokens=int(num_tokens.item())
+    )
 
-    print("**** sum of losses ****")
-    print(sum(losses))
-    print(len(losses))
-    print("***********************")
 
-    # Gather the loss onto the primary process to have accurate metrics.
-    if sampler is not None:
-        gathered_losses = [
-            torch.zeros_like(loss) for _ in range(sampler.num_replicas)  # type: ignore
-        ]
-        dist.all_gather(gathered_losses, loss)
-        print("**** sum of gathered losses ****")
-        print(sum(gathered_losses))
-        print("********************************")
-        loss = torch.mean(torch.tensor(gathered_losses))
+def evaluate_sliding(
+    data_loader: DataLoader,
+    model: nn.Module,
+    device: torch.device,
+    logger: lavd.Logger,
+    name: str = "",
+    num_replicas: int = 1,
+) -> Dict:
+    """
+    Evaluates a causal language model on the overlapping windows of a
+    SlidingWindowDataset, where only the new tokens of each window are predicted.
+    The keys and values of the context are computed by the transformer without the
+    language modelling head, and only the new tokens are predicted from them.
+    """
+    torch.set_grad_enabled(False)
+    model.eval()
+
+    nll_sum = torch.zeros((), dtype=torch.double, device=device)
+    num_tokens = torch.zeros((), dtype=torch.double, device=device)
+    pbar = logger.progress_bar(
+        name, total=len(data_loader.dataset), leave=False, dynamic_ncols=True
+    )
+    for d in data_loader:
+        context = d["context"].to(device).long()
+        inputs = d["input_ids"].to(device).long()
+        labels = d["labels"].to(device).long()
+        # The first window has no context.
+        past = compute_past(model, context) if context.size(1) > 0 else None
+        logits, _ = forward_with_past(model, inputs, past=past)
+        nll_sum += F.cross_entropy(
+            logits.float().view(-1, logits.size(-1)), labels.view(-1), reduction="sum"
+        ).double()
+        num_tokens += labels.numel()
+
+        pbar.update(inputs.size(0) * num_replicas)
+
+    pbar.close()
+
+    # Sum the negative log-likelihoods and tokens of all processes.
+    if num_replicas > 1:
+        totals = torch.stack([nll_sum, num_tokens])
+        dist.all_reduce(totals)
+        nll_sum, num_tokens = totals[0], totals[1]
+    loss = nll_sum / num_tokens
     perplexity = torch.exp(loss)
-    return OrderedDict(loss=loss.item(), perplexity=perplexity.item())
+    return OrderedDict(
+        loss=loss.item(), perplexity=perplexity.item(), tokens=int(num_tokens.item())
+    )
 
 
 def parse_args() -> argparse.Namespace:
@@ -121,6 +188,16 @@ def parse_args() -> argparse.Namespace:
         type=str,
         help="Paths to the checkpoints to be evaluated",
     )
+    parser.add_argument(
+        "-o",
+        "--output",
+        dest="output",
+        type=str,
+        help=(
+            "Path to a CSV file to write the loss and perplexity of every checkpoint "
+            "on every dataset"
+        ),
+    )
     parser.add_argument(
         "-b",
         "--batch-size",
@@ -159,6 +236,65 @@ def parse_args() -> argparse.Namespace:
         type=int,
         help="Seed for random initialisation [Default: {}]".format(seed),
     )
+    parser.add_argument(
+        "--cache-dir",
+        dest="cache_dir",
+        type=str,
+        help=(
+            "Directory to cache the tokenised datasets, which are reused by "
+            "subsequent runs and shared amongst the processes"
+        ),
+    )
+    parser.add_argument(
+        "--batch-encoding",
+        dest="batch_encoding",
+        action="store_true",
+        help=(
+            "Encode the datasets in batches with the fast tokeniser, or with a pool "
+            "of processes if no fast tokeniser is available"
+        ),
+    )
+    parser.add_argument(
+        "--dataset-mode",
+        dest="dataset_mode",
+        default="blocks",
+        choices=["blocks", "sentences"],
+        help=(
+            "How the text is split into samples, either concatenated and split into "
+            "blocks of fixed size, or kept as separate sentences that are batched by "
+            "length [Default: blocks]"
+        ),
+    )
+    parser.add_argument(
+        "--max-tokens",
+        dest="max_tokens",
+        default=max_tokens,
+        type=int,
+        help=(
+            "Maximum number of tokens (including padding) per batch per GPU, "
+            "only used with --dataset-mode sentences [Default: {}]".format(max_tokens)
+        ),
+    )
+    parser.add_argument(
+        "--block-size",
+        dest="block_size",
+        default=block_size,
+        type=int,
+        help=(
+            "Size of the blocks of text, or of the windows with --stride "
+            "[Default: {}]".format(block_size)
+        ),
+    )
+    parser.add_argument(
+        "--stride",
+        dest="stride",
+        type=int,
+        help=(
+            "Evaluate the causal language models on overlapping windows over the "
+            "whole text, where each window predicts the next STRIDE tokens given the "
+            "rest of the window as context, instead of on separate blocks"
+        ),
+    )
     return parser.parse_args()
 
 
@@ -187,130 +323,269 @@ def main():
         run(0, options)
 
 
-def run(gpu_id, options, distributed=False):
-    if distributed:
-        dist.init_process_group(
-            backend="nccl",
-            rank=gpu_id,
-            world_size=options.num_gpus,
-            init_method="env://",
-        )
-        torch.cuda.set_device(gpu_id)
-    use_cuda = torch.cuda.is_available() and not options.no_cuda
-    device = torch.device("cuda" if use_cuda else "cpu")
-    for cp in options.checkpoint:
-        checkpoint = load_checkpoint(os.path.join(cp, "stats.pt"))
-        name = "evaluate/{}".format(cp)
-        logger = lavd.Logger(name, disabled=gpu_id != 0)
-
-        spinner = logger.spinner("Initialising")
-        spinner.start()
-
-        # All but the primary GPU wait here, so that only the primary process loads the
-        # pre-trained model and the rest uses the cached version.
-        if distributed and gpu_id != 0:
-            torch.distributed.barrier()
-
-        model_kind = checkpoint["model"].get("kind")
-        use_special = True
-        masked_lm = True
-        add_space = False
-        if model_kind == "bert" or model_kind == "bert-scratch":
-            config = BertConfig.from_pretrained(cp)
-            model = BertForMaskedLM.from_pretrained(cp, config=config)
-            tokeniser = BertTokenizer.from_pretrained(cp)
-        elif model_kind == "gpt2" or model_kind == "gpt2-scratch":
-            config = GPT2Config.from_pretrained(cp)
-            model = GPT2LMHeadModel.from_pretrained(cp, config=config)
-            tokeniser = GPT2Tokenizer.from_pretrained(cp)
-            masked_lm = False
-            use_special = False
-            add_space = True
+def create_data_loaders(
+    options: argparse.Namespace,
+    pretrained: Dict,
+    fast_tokeniser: Optional[PreTrainedTokenizerFast],
+    gpu_id: int = 0,
+    distributed: bool = False,
+) -> List[DataLoader]:
+    """
+    Creates the data loaders of all datasets for the tokeniser of the given
+    checkpoint (see load_pretrained).
+    """
+    tokeniser = pretrained["tokeniser"]
+    num_replicas = options.num_gpus if distributed else 1
+    data_loaders = []
+    for data_file in options.datasets:
+        data = data_file.split("=", 1)
+        if len(data) > 1:
+            # Remove whitespace around the name
+            name = data[0].strip()
+            # Expand the ~ to the full path as it won't be done automatically since
+            # it's not at the beginning of the word.
+            file_path = os.path.expanduser(data[1])
         else:
-            raise Exception("No model available for {}".format(model_kind))
-        model = model.to(device)
-
-        # Primary process has loaded the model and the other can now load the cached
-        # version.
-        if distributed and gpu_id == 0:
-            torch.distributed.barrier()
-
-        data_loaders = []
-        for data_file in options.datasets:
-            data = data_file.split("=", 1)
-            if len(data) > 1:
-                # Remove whitespace around the name
-                name = data[0].strip()
-                # Expand the ~ to the full path as it won't be done automatically since
-                # it's not at the beginning of the word.
-                file_path = os.path.expanduser(data[1])
-            else:
-                name = None
-                file_path = data[0]
-            dataset = TextDataset(
+            name = None
+            file_path = data[0]
+        dataset_options = dict(
+            name=name,
+            use_special=pretrained["use_special"],
+            manual_special=pretrained["manual_special"],
+            block_size=options.block_size,
+            cache_dir=options.cache_dir,
+            batch_encoding=options.batch_encoding,
+            fast_tokeniser=fast_tokeniser,
+            num_workers=options.num_workers,
+        )
+        if options.stride is not None:
+            dataset = SlidingWindowDataset(
                 file_path,
                 tokeniser,
+                stride=options.stride,
+                manual_special=pretrained["manual_special"],
+                block_size=options.block_size,
                 name=name,
-                use_special=use_special
+                cache_dir=options.cache_dir,
+                batch_encoding=options.batch_encoding,
+                fast_tokeniser=fast_tokeniser,
+                num_workers=options.num_workers,
             )
-            sampler = (
-                DistributedSampler(
-                    dataset, num_replicas=options.num_gpus, rank=gpu_id, shuffle=False
-                )
-                if distributed
-                else None
+            # Batches of windows with the same shape, which are split amongst the
+            # processes.
+            data_loader = DataLoader(
+                dataset,
+                batch_sampler=dataset.batches(
+                    options.batch_size, rank=gpu_id, num_replicas=num_replicas
+                ),
+                num_workers=options.num_workers,
+                pin_memory=True,
             )
+        elif options.dataset_mode == "sentences":
+            dataset = SentenceDataset(file_path, tokeniser, **dataset_options)
+            data_loader = sentence_data_loader(
+                dataset,
+                max_tokens=options.max_tokens,
+                num_workers=options.num_workers,
+                shuffle=False,
+                rank=gpu_id,
+                num_replicas=num_replicas,
+                even=False,
+            )
+        else:
+            dataset = TextDataset(file_path, tokeniser, **dataset_options)
+            # Every block is evaluated exactly once, unlike with the
+            # DistributedSampler, which repeats some to even out the shards.
+            sampler = ShardedSampler(dataset, num_replicas=num_replicas, rank=gpu_id)
             data_loader = DataLoader(
                 dataset,
                 batch_size=options.batch_size,
-                shuffle=False,
                 num_workers=options.num_workers,
                 sampler=sampler,
                 pin_memory=True,
             )
-            data_loaders.append(data_loader)
+        data_loaders.append(data_loader)
+    return data_loaders
 
-        if distributed:
-            model = DistributedDataParallel(
-                model, device_ids=[gpu_id], find_unused_parameters=True
-            )
 
-        # Wait for all processes to load eveything before starting training.
-        # Not strictly necessary, since they will wait once the actual model is run, but
-        # this makes it nicer to show the spinner until all of them are ready.
-        if distributed:
-            torch.distributed.barrier()
-        spinner.stop()
-
-        start_time = time.time()
-        logger.set_prefix("Evaluation - {}".format(cp))
-        results = []
-        for data_loader in data_loaders:
-            data_name = data_loader.dataset.name
-            logger.start(data_name)
-            result = evaluate(
-                data_loader,
-                model,
-                device=device,
-                name=data_name,
-                logger=logger,
-                masked_lm=masked_lm,
+def write_results(path: str, results: List[Dict]):
+    """
+    Writes the results of all checkpoints and datasets to a CSV file.
+    """
+    with open(path, "w", encoding="utf8", newline="") as fd:
+        writer = csv.DictWriter(
+            fd, fieldnames=["checkpoint", "dataset", "loss", "perplexity", "tokens"]
+        )
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def log_summary(logger: lavd.Logger, checkpoints: List[str], results: List[Dict]):
+    """
+    Prints the perplexity of each checkpoint on each dataset, followed by the best
+    checkpoint of each dataset.
+    """
+    dataset_names = list(OrderedDict.fromkeys(result["dataset"] for result in results))
+    perplexities = {
+        (result["checkpoint"], result["dataset"]): result["perplexity"]
+        for result in results
+    }
+    logger.set_prefix("Summary")
+    logger.println("Perplexity of each checkpoint:")
+    logger.print_table(
+        ["Checkpoint"] + dataset_names,
+        [
+            [cp] + [perplexities.get((cp, data_name)) for data_name in dataset_names]
+            for cp in checkpoints
+        ],
+        indent_level=1,
+    )
+    for data_name in dataset_names:
+        best = min(
+            (result for result in results if result["dataset"] == data_name),
+            key=lambda result: result["perplexity"],
+        )
+        logger.println(
+            "Best checkpoint for {name}: {checkpoint} (perplexity {perplexity:.5f})",
+            name=data_name,
+            checkpoint=best["checkpoint"],
+            perplexity=best["perplexity"],
+        )
+
+
+def run(gpu_id, options, distributed=False):
+    if distributed:
+        dist.init_process_group(
+            backend="nccl",
+            rank=gpu_id,
+            world_size=options.num_gpus,
+            init_method="env://",
+        )
+        torch.cuda.set_device(gpu_id)
+    use_cuda = torch.cuda.is_available() and not options.no_cuda
+    device = torch.device("cuda" if use_cuda else "cpu")
+    # The datasets only depend on how the text is tokenised, hence they are created
+    # once for each distinct tokeniser and reused by all checkpoints that share it.
+    data_loaders_by_tokeniser: Dict[Tuple[str, bool, bool], List[DataLoader]] = {}
+    results = []
+    logger = None
+    # The next checkpoint is loaded in the background while the current one is being
+    # evaluated.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_pretrained = executor.submit(load_pretrained, options.checkpoint[0])
+        for i, cp in enumerate(options.checkpoint):
+            name = "evaluate/{}".format(cp)
+            logger = lavd.Logger(name, disabled=gpu_id != 0)
+
+            spinner = logger.spinner("Initialising")
+            spinner.start()
+
+            pretrained = next_pretrained.result()
+            if i + 1 < len(options.checkpoint):
+                next_pretrained = executor.submit(
+                    load_pretrained, options.checkpoint[i + 1]
+                )
+            masked_lm = pretrained["masked_lm"]
+            if options.stride is not None and masked_lm:
+                raise Exception(
+                    "--stride is only available for causal language models, "
+                    "not for {}".format(pretrained["kind"])
+                )
+            model = pretrained["model"].to(device)
+
+            tokeniser_key = (
+                tokeniser_identity(pretrained["tokeniser"]),
+                pretrained["use_special"],
+                pretrained["manual_special"],
             )
-            result["name"] = data_name
-            results.append(result)
-            logger.end(data_name)
-
-        time_difference = time.time() - start_time
-        evaluation_results = [
-            OrderedDict(
-                name=result["name"],
-                stats=OrderedDict(loss=result["loss"], perplexity=result["perplexity"]),
+            data_loaders = data_loaders_by_tokeniser.get(tokeniser_key)
+            if data_loaders is None:
+                fast_tokeniser_class = pretrained["fast_tokeniser_class"]
+                fast_tokeniser = (
+                    fast_tokeniser_class.from_pretrained(cp)
+                    if options.batch_encoding and fast_tokeniser_class is not None
+                    else None
+                )
+                # When caching the datasets, only the primary process tokenises them
+                # and the rest waits to load the cached version.
+                if distributed and options.cache_dir is not None and gpu_id != 0:
+                    torch.distributed.barrier()
+                data_loaders = create_data_loaders(
+                    options,
+                    pretrained,
+                    fast_tokeniser,
+                    gpu_id=gpu_id,
+                    distributed=distributed,
+                )
+                data_loaders_by_tokeniser[tokeniser_key] = data_loaders
+                # Primary process has created the cached datasets and the others can
+                # now load them.
+                if distributed and options.cache_dir is not None and gpu_id == 0:
+                    torch.distributed.barrier()
+
+            # Wait for all processes to load eveything before starting the evaluation.
+            # Not strictly necessary, since they will wait once the actual model is
+            # run, but this makes it nicer to show the spinner until all of them are
+            # ready.
+            if distributed:
+                torch.distributed.barrier()
+            spinner.stop()
+
+            start_time = time.time()
+            logger.set_prefix("Evaluation - {}".format(cp))
+            evaluation_results = []
+            for data_loader in data_loaders:
+                data_name = data_loader.dataset.name
+                logger.start(data_name)
+                result = (
+                    evaluate_sliding(
+                        data_loader,
+                        model,
+                        device=device,
+                        name=data_name,
+                        logger=logger,
+                        num_replicas=options.num_gpus if distributed else 1,
+                    )
+                    if options.stride is not None
+                    else evaluate(
+                        data_loader,
+                        model,
+                        device=device,
+                        name=data_name,
+                        logger=logger,
+                        masked_lm=masked_lm,
+                    )
+                )
+                evaluation_results.append(
+                    OrderedDict(
+                        name=data_name,
+                        stats=OrderedDict(
+                            loss=result["loss"], perplexity=result["perplexity"]
+                        ),
+                    )
+                )
+                results.append(
+                    OrderedDict(
+                        checkpoint=cp,
+                        dataset=data_name,
+                        loss=result["loss"],
+                        perplexity=result["perplexity"],
+                        tokens=result["tokens"],
+                    )
+                )
+                logger.end(data_name)
+
+            time_difference = time.time() - start_time
+            log_epoch_stats(
+                logger, evaluation_results, metrics, time_elapsed=time_difference
             )
-            for result in results
-        ]
-        log_epoch_stats(
-            logger, evaluation_results, metrics, time_elapsed=time_difference
-        )
+            # Free the memory of the model before the next one is moved to the device.
+            del model, pretrained
+
+    if logger is not None and len(options.checkpoint) > 1:
+        log_summary(logger, options.checkpoint, results)
+    if options.output is not None and gpu_id == 0:
+        write_results(options.output, results)
 
 
 if __name__ == "__main__":
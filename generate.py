@@ -0,0 +1,560 @@
+import argparse
+import sys
+import time
+from typing import Iterator, List, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+from transformers import PreTrainedModel, PreTrainedTokenizer
+
+from checkpoint import load_pretrained
+from kv_cache import forward_with_past, reorder_past
+from score import read_sentences
+
+batch_size = 32
+max_length = 64
+temperature = 1.0
+top_k = 0
+top_p = 1.0
+num_beams = 1
+length_penalty = 1.0
+seed = 1234
+num_threads = torch.get_num_threads()
+
+
+def filter_logits(
+    logits: torch.Tensor, top_k: int = top_k, top_p: float = top_p
+) -> torch.Tensor:
+    """
+    Removes the tokens outside of the top k and outside of the smallest set of tokens
+    whose cumulative probability exceeds top p (nucleus), by setting their logits to
+    -inf.
+
+    Args:
+        logits (torch.Tensor): Logits of the next token
+            [Dimension: batch_size x vocab_size]
+        top_k (int): Number of most likely tokens to keep, where 0 keeps all of them
+            [Default: 0]
+        top_p (float): Cumulative probability of the most likely tokens to keep, where
+            1.0 keeps all of them [Default: 1.0]
+
+    Returns:
+        logits (torch.Tensor): Filtered logits [Dimension: batch_size x vocab_size]
+    """
+    if top_k > 0:
+        kth_value = torch.topk(logits, min(top_k, logits.size(-1)), dim=-1)[0][:, -1:]
+        logits = logits.masked_fill(logits < kth_value, float("-inf"))
+    if top_p < 1.0:
+        sorted_logits, sorted_indices = torch.sort(logits, descending=True, dim=-1)
+        cumulative_probs = F.softmax(sorted_logits, dim=-1).cumsum(dim=-1)
+        # A token is removed when the tokens before it already exceed top p, which
+        # always keeps the most likely token.
+        sorted_remove = (cumulative_probs - F.softmax(sorted_logits, dim=-1)) > top_p
+        remove = sorted_remove.scatter(-1, sorted_indices, sorted_remove)
+        logits = logits.masked_fill(remove, float("-inf"))
+    return logits
+
+
+class Generator:
+    """
+    Generates text with a causal language model, continuing a batch of prompts at a
+    time.
+
+    The prompts are padded on the left, so that all of them are continued at the same
+    position, and the keys and values of the previous tokens are cached, so that each
+    step only computes the new token.
+    """
+
+    def __init__(
+        self,
+        model: PreTrainedModel,
+        tokeniser: PreTrainedTokenizer,
+        device: torch.device,
+    ):
+        """
+        Args:
+            model (PreTrainedModel): Causal language model, e.g. GPT2LMHeadModel
+            tokeniser (PreTrainedTokenizer): Tokeniser of the model
+            device (torch.device): Device on which the model is run
+        """
+        self.model = model.to(device)
+        self.model.eval()
+        self.tokeniser = tokeniser
+        self.device = device
+        # Every prompt starts with the start token, so that the generation can also
+        # start without a prompt.
+        self.start_token_id = (
+            tokeniser.bos_token_id
+            if tokeniser.bos_token_id is not None
+            else tokeniser.eos_token_id
+        )
+        self.end_token_id = tokeniser.eos_token_id
+        self.max_len = model.config.n_positions
+
+    @classmethod
+    def from_checkpoint(cls, path: str, device: torch.device) -> "Generator":
+        """
+        Loads the generator from a checkpoint directory.
+        """
+        pretrained = load_pretrained(path)
+        if pretrained["masked_lm"]:
+            raise Exception(
+                "Generating text requires a causal language model, not {}".format(
+                    pretrained["kind"]
+                )
+            )
+        return cls(pretrained["model"], pretrained["tokeniser"], device)
+
+    def encode(
+        self, prompts: List[str], max_length: int = max_length
+    ) -> List[List[int]]:
+        """
+        Encodes the prompts with the start token, keeping only their last tokens if
+        there would not be enough positions left to generate max_length tokens.
+        """
+        max_prompt_len = self.max_len - max_length
+        assert max_prompt_len > 1, "max_length must be less than {}".format(
+            self.max_len - 1
+        )
+        encoded = []
+        for prompt in prompts:
+            enc = self.tokeniser.encode(prompt, add_special_tokens=False)
+            enc = (
+                enc[len(enc) - max_prompt_len + 1 :]
+                if len(enc) >= max_prompt_len
+                else enc
+            )
+            encoded.append([self.start_token_id] + enc)
+        return encoded
+
+    def decode(self, ids: List[int]) -> str:
+        text = self.tokeniser.decode(
+            ids, skip_special_tokens=True, clean_up_tokenization_spaces=False
+        )
+        # Every generated text is written on a single line.
+        return " ".join(text.split())
+
+    def prepare_prompts(
+        self, prompts: List[List[int]]
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Pads the prompts on the left.
+
+        Returns:
+            input_ids (torch.Tensor): Padded prompts [Dimension: batch_size x seq_len]
+            attention_mask (torch.Tensor): Mask of the padding
+                [Dimension: batch_size x seq_len]
+            position_ids (torch.Tensor): Positions of the tokens, which start at 0 after
+                the padding [Dimension: batch_size x seq_len]
+        """
+        prompt_len = max(len(prompt) for prompt in prompts)
+        input_ids = torch.full(
+            (len(prompts), prompt_len),
+            self.start_token_id,
+            dtype=torch.long,
+            device=self.device,
+        )
+        attention_mask = torch.zeros(
+            (len(prompts), prompt_len), dtype=torch.long, device=self.device
+        )
+        for i, prompt in enumerate(prompts):
+            input_ids[i, prompt_len - len(prompt) :] = torch.tensor(
+                prompt, dtype=torch.long
+            )
+            attention_mask[i, prompt_len - len(prompt) :] = 1
+        position_ids = (attention_mask.cumsum(dim=-1) - 1).clamp(min=0)
+        return input_ids, attention_mask, position_ids
+
+    def trim(self, tokens: torch.Tensor) -> List[List[int]]:
+        """
+        Cuts the generated tokens off at the end token.
+        """
+        sequences = []
+        for seq in tokens.tolist():
+            if self.end_token_id in seq:
+                seq = seq[: seq.index(self.end_token_id)]
+            sequences.append(seq)
+        return sequences
+
+    @torch.no_grad()
+    def sample(
+        self,
+        prompts: List[List[int]],
+        max_length: int = max_length,
+        temperature: float = temperature,
+        top_k: int = top_k,
+        top_p: float = top_p,
+    ) -> List[List[int]]:
+        """
+        Continues the encoded prompts by sampling one token after another, until the
+        end token or max_length tokens have been generated.
+
+        Args:
+            prompts (List[List[int]]): Encoded prompts (see encode)
+            max_length (int): Maximum number of tokens to generate [Default: 64]
+            temperature (float): Temperature of the distribution, where 0 always
+                picks the most likely token [Default: 1.0]
+            top_k (int): Only sample from the k most likely tokens, 0 to disable
+                [Default: 0]
+            top_p (float): Only sample from the most likely tokens that have
+                a cumulative probability of p, 1.0 to disable [Default: 1.0]
+
+        Returns:
+            sequences (List[List[int]]): Generated tokens of each prompt
+        """
+        input_ids, attention_mask, position_ids = self.prepare_prompts(prompts)
+        past = None
+        finished = torch.zeros(len(prompts), dtype=torch.bool, device=self.device)
+        generated = []
+        for _ in range(max_length):
+            logits, past = forward_with_past(
+                self.model,
+                input_ids,
+                past=past,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+            )
+            next_logits = logits[:, -1].float()
+            if temperature == 0:
+                next_tokens = next_logits.argmax(dim=-1)
+            else:
+                next_logits = filter_logits(
+                    next_logits / temperature, top_k=top_k, top_p=top_p
+                )
+                next_tokens = torch.multinomial(
+                    F.softmax(next_logits, dim=-1), num_samples=1
+                ).squeeze(1)
+            next_tokens = next_tokens.masked_fill(finished, self.end_token_id)
+            generated.append(next_tokens)
+            finished |= next_tokens == self.end_token_id
+            if finished.all():
+                break
+            input_ids = next_tokens.unsqueeze(1)
+            attention_mask = torch.cat(
+                [attention_mask, attention_mask.new_ones((len(prompts), 1))], dim=1
+            )
+            position_ids = position_ids[:, -1:] + 1
+        return self.trim(torch.stack(generated, dim=1))
+
+    @torch.no_grad()
+    def beam_search(
+        self,
+        prompts: List[List[int]],
+        max_length: int = max_length,
+        num_beams: int = 4,
+        length_penalty: float = length_penalty,
+    ) -> List[List[int]]:
+        """
+        Continues the encoded prompts with the most likely sequences found by a beam
+        search, until all beams have generated the end token or max_length tokens.
+
+        Args:
+            prompts (List[List[int]]): Encoded prompts (see encode)
+            max_length (int): Maximum number of tokens to generate [Default: 64]
+            num_beams (int): Number of beams per prompt [Default: 4]
+            length_penalty (float): Exponent of the length by which the
+                log-probability of the finished sequences is divided, where higher
+                values favour longer sequences [Default: 1.0]
+
+        Returns:
+            sequences (List[List[int]]): Generated tokens of each prompt
+        """
+        batch_size = len(prompts)
+        num_sequences = batch_size * num_beams
+        input_ids, attention_mask, position_ids = self.prepare_prompts(prompts)
+        input_ids = input_ids.repeat_interleave(num_beams, dim=0)
+        attention_mask = attention_mask.repeat_interleave(num_beams, dim=0)
+        position_ids = position_ids.repeat_interleave(num_beams, dim=0)
+        # All beams of a prompt start out identical, hence only the first one is
+        # continued in the first step.
+        beam_scores = torch.full(
+            (batch_size, num_beams), float("-inf"), device=self.device
+        )
+        beam_scores[:, 0] = 0
+        beam_scores = beam_scores.view(-1)
+        lengths = torch.zeros(num_sequences, device=self.device)
+        finished = torch.zeros(num_sequences, dtype=torch.bool, device=self.device)
+        tokens = torch.zeros((num_sequences, 0), dtype=torch.long, device=self.device)
+        offsets = torch.arange(batch_size, device=self.device).unsqueeze(1) * num_beams
+        past = None
+        for _ in range(max_length):
+            logits, past = forward_with_past(
+                self.model,
+                input_ids,
+                past=past,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+            )
+            log_probs = F.log_softmax(logits[:, -1].float(), dim=-1)
+            # Finished beams can only be continued by the end token, which does not
+            # change their score.
+            log_probs[finished] = float("-inf")
+            log_probs[finished, self.end_token_id] = 0
+            vocab_size = log_probs.size(-1)
+            scores = (beam_scores.unsqueeze(1) + log_probs).view(batch_size, -1)
+            beam_scores, candidates = torch.topk(scores, num_beams, dim=-1)
+            beam_scores = beam_scores.view(-1)
+            beam_indices = (
+                torch.div(candidates, vocab_size, rounding_mode="floor") + offsets
+            ).view(-1)
+            next_tokens = (candidates % vocab_size).view(-1)
+
+            tokens = torch.cat([tokens[beam_indices], next_tokens.unsqueeze(1)], dim=1)
+            lengths = lengths[beam_indices] + (~finished[beam_indices]).float()
+            finished = finished[beam_indices] | (next_tokens == self.end_token_id)
+            if finished.all():
+                break
+            past = reorder_past(past, beam_indices)
+            input_ids = next_tokens.unsqueeze(1)
+            attention_mask = torch.cat(
+                [
+                    attention_mask[beam_indices],
+                    attention_mask.new_ones((num_sequences, 1)),
+                ],
+                dim=1,
+            )
+            position_ids = position_ids[beam_indices, -1:] + 1
+        normalised_scores = beam_scores / lengths.clamp(min=1) ** length_penalty
+        best = normalised_scores.view(batch_size, num_beams).argmax(dim=-1)
+        return self.trim(tokens[best + offsets.squeeze(1)])
+
+    def generate(
+        self,
+        prompts: List[str],
+        max_length: int = max_length,
+        temperature: float = temperature,
+        top_k: int = top_k,
+        top_p: float = top_p,
+        num_beams: int = num_beams,
+        length_penalty: float = length_penalty,
+    ) -> List[Tuple[str, int]]:
+        """
+        Continues the prompts with sampling, or with a beam search if there is more
+        than one beam. See sample and beam_search for the arguments.
+
+        Returns:
+            results (List[Tuple[str, int]]): Text of each prompt and its continuation,
+                and the number of generated tokens.
+        """
+        encoded = self.encode(prompts, max_length=max_length)
+        if num_beams > 1:
+            sequences = self.beam_search(
+                encoded,
+                max_length=max_length,
+                num_beams=num_beams,
+                length_penalty=length_penalty,
+            )
+        else:
+            sequences = self.sample(
+                encoded,
+                max_length=max_length,
+                temperature=temperature,
+                top_k=top_k,
+                top_p=top_p,
+            )
+        return [
+            (self.decode(prompt + seq), len(seq))
+            for prompt, seq in zip(encoded, sequences)
+        ]
+
+
+def batch_prompts(
+    input_path: Optional[str], num_samples: int, batch_size: int = batch_size
+) -> Iterator[List[str]]:
+    """
+    Groups the prompts into batches, where each prompt is repeated num_samples times.
+    Without an input, it generates num_samples texts without a prompt.
+    """
+    prompts = (
+        (prompt for chunk in read_sentences(input_path) for prompt in chunk)
+        if input_path is not None
+        else iter([""])
+    )
+    batch = []
+    for prompt in prompts:
+        for _ in range(num_samples):
+            batch.append(prompt)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-c",
+        "--checkpoint",
+        dest="checkpoint",
+        required=True,
+        type=str,
+        help="Path to the checkpoint of the (causal) language model",
+    )
+    parser.add_argument(
+        "-i",
+        "--input",
+        dest="input",
+        type=str,
+        help=(
+            "Path to TSV file of the prompts, - for stdin. If not given, the texts "
+            "are generated without a prompt."
+        ),
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        dest="output",
+        default="-",
+        type=str,
+        help=(
+            "Path to the output file, with one generated text per line "
+            "[Default: - (stdout)]"
+        ),
+    )
+    parser.add_argument(
+        "-n",
+        "--num-samples",
+        dest="num_samples",
+        default=1,
+        type=int,
+        help="Number of texts to generate per prompt [Default: 1]",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch-size",
+        dest="batch_size",
+        default=batch_size,
+        type=int,
+        help="Number of texts generated together [Default: {}]".format(batch_size),
+    )
+    parser.add_argument(
+        "-l",
+        "--max-length",
+        dest="max_length",
+        default=max_length,
+        type=int,
+        help="Maximum number of tokens to generate [Default: {}]".format(max_length),
+    )
+    parser.add_argument(
+        "--temperature",
+        dest="temperature",
+        default=temperature,
+        type=float,
+        help=(
+            "Temperature of the sampling, where 0 always picks the most likely token "
+            "[Default: {}]".format(temperature)
+        ),
+    )
+    parser.add_argument(
+        "--top-k",
+        dest="top_k",
+        default=top_k,
+        type=int,
+        help=(
+            "Sample only from the k most likely tokens, 0 to disable "
+            "[Default: {}]".format(top_k)
+        ),
+    )
+    parser.add_argument(
+        "--top-p",
+        dest="top_p",
+        default=top_p,
+        type=float,
+        help=(
+            "Sample only from the most likely tokens with a cumulative probability "
+            "of p (nucleus sampling), 1.0 to disable [Default: {}]".format(top_p)
+        ),
+    )
+    parser.add_argument(
+        "--num-beams",
+        dest="num_beams",
+        default=num_beams,
+        type=int,
+        help=(
+            "Number of beams for a beam search instead of sampling, 1 to disable "
+            "[Default: {}]".format(num_beams)
+        ),
+    )
+    parser.add_argument(
+        "--length-penalty",
+        dest="length_penalty",
+        default=length_penalty,
+        type=float,
+        help=(
+            "Exponent of the length normalisation of the beam search, where higher "
+            "values favour longer texts [Default: {}]".format(length_penalty)
+        ),
+    )
+    parser.add_argument(
+        "-s",
+        "--seed",
+        dest="seed",
+        default=seed,
+        type=int,
+        help="Seed for the sampling [Default: {}]".format(seed),
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        dest="num_threads",
+        default=num_threads,
+        type=int,
+        help="Number of threads used on the CPU [Default: {}]".format(num_threads),
+    )
+    parser.add_argument(
+        "--no-cuda",
+        dest="no_cuda",
+        action="store_true",
+        help="Do not use CUDA even if it's available",
+    )
+    return parser.parse_args()
+
+
+def main():
+    options = parse_args()
+    torch.manual_seed(options.seed)
+    torch.set_num_threads(options.num_threads)
+    use_cuda = torch.cuda.is_available() and not options.no_cuda
+    device = torch.device("cuda" if use_cuda else "cpu")
+    generator = Generator.from_checkpoint(options.checkpoint, device)
+    out_fd = (
+        sys.stdout
+        if options.output == "-"
+        else open(options.output, "w", encoding="utf8")
+    )
+    num_texts = 0
+    num_tokens = 0
+    start_time = time.time()
+    for prompts in batch_prompts(
+        options.input, options.num_samples, batch_size=options.batch_size
+    ):
+        results = generator.generate(
+            prompts,
+            max_length=options.max_length,
+            temperature=options.temperature,
+            top_k=options.top_k,
+            top_p=options.top_p,
+            num_beams=options.num_beams,
+            length_penalty=options.length_penalty,
+        )
+        for text, _ in results:
+            out_fd.write(text)
+            out_fd.write("\n")
+        # The texts are available as soon as their batch is done.
+        out_fd.flush()
+        num_texts += len(results)
+        num_tokens += sum(length for _, length in results)
+        time_elapsed = time.time() - start_time
+        print(
+            "{texts} texts, {tokens} tokens ({speed:.0f} tokens/s)".format(
+                texts=num_texts, tokens=num_tokens, speed=num_tokens / time_elapsed
+            ),
+            file=sys.stderr,
+        )
+    if out_fd is not sys.stdout:
+        out_fd.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import inspect
+from typing import Any, Optional, Tuple
+
+import torch
+from transformers import PreTrainedModel
+
+# The cached keys and values of the previous tokens (past) are passed to the causal
+# language models as past in older versions of transformers and as past_key_values in
+# newer ones. Either way, the models return the updated past as their second output.
+
+
+def accepts_argument(module: torch.nn.Module, name: str) -> bool:
+    return name in inspect.signature(module.forward).parameters
+
+
+def past_argument(model: PreTrainedModel) -> str:
+    return "past_key_values" if accepts_argument(model, "past_key_values") else "past"
+
+
+def compute_past(
+    model: PreTrainedModel,
+    input_ids: torch.Tensor,
+    attention_mask: Optional[torch.Tensor] = None,
+    past: Optional[Any] = None,
+) -> Any:
+    """
+    Computes the keys and values of the given tokens with the transformer alone,
+    without the language modelling head, since their predictions are not needed.
+
+    Args:
+        model (PreTrainedModel): Causal language model, e.g. GPT2LMHeadModel
+        input_ids (torch.Tensor): Tokens to cache [Dimension: batch_size x seq_len]
+        attention_mask (torch.Tensor, optional): Mask of the padding, covering the
+            past and the new tokens.
+        past (Any, optional): Keys and values of the preceding tokens
+
+    Returns:
+        past (Any): Keys and values of the preceding and the given tokens
+    """
+    transformer = model.base_model
+    kwargs = {past_argument(transformer): past}
+    if accepts_argument(transformer, "use_cache"):
+        kwargs["use_cache"] = True
+    output = transformer(input_ids, attention_mask=attention_mask, **kwargs)
+    return output[1]
+
+
+def forward_with_past(
+    model: PreTrainedModel,
+    input_ids: torch.Tensor,
+    past: Optional[Any] = None,
+    attention_mask: Optional[torch.Tensor] = None,
+    position_ids: Optional[torch.Tensor] = None,
+) -> Tuple[torch.Tensor, Any]:
+    """
+    Predicts the next tokens of the given tokens, which follow the cached ones.
+
+    Args:
+        model (PreTrainedModel): Causal language model, e.g. GPT2LMHeadModel
+        input_ids (torch.Tensor): Tokens following the past
+            [Dimension: batch_size x seq_len]
+        past (Any, optional): Keys and values of the preceding tokens
+        attention_mask (torch.Tensor, optional): Mask of the padding, covering the
+            past and the new tokens.
+        position_ids (torch.Tensor, optional): Positions of the new tokens. By default
+            they continue after the past.
+
+    Returns:
+        logits (torch.Tensor): Prediction of the next token for each of the tokens
+            [Dimension: batch_size x seq_len x vocab_size]
+        past (Any): Keys and values of the preceding and the given tokens
+    """
+    kwargs = {past_argument(model): past}
+    if accepts_argument(model, "use_cache"):
+        kwargs["use_cache"] = True
+    output = model(
+        input_ids, attention_mask=attention_mask, position_ids=position_ids, **kwargs
+    )
+    return output[0], output[1]
+
+
+def expand_past(past: Any, batch_size: int) -> Any:
+    """
+    Repeats the past of a single sequence for every sequence of a batch, without
+    copying it.
+
+    Args:
+        past (Any): Keys and values of a single sequence
+        batch_size (int): Number of sequences that continue the sequence
+
+    Returns:
+        past (Any): Keys and values for the whole batch
+    """
+    # Newer versions of transformers wrap the past in a cache object.
+    if hasattr(past, "batch_repeat_interleave"):
+        past.batch_repeat_interleave(batch_size)
+        return past
+    if isinstance(past, (tuple, list)):
+        return type(past)(expand_past(p, batch_size) for p in past)
+    # Older versions stack the keys and values of each layer, such that the batch is
+    # the second dimension: [2, batch_size, num_heads, seq_len, head_dim]
+    batch_dim = 1 if past.dim() == 5 else 0
+    sizes = [-1] * past.dim()
+    sizes[batch_dim] = batch_size
+    return past.expand(*sizes)
+
+
+def reorder_past(past: Any, indices: torch.Tensor) -> Any:
+    """
+    Selects the past of the given sequences of the batch, e.g. to follow the beams that
+    are kept in a beam search.
+
+    Args:
+        past (Any): Keys and values of all sequences
+        indices (torch.Tensor): Index of the sequence whose past is used for each of
+            the new sequences [Dimension: new_batch_size]
+
+    Returns:
+        past (Any): Keys and values of the selected sequences
+    """
+    if hasattr(past, "reorder_cache"):
+        past.reorder_cache(indices)
+        return past
+    if isinstance(past, (tuple, list)):
+        return type(past)(reorder_past(p, indices) for p in past)
+    batch_dim = 1 if past.dim() == 5 else 0
+    return past.index_select(batch_dim, indices.to(past.device))
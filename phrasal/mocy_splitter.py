@@ -15,6 +15,11 @@ Main changes compared to the latest split-sentences.perl:
 * it is possible to load multiple nonbreaking prefix lists (merged into one lookup table);
 * no support for <p> tags (I didn't get the purpose of this option anyway)
 
+Large files can be split with :py:meth:`MocySplitter.split_lines`, which reads the paragraphs lazily and splits them
+in batches across worker processes, keeping the order of the output::
+
+    python -m phrasal.mocy_splitter -i crawl.txt -o sentences.txt -w 16
+
 """
 
 import os
@@ -49,6 +54,20 @@ class MocySplitter():
 
     """
 
+    # patterns used by split_paragraph, compiled once
+    multi_spaces_pattern = re.compile(' +')
+    space_newline_pattern = re.compile('\n ')
+    more_pattern = regex.compile(r'([\:;])([^\d\)\(/-])')
+    question_exclamation_pattern = regex.compile(r'([\?!]+)([^\?!\p{Pe}\p{Pf}\"])')
+    multi_dots_pattern = regex.compile(r'(\.[\.]+) +([\'\"\(\[\¿\¡\p{Pi}]*[\p{L}])')
+    quote_end_pattern = regex.compile(
+        r'([?!\.][\ ]*[\'\"\)\]\p{Pf}]+) +([\'\"\(\[\¿\¡\p{Pi}]*[\ ]*[\p{Lu}])')
+    punctuation_end_pattern = regex.compile(r'([?!\.]) +([\'\"\(\[\¿\¡\p{Pi}]+[\ ]*[\p{L}])')
+    period_word_pattern = regex.compile(r'([\p{IsAlnum}\.\-]*)([\'\"\)\]\%\p{Pf}]*)(\.+)$')
+    acronym_pattern = regex.compile(r'(\.)[\p{IsUpper}\-]+(\.+)$')
+    sentence_start_pattern = regex.compile(r'^([ ]*[\'\"\(\[\¿\¡\p{Pi}]*[ ]*[\p{L}0-9])')
+    number_start_pattern = regex.compile('^[0-9]+')
+
     def __init__(self, langs=None, prefix_file=None, more=True, keep_newlines=True):
         """
         :param lang: a List[str] of language(s) for nonbreaking_prefix file to load (default: en, de)
@@ -88,11 +107,11 @@ class MocySplitter():
         :param more: split on :; if true
         :return: a list of sentences (no blank lines)
         """
-        return sum((
-            self.split_paragraph(p, self.nb_prefixes, more)
-            for p in input_text.split('\n')
-            if p and not p.isspace()
-        ), [])
+        splits = []
+        for p in input_text.split('\n'):
+            if p and not p.isspace():
+                splits.extend(self.split_paragraph(p, self.nb_prefixes, more))
+        return splits
 
     def _split_text(self, input_text, more):  # -> List[str]
         """
@@ -103,30 +122,69 @@ class MocySplitter():
         :return: a list of sentences (no blank lines)
         """
         # equivalent of process_text in moses, but returns a list
-        current_paragraph = ''
         splits = []
-        for line in input_text.split('\n'):
+        for paragraph in self.iter_paragraphs(input_text.split('\n'), keep_newlines=False):
+            splits.extend(self.split_paragraph(paragraph, self.nb_prefixes, more))
+        return splits
+
+    @staticmethod
+    def iter_paragraphs(lines, keep_newlines=True):  # -> Iterator[str]
+        """
+        Lazily group lines (with or without their trailing newline) into the paragraphs split by :py:meth:`split`.
+
+        :param lines: an iterable of lines, e.g. an open file
+        :param keep_newlines: if set, each non-blank line is a paragraph, otherwise paragraphs are delimited by
+            blank lines and their lines are joined with spaces
+        :return: a generator of paragraphs
+        """
+        current_paragraph = []
+        for line in lines:
+            if line.endswith('\n'):
+                line = line[:-1]
             if not line or line.isspace():
                 # Time to process this block; we've hit a blank or <p>
                 if current_paragraph:
-                    splits.extend(self.split_paragraph(current_paragraph, self.nb_prefixes, more))
-                    current_paragraph = ""
+                    yield ' '.join(current_paragraph) + ' '
+                    current_paragraph = []
+            elif keep_newlines:
+                yield line
             else:
-                current_paragraph += line + ' '
+                current_paragraph.append(line)
 
         if current_paragraph:
             # Do the leftover text.
-            splits.extend(self.split_paragraph(current_paragraph, self.nb_prefixes, more))
+            yield ' '.join(current_paragraph) + ' '
 
-        return splits
+    def split_lines(self, lines, more=None, keep_newlines=None, num_workers=1, batch_size=1000):  # -> Iterator[str]
+        """
+        Split a stream of lines into sentences, with the same result as :py:meth:`split` on the whole text.
+        The lines are only read as the sentences are consumed, so arbitrarily large files can be split.
+
+        :param lines: an iterable of lines, e.g. an open file
+        :param more: override the class' parameter
+        :param keep_newlines: override the class' parameter
+        :param num_workers: number of processes the batches of paragraphs are split in (1: in this process)
+        :param batch_size: number of paragraphs per batch
+        :return: a generator of sentences, in order
+        """
+        more = more if more is not None else self.more
+        keep_newlines = keep_newlines if keep_newlines is not None else self.keep_newlines
+        batches = _batches(self.iter_paragraphs(lines, keep_newlines), batch_size)
+        if num_workers > 1:
+            from phrasal.parallel import imap_ordered
+            results = imap_ordered(_split_batch, batches, num_workers,
+                                   initializer=_init_worker, initargs=(self.nb_prefixes, more))
+        else:
+            results = (_split_paragraphs(batch, self.nb_prefixes, more) for batch in batches)
+        for sentences in results:
+            yield from sentences
 
     @classmethod
     def cleanup_spaces(cls, text):  # -> str
         """Normalize spaces in a text."""
-        # clean up spaces
-        text = re.sub(' +', ' ', text)
-        text = re.sub('\n ', '\n', text)
-        text = re.sub(' \n ', '\n', text)
+        # clean up spaces (' \n ' can't be left once there is no '\n ' anymore)
+        text = cls.multi_spaces_pattern.sub(' ', text)
+        text = cls.space_newline_pattern.sub('\n', text)
         return text.strip()
 
     @classmethod
@@ -151,52 +209,52 @@ class MocySplitter():
             # https://bitbucket.org/luismsgomes/mosestokenizer/src/default/src/mosestokenizer/split-sentences.perl
             # text = regex.sub(r'([\:;])', r'\1\n', text)
             # TODO: improvement: try to keep emojis, numers like 1:1 and urls intact
-            text = regex.sub(r'([\:;])([^\d\)\(/-])', r'\1\n\2', text)
+            text = cls.more_pattern.sub(r'\1\n\2', text)
 
         # split if ?! is followed by a lowercase (often on the web)
-        text = regex.sub(r'([\?!]+)([^\?!\p{Pe}\p{Pf}\"])', r'\1\n\2', text)
+        text = cls.question_exclamation_pattern.sub(r'\1\n\2', text)
         # text = regex.sub(r'([?!]) +([\'\"\(\[\¿\¡\p{Pi}]*[\p{L}])', r'\1\n\2', text)
 
         # Multi-dots followed by sentence starters.
-        text = regex.sub(r'(\.[\.]+) +([\'\"\(\[\¿\¡\p{Pi}]*[\p{L}])', r'\1\n\2', text)
+        text = cls.multi_dots_pattern.sub(r'\1\n\2', text)
 
         # Add breaks for sentences that end with some sort of punctuation
         # inside a quote or parenthetical and are followed by a possible
         # sentence starter punctuation and ~upper case~ letter
-        text = regex.sub(r'([?!\.][\ ]*[\'\"\)\]\p{Pf}]+) +([\'\"\(\[\¿\¡\p{Pi}]*[\ ]*[\p{Lu}])', r'\1\n\2', text)
+        text = cls.quote_end_pattern.sub(r'\1\n\2', text)
 
         # Add breaks for sentences that end with some sort of punctuation,
         # and are followed by a sentence starter punctuation and upper case letter.
-        text = regex.sub(r'([?!\.]) +([\'\"\(\[\¿\¡\p{Pi}]+[\ ]*[\p{L}])', r'\1\n\2', text)
+        text = cls.punctuation_end_pattern.sub(r'\1\n\2', text)
 
         # Special punctuation cases are covered. Check all remaining periods.
         words = text.split(' ')
-        text = ''
         for i in range(len(words) - 1):
             # TODO: add the # as a possible sentence start ? (twitter and hashtags)
-            m = regex.search(r'([\p{IsAlnum}\.\-]*)([\'\"\)\]\%\p{Pf}]*)(\.+)$', words[i])
+            # the pattern needs a period at the end ($ also matches before a final newline)
+            if not (words[i].endswith('.') or words[i].endswith('.\n')):
+                continue
+            m = cls.period_word_pattern.search(words[i])
             if m is not None:
                 # Check if $1 is a known honorific and $2 is empty, never break.
                 prefix, starting_punct, _ = m.groups()
                 if prefix and nb_prefixes.get(prefix, _UNDEF) == _ANY and not starting_punct:
                     pass  # Not breaking prefix
-                elif regex.search(r'(\.)[\p{IsUpper}\-]+(\.+)$', words[i]) is not None:
+                elif cls.acronym_pattern.search(words[i]) is not None:
                     pass  # Not breaking - upper case acronym
-                elif regex.search(r'^([ ]*[\'\"\(\[\¿\¡\p{Pi}]*[ ]*[\p{L}0-9])', words[i + 1]):
+                elif cls.sentence_start_pattern.search(words[i + 1]):
                     # The next word has maybe a bunch of initial quotes, maybe a
                     # space, then either ~upper case~ letter or a number
                     if prefix and nb_prefixes.get(prefix, _UNDEF) == _NUMERIC_ONLY and not starting_punct \
-                            and regex.search('^[0-9]+', words[i + 1]):
+                            and cls.number_start_pattern.search(words[i + 1]):
                         # exception: we have a numeric-only prefix followed by a number
                         pass
                     else:
                         # In any other case, split
                         words[i] = words[i] + '\n'
-            text += words[i] + ' '
 
-        # We stopped one token from the end to allow for easy look-ahead.
-        # Append it now.
-        text = text + words[-1]
+        # The words are joined at once rather than one after another, which is quadratic
+        text = ' '.join(words)
 
         # clean up spaces
         text = cls.cleanup_spaces(text)
@@ -246,6 +304,39 @@ class MocySplitter():
         return prefixes
 
 
+# splitter state of each process of split_lines
+_worker_nb_prefixes = None
+_worker_more = False
+
+
+def _init_worker(nb_prefixes, more):
+    global _worker_nb_prefixes, _worker_more
+    _worker_nb_prefixes = nb_prefixes
+    _worker_more = more
+
+
+def _split_paragraphs(paragraphs, nb_prefixes, more):
+    sentences = []
+    for p in paragraphs:
+        sentences.extend(MocySplitter.split_paragraph(p, nb_prefixes, more))
+    return sentences
+
+
+def _split_batch(paragraphs):
+    return _split_paragraphs(paragraphs, _worker_nb_prefixes, _worker_more)
+
+
+def _batches(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 def main():
     import argparse
 
@@ -255,6 +346,9 @@ def main():
     parser.add_argument('-l', '--lang', action='append')
     parser.add_argument('-pf', '--prefix-file', default=None)
     parser.add_argument('-m', '--more', default=False, action='store_true')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='number of processes [Default: 1]')
+    parser.add_argument('-b', '--batch-size', type=int, default=1000,
+                        help='number of paragraphs split at once by a process [Default: 1000]')
 
     args = parser.parse_args()
 
@@ -265,6 +359,11 @@ def main():
         prefix_file=args.prefix_file,
         more=args.more)
 
-    args.out.write('\n'.join(
-        splitter.split(args.input.read())
-    ))
+    # the input is streamed, so the memory doesn't grow with its size
+    for sentence in splitter.split_lines(args.input, num_workers=args.workers, batch_size=args.batch_size):
+        args.out.write(sentence)
+        args.out.write('\n')
+
+
+if __name__ == '__main__':
+    main()
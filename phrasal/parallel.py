@@ -0,0 +1,31 @@
+"""
+Helpers to process large inputs in batches with a pool of processes.
+"""
+
+import multiprocessing
+from collections import deque
+
+
+def imap_ordered(fn, iterable, num_workers, initializer=None, initargs=(), max_pending=None):
+    """
+    Like ``multiprocessing.Pool.imap``, but the iterable is only consumed as the results are, so that at most
+    ``max_pending`` items are in memory at once (``Pool.imap`` reads the whole iterable ahead).
+
+    :param fn: the function to apply to each item, must be picklable (i.e. defined at module level)
+    :param iterable: the items, e.g. batches of lines read lazily from a file
+    :param num_workers: number of processes
+    :param initializer: function called once in each process (see ``multiprocessing.Pool``)
+    :param initargs: arguments of the initializer
+    :param max_pending: maximum number of items being processed (default: twice the number of processes)
+    :return: a generator of the results, in the order of the items
+    """
+    if max_pending is None:
+        max_pending = 2 * num_workers
+    with multiprocessing.Pool(num_workers, initializer=initializer, initargs=initargs) as pool:
+        pending = deque()
+        for item in iterable:
+            pending.append(pool.apply_async(fn, (item,)))
+            if len(pending) >= max_pending:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
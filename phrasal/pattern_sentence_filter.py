@@ -93,6 +93,16 @@ simply ignored:
         count:
           max: 0
 
+Evaluation
+----------
+
+The rules are not run as is: a ``find`` rule only counts its matches as far as needed to know if its bounds are
+respected (e.g. a single ``search`` for ``max: 0``), and the length rules are checked first, as they are almost free.
+Since a sentence is rejected as soon as any rule fails, the order of the other rules doesn't change the result.
+With ``adaptive=True``, the time and number of rejections of each rule are measured and the rules are regularly
+reordered so that the cheapest rules that reject the most sentences come first. The statistics are available
+with :py:meth:`Rules.statistics` (or ``--stats`` on the command line).
+
 Rules can additionnally specify ``examples`` and ``counterexamples`` that could be used to check quickly if they work
 (see the ``Rule.self_check`` method). For example:
 
@@ -116,6 +126,8 @@ Rules can additionnally specify ``examples`` and ``counterexamples`` that could
 import regex
 import yaml
 import logging
+import os
+import time
 from os import path
 
 logger = logging.getLogger(__name__)
@@ -130,19 +142,35 @@ class PatternSentenceFilter():
     You can override this by passing a path to the constructor (``rulespath`` argument).
     """
 
-    def __init__(self, rulespath=None):
-        """Load rules from the default YAML file or the path provided."""
+    def __init__(self, rulespath=None, adaptive=False):
+        """Load rules from the default YAML file or the path provided. See :py:class:`Rules` for ``adaptive``."""
         if rulespath is None:
             rulespath = path.join(path.dirname(path.realpath(__file__)), 'pattern_sentence_filter.yaml')
 
         self.rulespath = rulespath
-        self.rules = Rules(yaml.safe_load(open(rulespath)))
+        with open(rulespath) as f:
+            self.rules = Rules(yaml.safe_load(f), adaptive=adaptive)
 
     def is_valid(self, sentence):
         """Returns true only if all the rules were respected."""
         return not self.rules.is_invalid(sentence)
 
 
+def count_matches(pattern, s, limit=-1):
+    """
+    Count the matches of the pattern, i.e. ``len(pattern.findall(s))``, without building the list of matches.
+    If a limit is given, the counting stops as soon as it is reached.
+    """
+    if limit == 1:
+        return 0 if pattern.search(s) is None else 1
+    nb_matches = 0
+    for _ in pattern.finditer(s):
+        nb_matches += 1
+        if nb_matches == limit:
+            break
+    return nb_matches
+
+
 class MinMax:
     """Encapsulates and handles min/max bounds. A bound set to -1 will be ignored."""
 
@@ -156,6 +184,14 @@ class MinMax:
     def is_out_of_range(self, n) -> bool:
         return (self.min >= 0 and self.min > n) or (self.max >= 0 and self.max < n)
 
+    def count_limit(self) -> int:
+        """Number of matches after which the result of is_out_of_range doesn't change anymore (0 if it never fails)."""
+        if self.max >= 0:
+            return int(self.max) + 1
+        if self.min > 0:
+            return int(-(-self.min // 1))  # ceil, as min can be a float
+        return 0
+
     def __repr__(self):
         return "(min={}, max={})".format(self.min, self.max)
 
@@ -167,7 +203,11 @@ class Compare:
         self.ratio = MinMax(**ratio)
 
     def is_invalid(self, s):
-        ratio = len(self.num.findall(s)) / (len(self.denom.findall(s)) + 1)
+        nb_num = count_matches(self.num, s)
+        if nb_num == 0:
+            # the ratio is 0 whatever the denominator
+            return self.ratio.is_out_of_range(0)
+        ratio = nb_num / (count_matches(self.denom, s) + 1)
         return self.ratio.is_out_of_range(ratio)
 
     def __repr__(self):
@@ -183,10 +223,13 @@ class Find:
         self.pattern = regex.compile(pattern)
         self.count = MinMax(**count) if count else None
         self.ratio = MinMax(**ratio) if ratio else None
+        # the ratio needs the exact number of matches, otherwise they are only counted until the result is known
+        self.limit = self.count.count_limit() if self.count and not self.ratio else -1
 
     def is_invalid(self, s):
-        matches = self.pattern.findall(s)
-        nb_matches = len(matches)
+        if self.limit == 0:
+            return False
+        nb_matches = count_matches(self.pattern, s, self.limit)
         if self.count and self.count.is_out_of_range(nb_matches):
             return True
         if self.ratio:
@@ -206,6 +249,7 @@ class Rule:
         self.descr = descr
         self.examples = examples
         self.counterexamples = counterexamples
+        self.reset_statistics()
         self.iff = []
         # TODO: better way ?
         if 'if' in kwargs:  # if is a reserved keyword in python
@@ -223,9 +267,17 @@ class Rule:
         else:
             raise Exception('Found a rule with no length, find or ratio defined.')
 
+    @property
+    def is_length_rule(self) -> bool:
+        """Whether the rule only depends on the length of the sentence, hence is almost free to check."""
+        return isinstance(self.logic, MinMax) and all(isinstance(iff, MinMax) for iff in self.iff)
+
     def is_applicable(self, s) -> bool:
         """Check for the if condition"""
-        return not any([iff.is_invalid(s) for iff in self.iff])
+        for iff in self.iff:
+            if iff.is_invalid(s):
+                return False
+        return True
 
     def is_invalid(self, s) -> bool:
         if self.is_applicable(s):
@@ -237,6 +289,18 @@ class Rule:
             # logger.debug("SKIPPED   RULE %s: |%s|" % (self.descr, s))
             return False
 
+    def reset_statistics(self):
+        self.nb_checked = 0  #: number of sentences the rule has been checked on
+        self.nb_rejected = 0  #: number of those sentences that the rule rejected
+        self.time = 0.0  #: total time spent checking the rule, in seconds
+
+    def expected_cost(self) -> float:
+        """
+        Expected time spent on this rule per rejected sentence, the rules with the lowest cost are checked first.
+        The estimates are smoothed, so that a rule that hasn't rejected anything yet isn't put last forever.
+        """
+        return (self.time / (self.nb_checked + 1)) / ((self.nb_rejected + 1) / (self.nb_checked + 2))
+
     def self_check(self, verbose=True) -> bool:
         passed = True
         for examples, expected in [(self.examples, True), (self.counterexamples, False)]:
@@ -262,19 +326,72 @@ class Rules:
     This class represents a list of rules.
     """
 
-    def __init__(self, rules_dict):
+    def __init__(self, rules_dict, adaptive=False, reorder_every=1000):
         """
         :param rules_dict: a dictionary of rules (as loaded by yaml)
+        :param adaptive: if set, measure the statistics of each rule and reorder the rules with them;
+        :param reorder_every: number of sentences after which the rules are reordered
         """
         self.rules = [Rule(idx + 1, **r) for (idx, r) in enumerate(rules_dict)]  # [:1]
+        #: order in which the rules are checked, the length rules first
+        self.order = sorted(self.rules, key=lambda r: not r.is_length_rule)
+        self.adaptive = adaptive
+        self.reorder_every = reorder_every
+        self.nb_checked = 0
 
     def is_invalid(self, sentence: str) -> bool:
         """Returns true if any rule that apply failed."""
-        for idx, r in enumerate(self.rules):
-            if r.is_invalid(sentence):
-                # print("RULE %d %s FAILED on |%s|" % (idx, r.descr, sentence))
-                return True
-        return False
+        if not self.adaptive:
+            for r in self.order:
+                if r.is_invalid(sentence):
+                    return True
+            return False
+
+        invalid = False
+        for r in self.order:
+            start = time.perf_counter()
+            invalid = r.is_invalid(sentence)
+            r.time += time.perf_counter() - start
+            r.nb_checked += 1
+            if invalid:
+                r.nb_rejected += 1
+                break
+        self.nb_checked += 1
+        if self.nb_checked % self.reorder_every == 0:
+            self.reorder()
+        return invalid
+
+    def reorder(self):
+        """Order the rules by their expected cost per rejection, the length rules still come first."""
+        self.order = sorted(self.rules, key=lambda r: (not r.is_length_rule, r.expected_cost()))
+
+    def statistics(self):
+        """
+        Returns the statistics of each rule as a dict id -> (nb_checked, nb_rejected, time). Note that a rule is
+        only checked on the sentences that the previous rules didn't reject.
+        """
+        return {r.id: (r.nb_checked, r.nb_rejected, r.time) for r in self.rules}
+
+    def add_statistics(self, statistics):
+        """Add the statistics of another instance (e.g. from another process), as returned by statistics()."""
+        for r in self.rules:
+            nb_checked, nb_rejected, time_spent = statistics[r.id]
+            r.nb_checked += nb_checked
+            r.nb_rejected += nb_rejected
+            r.time += time_spent
+
+    def reset_statistics(self):
+        for r in self.rules:
+            r.reset_statistics()
+
+    def print_statistics(self, file=None):
+        """Prints the hit rate and cost of each rule, in the order they are currently checked."""
+        print("{:>4} {:<40} {:>10} {:>10} {:>8} {:>10}".format(
+            "id", "rule", "checked", "rejected", "rate", "us/check"), file=file)
+        for r in self.order:
+            print("{:>4} {:<40} {:>10} {:>10} {:>8.2%} {:>10.2f}".format(
+                r.id, r.descr[:40], r.nb_checked, r.nb_rejected, r.nb_rejected / max(r.nb_checked, 1),
+                1e6 * r.time / max(r.nb_checked, 1)), file=file)
 
     def print_rules(self):
         """Prints all the rules, useful for debug."""
@@ -288,21 +405,79 @@ class Rules:
         return len(self.rules)
 
 
+# filter used by each process of main
+_worker_filter = None
+
+
+def _init_worker(rulespath, adaptive):
+    global _worker_filter
+    _worker_filter = PatternSentenceFilter(rulespath=rulespath, adaptive=adaptive)
+
+
+def _filter_batch(lines):
+    """Returns the valid lines of the batch, the process id and the statistics of the rules in this process so far."""
+    valid = [t for t in lines if _worker_filter.is_valid(t)]
+    return valid, os.getpid(), _worker_filter.rules.statistics()
+
+
+def _read_batches(lines, batch_size):
+    batch = []
+    for line in lines:
+        batch.append(line.rstrip('\n'))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 def main():
     import argparse
     import sys
+    from phrasal.parallel import imap_ordered
+    global _worker_filter
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--input', type=argparse.FileType('r'), default='-')
     parser.add_argument('-o', '--out', type=argparse.FileType('w'), default='-')
     parser.add_argument('-r', '--rules-file', default=None)
+    parser.add_argument('-w', '--workers', type=int, default=1, help='number of processes [Default: 1]')
+    parser.add_argument('-b', '--batch-size', type=int, default=10000,
+                        help='number of lines filtered at once by a process [Default: 10000]')
+    parser.add_argument('--adaptive', default=False, action='store_true',
+                        help='reorder the rules with the statistics of the previous sentences')
+    parser.add_argument('--stats', default=False, action='store_true',
+                        help='print the hit rate and cost of each rule to stderr (implies --adaptive)')
 
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.INFO, stream=sys.stderr, format='%(levelname)s: %(msg)s')
 
-    psf = PatternSentenceFilter(rulespath=args.rules_file)
-
-    args.out.write('\n'.join(
-        t for t in args.input if psf.is_valid(t)
-    ))
+    adaptive = args.adaptive or args.stats
+    psf = PatternSentenceFilter(rulespath=args.rules_file, adaptive=adaptive)
+    batches = _read_batches(args.input, args.batch_size)
+    if args.workers > 1:
+        # the batches are read lazily and the results come back in order
+        results = imap_ordered(_filter_batch, batches, args.workers,
+                               initializer=_init_worker, initargs=(psf.rulespath, adaptive))
+    else:
+        _worker_filter = psf
+        results = map(_filter_batch, batches)
+
+    statistics = {}  # latest statistics of each process
+    for valid, pid, process_statistics in results:
+        for t in valid:
+            args.out.write(t)
+            args.out.write('\n')
+        statistics[pid] = process_statistics
+
+    if args.stats:
+        psf.rules.reset_statistics()
+        for process_statistics in statistics.values():
+            psf.rules.add_statistics(process_statistics)
+        psf.rules.reorder()
+        psf.rules.print_statistics(file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,286 @@
+"""Benchmarks of the preprocessing, which compare the optimised implementations
+to the original ones they replace, both in speed and output.
+
+    python -m preprocessing.benchmark cleaning -i data/twitter_over_99.csv
+    python -m preprocessing.benchmark normalisation -i data/twitter_over_99.csv
+    python -m preprocessing.benchmark near-dedup -i data/twitter_over_99.csv
+
+With --golden, the output of the original implementation is written to the
+given file if it doesn't exist yet, otherwise both outputs are compared to it,
+which catches any change of the output across versions.
+
+The near duplicates have no original implementation, hence their clusters are
+compared between one and multiple processes, and checked on a few sentences whose
+clusters are known.
+"""
+
+import argparse
+import multiprocessing
+import os
+import time
+from collections import OrderedDict
+from functools import partial
+
+from phrasal.norm_punc import normalize_batch, normalize_text
+from preprocessing.cleaner import CompiledCleaner
+from preprocessing.generic.clean_data import clean_text, preprocessing_regex
+from preprocessing.near_dedup import cluster_sentences, is_representative
+from preprocessing.pipeline import read_chunks
+
+num_workers = multiprocessing.cpu_count()
+batch_size = 1000
+
+# Sentences with known clusters and whether they are all in the same cluster (or
+# all in different ones).
+near_dedup_cases = [
+    (
+        "Variants of a sentence",
+        [
+            "Hallo zäme, wie gahts eu hüt?",
+            "hallo zäme wie gahts eu hüt",
+            "Hallo zäme, wie gahts eu hüt?! https://t.co/abc",
+            "@someone Hallo zäme, wie gahts eu hüt?",
+        ],
+        True,
+    ),
+    (
+        "Sentences without letters or digits",
+        ["!!!", "???", ":)", "😀😀", "https://t.co/abc", "@someone", ""],
+        False,
+    ),
+]
+
+
+def read_sentences(path, num_sentences=None):
+    sentences = []
+    for chunk in read_chunks(path):
+        sentences.extend(chunk)
+        if num_sentences is not None and len(sentences) >= num_sentences:
+            return sentences[:num_sentences]
+    return sentences
+
+
+def measure(fn, name, sentences):
+    start_time = time.time()
+    results = fn(sentences)
+    time_elapsed = time.time() - start_time
+    print(
+        "{name:<24} {time:>8.2f}s {sentences:>12.0f} sentences/s".format(
+            name=name, time=time_elapsed, sentences=len(sentences) / time_elapsed
+        )
+    )
+    return results
+
+
+def compare(results, reference, name):
+    num_different = sum(1 for x, y in zip(results, reference) if x != y)
+    num_different += abs(len(results) - len(reference))
+    if num_different > 0:
+        print("  -> {} sentences differ from {}".format(num_different, name))
+    return num_different
+
+
+def check_golden(path, modes):
+    """Writes the output of the first mode to the golden file if it doesn't
+    exist, otherwise compares the output of every mode to it."""
+    reference_name, reference = next(iter(modes.items()))
+    if not os.path.exists(path):
+        with open(path, "w", encoding="utf8") as fd:
+            for sentence in reference:
+                fd.write(sentence.replace("\n", "\\n"))
+                fd.write("\n")
+        print("Golden file {} written ({})".format(path, reference_name))
+        return
+    with open(path, "r", encoding="utf8") as fd:
+        golden = [line.rstrip("\n").replace("\\n", "\n") for line in fd]
+    for name, results in modes.items():
+        if compare(results, golden, "the golden file") == 0:
+            print("{:<24} identical to the golden file".format(name))
+
+
+def run_modes(modes, sentences, golden=None):
+    """Measures every mode and compares its output to the first one, which is
+    the original implementation."""
+    outputs = OrderedDict()
+    for name, fn in modes.items():
+        outputs[name] = measure(fn, name, sentences)
+        if len(outputs) > 1:
+            compare(outputs[name], next(iter(outputs.values())), "the original")
+    if golden is not None:
+        check_golden(golden, outputs)
+
+
+def check_near_dedup(cluster_fn):
+    """Checks the clusters of the sentences whose clusters are known."""
+    num_failed = 0
+    for name, sentences, same_cluster in near_dedup_cases:
+        num_clusters = len(set(cluster_fn(sentences)))
+        expected = 1 if same_cluster else len(sentences)
+        if num_clusters != expected:
+            print(
+                "  -> {}: {} clusters instead of {}".format(
+                    name, num_clusters, expected
+                )
+            )
+            num_failed += 1
+    if num_failed == 0:
+        print("Known clusters are correct ({} cases)".format(len(near_dedup_cases)))
+
+
+def benchmark_cleaning(options):
+    sentences = read_sentences(options.input, options.num_sentences)
+    cleaner = CompiledCleaner(
+        preprocessing_regex,
+        normalize=partial(normalize_text, strip_emojis=True),
+        normalize_batch=partial(
+            normalize_batch, strip_emojis=True, batch_size=options.batch_size
+        ),
+    )
+    modes = OrderedDict(
+        [
+            ("Cleaner chain", lambda xs: [clean_text(x) for x in xs]),
+            ("Compiled cleaner", lambda xs: [cleaner(x) for x in xs]),
+            ("Compiled cleaner (batch)", cleaner.clean_batch),
+        ]
+    )
+    run_modes(modes, sentences, golden=options.golden)
+
+
+def benchmark_normalisation(options):
+    sentences = read_sentences(options.input, options.num_sentences)
+    kwargs = dict(strip_emojis=options.strip_emojis)
+    modes = OrderedDict(
+        [
+            (
+                "normalize_text",
+                lambda xs: [normalize_text(x, **kwargs) for x in xs],
+            ),
+            (
+                "normalize_batch",
+                lambda xs: normalize_batch(xs, batch_size=options.batch_size, **kwargs),
+            ),
+            (
+                "normalize_batch ({} proc.)".format(options.num_workers),
+                lambda xs: normalize_batch(
+                    xs,
+                    batch_size=options.batch_size,
+                    num_workers=options.num_workers,
+                    **kwargs
+                ),
+            ),
+        ]
+    )
+    run_modes(modes, sentences, golden=options.golden)
+
+
+def benchmark_near_dedup(options):
+    sentences = read_sentences(options.input, options.num_sentences)
+    modes = OrderedDict(
+        [
+            (
+                "Clusters (1 proc.)",
+                lambda xs: cluster_sentences(xs, num_workers=1).tolist(),
+            ),
+            (
+                "Clusters ({} proc.)".format(options.num_workers),
+                lambda xs: cluster_sentences(
+                    xs, num_workers=options.num_workers
+                ).tolist(),
+            ),
+        ]
+    )
+    outputs = OrderedDict()
+    for name, fn in modes.items():
+        outputs[name] = measure(fn, name, sentences)
+        if len(outputs) > 1:
+            compare(outputs[name], next(iter(outputs.values())), "1 process")
+    clusters = next(iter(outputs.values()))
+    num_near_duplicates = len(clusters) - int(is_representative(clusters).sum())
+    print("Near duplicates: {} of {}".format(num_near_duplicates, len(clusters)))
+    check_near_dedup(lambda xs: cluster_sentences(xs, num_workers=1).tolist())
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    cleaning_parser = subparsers.add_parser(
+        "cleaning",
+        help="Throughput of the cleaning of the generic corpora (clean_data)",
+    )
+    cleaning_parser.set_defaults(run=benchmark_cleaning)
+
+    normalisation_parser = subparsers.add_parser(
+        "normalisation",
+        help="Throughput of the normalisation of the sentences (phrasal.norm_punc)",
+    )
+    normalisation_parser.set_defaults(run=benchmark_normalisation)
+    normalisation_parser.add_argument(
+        "--strip-emojis",
+        dest="strip_emojis",
+        action="store_true",
+        help="Strip the emojis as well",
+    )
+
+    near_dedup_parser = subparsers.add_parser(
+        "near-dedup",
+        help="Throughput of the clustering of near duplicates (near_dedup)",
+    )
+    near_dedup_parser.set_defaults(run=benchmark_near_dedup)
+
+    for subparser in [normalisation_parser, near_dedup_parser]:
+        subparser.add_argument(
+            "-w",
+            "--workers",
+            dest="num_workers",
+            default=num_workers,
+            type=int,
+            help="Number of processes [Default: {}]".format(num_workers),
+        )
+
+    for subparser in [cleaning_parser, normalisation_parser, near_dedup_parser]:
+        subparser.add_argument(
+            "-i",
+            "--input",
+            dest="input",
+            required=True,
+            type=str,
+            help="Path to TSV file of the sentences",
+        )
+        subparser.add_argument(
+            "-n",
+            "--num-sentences",
+            dest="num_sentences",
+            type=int,
+            help="Only use the first n sentences of the file",
+        )
+
+    for subparser in [cleaning_parser, normalisation_parser]:
+        subparser.add_argument(
+            "--golden",
+            dest="golden",
+            type=str,
+            help=(
+                "Path to the golden file of the expected output, which is "
+                "created if it doesn't exist"
+            ),
+        )
+        subparser.add_argument(
+            "--batch-size",
+            dest="batch_size",
+            default=batch_size,
+            type=int,
+            help="Number of sentences normalised at once [Default: {}]".format(
+                batch_size
+            ),
+        )
+    return parser.parse_args()
+
+
+def main():
+    options = parse_args()
+    options.run(options)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,16 @@
 import re
-from typechecker.typecheck import *
+from typing import List, Set, Tuple
 import unidecode
 
+if __debug__:
+    from typechecker.typecheck import accepts, returns
+else:
+    # In production (python -O) the runtime type checks are removed, as they
+    # are run on every call of the cleaning methods.
+    def accepts(*types, **kw_types):
+        return lambda fn: fn
+    returns = accepts
+
 class Cleaner:
     good_chars = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
     good_chars += "ÀÁÂÄÈÉÊËÍÌÎÏÓÒÔÖÚÙÛÜàáâäèéêëìíîïôöòóüùúûÿ"
@@ -20,6 +29,24 @@ class Cleaner:
     punc_set = set(".,:;!?")
     punc_set_no_period = set(",:;!?")
 
+    # The patterns are compiled once rather than looked up in the cache of the
+    # re module on every call.
+    smiley_regexs = [
+        re.compile(r"[\:\;\=]{1}-?([\\\/DpPdoO0\*)(\]\[\]])\1*"),
+        re.compile(r"[\:\;\=]{1}\s?-\s?([\\\/\*)(\]\[\]])\1*")]
+    hat_regex = re.compile(r"\^\w+$")
+    spaces_regex = re.compile(r"\s+")
+    points_regex = re.compile(r"\.{2,}")
+    punc_combination_regexs = [
+        (re.compile(r"[\?\!\.\,\;\:]*\?[\?\!\.\,\;\:]*"), "?"),
+        (re.compile(r"[\!\.\,\;\:]*\![\!\.\,\;\:]*"), "!"),
+        (re.compile(r"[\,\;\:]*\.[\,\;\:]*"), "."),
+        (re.compile(r"[\,\;\:]*\,[\,\;\:]*"), ",")]
+    point_space_regex = re.compile(r"\.(?!\.)")
+    special_duplication_regex = re.compile(
+        r"([\-\,\?\!\%\&\"\'\(\)\/\$\*\+\:\;\<\=\>\[\]\\\^" +
+        r"\_\{\}\|\~\€\°\²])\1*")
+
     @staticmethod
     @accepts(str, List[Tuple[str, str]])
     @returns(str)
@@ -46,10 +73,8 @@ class Cleaner:
         """Remove smileys from text. This is different from the emojis because
         the smileys are made by combining characters (mostly ascii), e.g. :-)
         """
-        regex = r"[\:\;\=]{1}-?([\\\/DpPdoO0\*)(\]\[\]])\1*"
-        sentence = re.sub(regex, " ", sentence)
-        regex = r"[\:\;\=]{1}\s?-\s?([\\\/\*)(\]\[\]])\1*"
-        sentence = re.sub(regex, " ", sentence)
+        for regex in Cleaner.smiley_regexs:
+            sentence = regex.sub(" ", sentence)
 
         for smiley in Cleaner.smileys:
             sentence = sentence.replace(smiley, " ")
@@ -63,7 +88,7 @@ class Cleaner:
         sometimes at the end of sentences. The meaning and origin of these
         elements are unknown.
         """
-        sentence = re.sub(r"\^\w+$", "", sentence)
+        sentence = Cleaner.hat_regex.sub("", sentence)
         return sentence
 
     @staticmethod
@@ -172,17 +197,15 @@ class Cleaner:
             while c+c in sentence:
                 sentence = sentence.replace(c+c, c)
         # replace two or more points by three points
-        sentence = re.sub(r"\.{2,}", "...", sentence)
+        sentence = Cleaner.points_regex.sub("...", sentence)
         # replace a weird combination of punctuation by a simple one
-        sentence = re.sub(r"[\?\!\.\,\;\:]*\?[\?\!\.\,\;\:]*", "?", sentence)
-        sentence = re.sub(r"[\!\.\,\;\:]*\![\!\.\,\;\:]*", "!", sentence)
-        sentence = re.sub(r"[\,\;\:]*\.[\,\;\:]*", ".", sentence)
-        sentence = re.sub(r"[\,\;\:]*\,[\,\;\:]*", ",", sentence)
+        for regex, replacement in Cleaner.punc_combination_regexs:
+            sentence = regex.sub(replacement, sentence)
         # remove punctuation at the beginning
         while len(sentence) > 0 and sentence[0] in Cleaner.punc_set:
             sentence = sentence[1:]
         # add space after punctuation
-        sentence = re.sub(r"\.(?!\.)", ". ", sentence)
+        sentence = Cleaner.point_space_regex.sub(". ", sentence)
         for c in Cleaner.punc_set_no_period:
             sentence = sentence.replace(c, c+" ")
         # remove duplicated space
@@ -195,7 +218,7 @@ class Cleaner:
     def clean_spaces(sentence):
         """Remove duplicated spaces and spaces at the beginning or end of a
         sentence"""
-        sentence = re.sub(r"\s+", " ", sentence)
+        sentence = Cleaner.spaces_regex.sub(" ", sentence)
         sentence = sentence.strip()
         return sentence
 
@@ -222,10 +245,7 @@ class Cleaner:
         """
 
         # would do the job but takes slightly more time
-        special = r"[\-\,\?\!\%\&\"\'\(\)\/\$\*\+\:\;\<\=\>\[\]\\\^" + \
-                   r"\_\{\}\|\~\€\°\²]"
-        regex = r"(" + special + r")\1*"
-        sentence = re.sub(regex, r"\1", sentence)
+        sentence = Cleaner.special_duplication_regex.sub(r"\1", sentence)
         return sentence
 
         # slightly faster but need to check escaped characters
@@ -243,3 +263,164 @@ class Cleaner:
                 c = unidecode.unidecode(c)
             res.append(c)
         return ''.join(res)
+
+
+def char_class(chars):
+    """Regex character class that matches any of the given characters"""
+    return "[" + "".join(re.escape(c) for c in sorted(chars)) + "]"
+
+
+class CompiledCleaner:
+    """Cleaning chain of the generic corpora, which gives exactly the same
+    output as calling the following Cleaner methods one after another:
+
+        preprocess(sentence, regexs)
+        normalize(sentence)
+        remove_smileys
+        remove_hat_element
+        remove_html_entities
+        clean_punc
+        remove_groups_of_special_chars(sentence, group_size)
+        remove_special_duplication
+        remove_isolated_special_chars
+
+    All patterns are compiled once and the passes that only look for a few
+    characters are merged into single regexs. The steps that are rarely needed
+    (smileys, hat elements, html entities) are skipped when the sentence
+    contains nothing they would remove.
+    """
+
+    # maximum number of cleaned punctuation sequences that are remembered
+    max_cached_runs = 100000
+
+    def __init__(self, regexs, normalize=None, normalize_batch=None,
+                 group_size=2, group_special=set("-,%&\"'()/$*+:;<=>[]^_{}|\\~€°²"),
+                 isolated_special=set("+<=>^_\\°²")):
+        """
+        Parameters
+            regexs | List[Tuple[str, str]]
+                The patterns and their replacements given to Cleaner.preprocess
+            normalize | Callable[[str], str]
+                Function called after the preprocessing, e.g. a partial of
+                phrasal.norm_punc.normalize_text. None to skip it.
+            normalize_batch | Callable[[List[str]], List[str]]
+                Function giving the same result as normalize on a list of
+                sentences at once, used by clean_batch, e.g. a partial of
+                phrasal.norm_punc.normalize_batch.
+            group_size | int
+                from_size of Cleaner.remove_groups_of_special_chars
+            group_special | Set[str]
+                special of Cleaner.remove_groups_of_special_chars
+            isolated_special | Set[str]
+                special of Cleaner.remove_isolated_special_chars
+        """
+        self.regexs = [(re.compile(regex), replacement)
+                       for regex, replacement in regexs]
+        self.normalize = normalize
+        self.normalize_batch = normalize_batch
+        # Matches if any smiley is in the sentence. A sentence that contains
+        # one still goes through all the replacements in order, because
+        # removing a smiley can create another (e.g. "^^XD" -> " XD").
+        self.smiley_regex = re.compile("|".join(
+            [regex.pattern for regex in Cleaner.smiley_regexs] +
+            [re.escape(smiley) for smiley in Cleaner.smileys]))
+        # The entities with a semicolon come first, hence they are preferred to
+        # their prefix without it, like the order of the replacements.
+        self.html_regex = re.compile(
+            "|".join(re.escape(x) for x in Cleaner.html_entities))
+        punc = char_class(Cleaner.punc_set)
+        self.punc_chars = "".join(sorted(Cleaner.punc_set))
+        self.space_before_punc_regex = re.compile(" (?=" + punc + ")")
+        self.punc_run_regex = re.compile(punc + "+")
+        self.space_after_punc_regex = re.compile(
+            char_class(Cleaner.punc_set_no_period) + r"|\.(?!\.)")
+        self.punc_runs = {}
+        # whole words, since the sentence only has single spaces at this point
+        self.group_regex = re.compile(
+            r"(?<!\S)" + char_class(group_special) +
+            "{" + str(group_size) + r",}(?!\S)")
+        self.isolated_regex = re.compile(
+            r"(?<!\S)" + char_class(isolated_special) + r"(?!\S)")
+
+    def __call__(self, sentence):
+        return self.clean(sentence)
+
+    def clean(self, sentence):
+        sentence = self.preprocess(sentence)
+        if self.normalize is not None:
+            sentence = self.normalize(sentence)
+        return self.clean_normalized(sentence)
+
+    def clean_batch(self, sentences):
+        """Clean a list of sentences, where the normalization is done for all
+        of them at once if normalize_batch is given."""
+        if self.normalize_batch is None:
+            return [self.clean(sentence) for sentence in sentences]
+        sentences = self.normalize_batch(
+            [self.preprocess(sentence) for sentence in sentences])
+        return [self.clean_normalized(sentence) for sentence in sentences]
+
+    def preprocess(self, sentence):
+        for regex, replacement in self.regexs:
+            sentence = regex.sub(replacement, sentence)
+        return sentence
+
+    def clean_normalized(self, sentence):
+        """The steps of the chain after the normalization"""
+        sentence = self.remove_smileys(sentence)
+        if "^" in sentence:
+            sentence = Cleaner.hat_regex.sub("", sentence)
+        if "&" in sentence:
+            sentence = self.html_regex.sub(" ", sentence)
+        sentence = self.clean_punc(sentence)
+        sentence = self.remove_words(self.group_regex, sentence)
+        sentence = Cleaner.special_duplication_regex.sub(r"\1", sentence)
+        sentence = self.remove_words(self.isolated_regex, sentence)
+        return sentence
+
+    def remove_smileys(self, sentence):
+        if self.smiley_regex.search(sentence) is None:
+            return sentence
+        for regex in Cleaner.smiley_regexs:
+            sentence = regex.sub(" ", sentence)
+        for smiley in Cleaner.smileys:
+            sentence = sentence.replace(smiley, " ")
+        return sentence
+
+    @staticmethod
+    def remove_words(regex, sentence):
+        """Remove the words matched by the regex from a sentence with single
+        spaces, which is the same as splitting it, filtering the words and
+        joining them."""
+        sentence, count = regex.subn("", sentence)
+        if count > 0:
+            sentence = Cleaner.spaces_regex.sub(" ", sentence).strip()
+        return sentence
+
+    def clean_punc(self, sentence):
+        """Cleaner.clean_punc with a single pass for each step. The removal of
+        duplicates and the combinations of punctuation never go beyond a
+        sequence of punctuation signs, so each sequence is cleaned on its own
+        and the result is remembered, as only few different ones occur."""
+        sentence = Cleaner.spaces_regex.sub(" ", sentence).strip()
+        sentence = self.space_before_punc_regex.sub("", sentence)
+        sentence = self.punc_run_regex.sub(self.clean_punc_run, sentence)
+        sentence = sentence.lstrip(self.punc_chars)
+        sentence = self.space_after_punc_regex.sub(r"\g<0> ", sentence)
+        sentence = Cleaner.spaces_regex.sub(" ", sentence).strip()
+        return sentence
+
+    def clean_punc_run(self, match):
+        run = match.group()
+        cleaned = self.punc_runs.get(run)
+        if cleaned is None:
+            cleaned = run
+            for c in Cleaner.punc_set_no_period:
+                while c+c in cleaned:
+                    cleaned = cleaned.replace(c+c, c)
+            cleaned = Cleaner.points_regex.sub("...", cleaned)
+            for regex, replacement in Cleaner.punc_combination_regexs:
+                cleaned = regex.sub(replacement, cleaned)
+            if len(self.punc_runs) < self.max_cached_runs:
+                self.punc_runs[run] = cleaned
+        return cleaned
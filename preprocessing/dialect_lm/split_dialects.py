@@ -3,20 +3,30 @@
 # and test set.
 # The second does the same, but on the predictions from the entire twitter
 # module.
+# The near duplicates (e.g. retweets with another url) are clustered beforehand
+# and each cluster ends up in a single set, the same for both splits.
 
 ###  Settings  #################################################################
 dataset_path = "data/twitter_all_predicted.csv"
 label_names = "BE,CE,EA,GR,NW,VS,ZH".split(',')
 out_dir = "data/dialect_specific"
+# minimum similarity of near duplicates, None to split the sentences separately
+near_dedup_threshold = 0.7
 ################################################################################
 
 import pandas as pd
 from preprocessing.split_dataset import *
+from preprocessing.near_dedup import cluster_sentences, is_representative
 import os
 from pathlib import Path
 
 df = pd.read_csv(dataset_path, sep="\t")
 
+if near_dedup_threshold is not None:
+    df["cluster"] = cluster_sentences(df.sentence.astype(str).tolist(),
+                                      threshold=near_dedup_threshold)
+    print(f"Near duplicates : {(~is_representative(df.cluster.values)).sum()}")
+
 #--- Group per known dialect  --------------------------------------------------
 
 print("*"*80 + "\nCompute known dialects sets\n" + "*"*80)
@@ -26,7 +36,7 @@ all_known = dict()
 for dialect in label_names:
     print(dialect)
     sub = df[df.dialect == dialect]
-    sets = split_dataset(sub, 0.8, 0.1)
+    sets = split_dataset(sub, 0.8, 0.1, groups=sub.get("cluster"))
 
     dialect_dir = os.path.join(known_path, dialect)
     Path(dialect_dir).mkdir(parents=True, exist_ok=True)
@@ -48,7 +58,7 @@ all_pred = dict()
 for dialect in label_names:
     print(dialect)
     sub = df[df.dialect_predicted == dialect]
-    sets = split_dataset(sub, 0.8, 0.1)
+    sets = split_dataset(sub, 0.8, 0.1, groups=sub.get("cluster"))
 
     dialect_dir = os.path.join(predicted_path, dialect)
     Path(dialect_dir).mkdir(parents=True, exist_ok=True)
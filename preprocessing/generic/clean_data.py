@@ -6,17 +6,32 @@
 # All files are saved as .txt files.
 # The goal is to compare how generalizable the swisstext/leipzig corpus is
 # compared to a swisstext/leipzig/twitter corpus.
+#
+# The corpora are first cleaned in a streaming fashion: they are read in chunks,
+# cleaned by a pool of processes and the cleaned sentences are written to
+# --cleaned-dir as soon as they are done. Only the (much smaller) cleaned corpora
+# are loaded for the splitting.
+#
+# The near duplicates (sentences that only differ by a few characters) are
+# found across the Leipzig, Swisstext and Twitter corpora with
+# --near-duplicates: "remove" only keeps the first sentence of each cluster and
+# "group" keeps them all but puts each cluster in a single set, so that no near
+# duplicate of a test sentence is trained on. By default only the exact
+# duplicates within each set are removed.
 
-import pandas as pd
+import argparse
+import multiprocessing
 import numpy as np
 import random
 import os
+from functools import partial
 from pathlib import Path
 from preprocessing.cleaner import *
-from tqdm import tqdm
+from preprocessing.pipeline import process_file
+from preprocessing.near_dedup import assign_splits, cluster_chunks
 from phrasal.norm_punc import *
 
-###  Settings  #################################################################
+###  Default settings  #########################################################
 leipzig_path = "data/leipzig_over_99.csv"
 swisstext_path = "data/swisscrawl_over_99.csv"
 twitter_path = "data/twitter_over_99.csv"
@@ -24,6 +39,13 @@ whatsapp_path = "data/whatsapp_over_99.csv"
 output_dir_sl = "data/swisstext_leipzig"
 output_dir_tsl = "data/twitter_swisstext_leipzig"
 output_dir_whatsapp = "data/whatsapp/"
+cleaned_dir = "data/cleaned"
+min_words = 5
+max_special_chars = 3
+chunk_size = 10000
+num_workers = multiprocessing.cpu_count()
+near_duplicates = "keep"
+near_dedup_threshold = 0.7
 ################################################################################
 
 # regexs to remove urls, mentions, and hashtags
@@ -34,72 +56,35 @@ preprocessing_regex = [('https?[\w\.\:\-\/]*($|\s)', ' '),
 
 # good characters set. Any sentence with characters not in this set will be
 # removed.
+chars_ok_sentence = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+chars_ok_sentence += "ÀÁÂÄÈÉÊËÍÌÎÏÓÒÔÖÚÙÛÜàáâäèéêëìíîïôöòóüùúûÿ"
+chars_ok_sentence += " -,.?!0123456789%&\"\'()/$*+:;<=>[]\\^_{}|\\~€°²#"
+chars_ok_sentence = set(chars_ok_sentence)
+
+# characters that are not counted as special characters within words.
+chars_ok_word = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+chars_ok_word += "ÀÁÂÄÈÉÊËÍÌÎÏÓÒÔÖÚÙÛÜàáâäèéêëìíîïôöòóüùúûÿ"
+chars_ok_word += "0123456789"
+chars_ok_word = set(chars_ok_word)
 
-def remove_sentences_with_special_chars(sentences):
-    chars_ok = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
-    chars_ok += "ÀÁÂÄÈÉÊËÍÌÎÏÓÒÔÖÚÙÛÜàáâäèéêëìíîïôöòóüùúûÿ"
-    chars_ok += " -,.?!0123456789%&\"\'()/$*+:;<=>[]\\^_{}|\\~€°²#"
-    chars_ok = set(chars_ok)
 
-    return [x for x in sentences if len(set(x).difference(chars_ok))==0]
+def remove_sentences_with_special_chars(sentences):
+    return [x for x in sentences if len(set(x).difference(chars_ok_sentence))==0]
 
 def remove_sentences_with_special_words(sentences, max_char):
     """Remove sentences with words containing too much special characters.
     """
-
-    chars_ok = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
-    chars_ok += "ÀÁÂÄÈÉÊËÍÌÎÏÓÒÔÖÚÙÛÜàáâäèéêëìíîïôöòóüùúûÿ"
-    chars_ok += "0123456789"
-    chars_ok = set(chars_ok)
-
     res = []
-    for sentence in tqdm(sentences):
+    for sentence in sentences:
         words = sentence.split()
         ok = True
         for word in words:
-            if len([c for c in word if c not in chars_ok]) > max_char:
+            if len([c for c in word if c not in chars_ok_word]) > max_char:
                 ok = False
         if ok:
             res.append(sentence)
     return res
 
-# load the datasets
-df_leipzig = pd.read_csv(leipzig_path, header=None, sep="\t")
-leipzig_sentences = list(df_leipzig.iloc[:, 0])
-print(f"leipzig length : {len(leipzig_sentences)}")
-leipzig_sentences = remove_sentences_with_special_chars(leipzig_sentences)
-leipzig_sentences = remove_sentences_with_special_words(leipzig_sentences, 3)
-print(f"leipzig filtered length : {len(leipzig_sentences)}")
-print(leipzig_sentences[0])
-print(leipzig_sentences[-1])
-
-df_swisstext = pd.read_csv(swisstext_path, header=None, sep="\t")
-swisstext_sentences = list(df_swisstext.iloc[:, 0])
-print(f"swisstext length : {len(swisstext_sentences)}")
-swisstext_sentences = remove_sentences_with_special_chars(swisstext_sentences)
-swisstext_sentences = remove_sentences_with_special_words(swisstext_sentences, 3)
-print(f"swisstext filtered length : {len(swisstext_sentences)}")
-print(swisstext_sentences[0])
-print(swisstext_sentences[-1])
-
-df_twitter = pd.read_csv(twitter_path, header=None, sep="\t")
-twitter_sentences = list(df_twitter.iloc[:, 0])
-print(f"twitter length : {len(twitter_sentences)}")
-twitter_sentences = remove_sentences_with_special_chars(twitter_sentences)
-twitter_sentences = remove_sentences_with_special_words(twitter_sentences, 3)
-print(f"twitter filtered length : {len(twitter_sentences)}")
-print(twitter_sentences[0])
-print(twitter_sentences[-1])
-
-df_whatsapp = pd.read_csv(whatsapp_path, header=None, sep="\t")
-whatsapp_sentences = list(df_whatsapp.iloc[:, 0])
-print(f"whatsapp length : {len(whatsapp_sentences)}")
-whatsapp_sentences = remove_sentences_with_special_chars(whatsapp_sentences)
-whatsapp_sentences = remove_sentences_with_special_words(whatsapp_sentences, 3)
-print(f"whatsapp filtered length : {len(whatsapp_sentences)}")
-print(whatsapp_sentences[0])
-print(whatsapp_sentences[-1])
-
 ### cleaning ###
 
 def clean_text(text):
@@ -114,22 +99,60 @@ def clean_text(text):
     text = Cleaner.remove_isolated_special_chars(text)
     return text
 
-leipzig_sentences = [clean_text(x) for x in tqdm(leipzig_sentences)]
-leipzig_sentences = [x for x in leipzig_sentences if len(x.split()) >= 5]
-print(f"leipzig final length : {len(leipzig_sentences)}")
-swisstext_sentences = [clean_text(x) for x in tqdm(swisstext_sentences)]
-swisstext_sentences = [x for x in swisstext_sentences if len(x.split()) >= 5]
-print(f"swisstext final length : {len(swisstext_sentences)}")
-twitter_sentences = [clean_text(x) for x in tqdm(twitter_sentences)]
-twitter_sentences = [x for x in twitter_sentences if len(x.split()) >= 5]
-print(f"twitter final length : {len(twitter_sentences)}")
-whatsapp_sentences = [clean_text(x) for x in tqdm(whatsapp_sentences)]
-whatsapp_sentences = [x for x in whatsapp_sentences if len(x.split()) >= 5]
-print(f"whatsapp final length : {len(whatsapp_sentences)}")
+# clean_text with precompiled and merged patterns, which gives the same output
+cleaner = CompiledCleaner(
+    preprocessing_regex,
+    normalize=partial(normalize_text, strip_emojis=True),
+    normalize_batch=partial(normalize_batch, strip_emojis=True))
+
+def clean_chunk(sentences, min_words=min_words,
+                max_special_chars=max_special_chars):
+    """Filter and clean a chunk of sentences, keeping the cleaned sentences that
+    have at least min_words words. This is the work done by each process of the
+    pipeline.
+    """
+    sentences = remove_sentences_with_special_chars(sentences)
+    sentences = remove_sentences_with_special_words(sentences,
+                                                    max_special_chars)
+    sentences = cleaner.clean_batch(sentences)
+    return [x for x in sentences if len(x.split()) >= min_words]
+
+def clean_corpus(name, input_path, options):
+    """Clean a corpus into the cleaned directory and return the path of the
+    cleaned file.
+    """
+    output_path = os.path.join(options.cleaned_dir, name + ".txt")
+    num_read, num_written = process_file(
+        input_path,
+        output_path,
+        partial(clean_chunk, min_words=options.min_words,
+                max_special_chars=options.max_special_chars),
+        chunk_size=options.chunk_size,
+        num_workers=options.num_workers,
+        ordered=not options.unordered,
+        desc=name,
+    )
+    print(f"{name} length : {num_read}")
+    print(f"{name} final length : {num_written}")
+    return output_path
+
+def read_cleaned(path):
+    with open(path, "r", encoding="utf8") as f:
+        return [line.rstrip("\n") for line in f]
 
 ### splitting into sets ###
 
-def split_sets(sentences, train_proportion, valid_proportion):
+def split_sets(sentences, train_proportion, valid_proportion, clusters=None,
+               seed=0):
+    if clusters is not None:
+        # each cluster of near duplicates goes to a single set
+        splits = assign_splits(clusters, train_proportion, valid_proportion,
+                               seed=seed)
+        sets = [[x for x, split in zip(sentences, splits) if split == i]
+                for i in range(3)]
+        for x in sets:
+            random.shuffle(x)
+        return sets
     random.shuffle(sentences)
     first_break = train_proportion
     second_break = train_proportion + valid_proportion
@@ -137,67 +160,215 @@ def split_sets(sentences, train_proportion, valid_proportion):
                                 int(second_break*len(sentences))])
     return [list(x) for x in sets]
 
-leipzig_sets = split_sets(leipzig_sentences, 0.8, 0.1)
-print("Leipzig")
-for i, name in enumerate(["Train", "Valid", "Test"]):
-    print(f"{name} : {len(leipzig_sets[i])}")
-swisstext_sets = split_sets(swisstext_sentences, 0.8, 0.1)
-print("Swisstext")
-for i, name in enumerate(["Train", "Valid", "Test"]):
-    print(f"{name} : {len(swisstext_sets[i])}")
-twitter_sets = split_sets(twitter_sentences, 0.8, 0.1)
-print("Twitter")
-for i, name in enumerate(["Train", "Valid", "Test"]):
-    print(f"{name} : {len(twitter_sets[i])}")
-
-### merging ###
-
-print("Swisstext / Leipzig")
-sl_sets = dict()
-sl_sets["train"] = list(set(leipzig_sets[0] + swisstext_sets[0]))
-random.shuffle(sl_sets["train"])
-print(f"Train : {len(sl_sets['train'])}")
-sl_sets["valid"] = list(set(leipzig_sets[1] + swisstext_sets[1]))
-random.shuffle(sl_sets["valid"])
-print(f"Valid : {len(sl_sets['valid'])}")
-sl_sets["test"] = list(set(leipzig_sets[2] + swisstext_sets[2]))
-random.shuffle(sl_sets["test"])
-print(f"Test : {len(sl_sets['test'])}")
-sl_sets["test_20k"] = sl_sets["test"][:20000]
-
-print("Twitter / Swisstext / Leipzig")
-tsl_sets = dict()
-tsl_sets["train"] = list(set(sl_sets["train"] + twitter_sets[0]))
-random.shuffle(tsl_sets["train"])
-print(f"Train : {len(tsl_sets['train'])}")
-tsl_sets["valid"] = list(set(sl_sets["valid"] + twitter_sets[1]))
-random.shuffle(tsl_sets["valid"])
-print(f"Valid : {len(tsl_sets['valid'])}")
-tsl_sets["test"] = list(set(sl_sets["test"] + twitter_sets[2]))
-random.shuffle(tsl_sets["test"])
-print(f"Test : {len(tsl_sets['test'])}")
-tsl_sets["test_20k"] = tsl_sets["test"][:20000]
-
-print("Whatsapp")
-w_sentences = list(set(whatsapp_sentences))
-print(f"Full : {len(w_sentences)}")
-
-### Saving on disk ###
-
-Path(output_dir_sl).mkdir(parents=True, exist_ok=True)
-Path(output_dir_tsl).mkdir(parents=True, exist_ok=True)
-Path(output_dir_whatsapp).mkdir(parents=True, exist_ok=True)
-
-for name in ["train", "valid", "test", "test_20k"]:
-    path = os.path.join(output_dir_sl, name + ".csv")
-    with open(path, "w", encoding="utf8") as f:
-        f.write('\n'.join(sl_sets[name]) + '\n')
+### near duplicates ###
+
+def near_duplicate_clusters(corpora, options):
+    """Cluster the near duplicates of all the corpora at once, so that the near
+    duplicates across corpora are found too.
+
+    Parameters
+        corpora | List[List[str]]
+            Sentences of each corpus
+        options | argparse.Namespace
+            Options of the script
+
+    Returns
+        clusters | List[np.ndarray[int64]]
+            Cluster of each sentence of each corpus, i.e. the index of the first
+            sentence of the cluster among all the corpora
+        offsets | List[int]
+            Index of the first sentence of each corpus among all the corpora
+    """
+    chunks = (corpus[i:i+options.chunk_size] for corpus in corpora
+              for i in range(0, len(corpus), options.chunk_size))
+    clusters = cluster_chunks(chunks, threshold=options.near_dedup_threshold,
+                              num_workers=options.num_workers,
+                              desc="near duplicates")
+    offsets = np.cumsum([0] + [len(x) for x in corpora]).tolist()
+    return ([clusters[offsets[i]:offsets[i+1]] for i in range(len(corpora))],
+            offsets[:-1])
+
+def remove_near_duplicates(sentences, clusters, offset):
+    """Keep the first sentence of each cluster, where offset is the index of
+    the first sentence of the corpus among all the corpora.
+    """
+    keep = clusters == offset + np.arange(len(sentences))
+    return [x for x, k in zip(sentences, keep) if k]
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--leipzig", dest="leipzig", default=leipzig_path,
+                        help=f"Leipzig corpus [Default: {leipzig_path}]")
+    parser.add_argument("--swisstext", dest="swisstext",
+                        default=swisstext_path,
+                        help=f"Swisstext corpus [Default: {swisstext_path}]")
+    parser.add_argument("--twitter", dest="twitter", default=twitter_path,
+                        help=f"Twitter corpus [Default: {twitter_path}]")
+    parser.add_argument("--whatsapp", dest="whatsapp", default=whatsapp_path,
+                        help=f"WhatsApp corpus [Default: {whatsapp_path}]")
+    parser.add_argument("--output-sl", dest="output_dir_sl",
+                        default=output_dir_sl,
+                        help=("Output directory of the Swisstext/Leipzig sets "
+                              f"[Default: {output_dir_sl}]"))
+    parser.add_argument("--output-tsl", dest="output_dir_tsl",
+                        default=output_dir_tsl,
+                        help=("Output directory of the Twitter/Swisstext/Leipzig"
+                              f" sets [Default: {output_dir_tsl}]"))
+    parser.add_argument("--output-whatsapp", dest="output_dir_whatsapp",
+                        default=output_dir_whatsapp,
+                        help=("Output directory of the WhatsApp set "
+                              f"[Default: {output_dir_whatsapp}]"))
+    parser.add_argument("--cleaned-dir", dest="cleaned_dir",
+                        default=cleaned_dir,
+                        help=("Directory of the cleaned corpora "
+                              f"[Default: {cleaned_dir}]"))
+    parser.add_argument("--min-words", dest="min_words", default=min_words,
+                        type=int,
+                        help=("Minimum number of words of a cleaned sentence "
+                              f"[Default: {min_words}]"))
+    parser.add_argument("--max-special-chars", dest="max_special_chars",
+                        default=max_special_chars, type=int,
+                        help=("Maximum number of special characters in a word "
+                              f"[Default: {max_special_chars}]"))
+    parser.add_argument("-c", "--chunk-size", dest="chunk_size",
+                        default=chunk_size, type=int,
+                        help=("Number of sentences cleaned at once by a process "
+                              f"[Default: {chunk_size}]"))
+    parser.add_argument("-w", "--workers", dest="num_workers",
+                        default=num_workers, type=int,
+                        help=("Number of processes for the cleaning "
+                              f"[Default: {num_workers}]"))
+    parser.add_argument("--unordered", dest="unordered", action="store_true",
+                        help=("Write the cleaned chunks as soon as they are done "
+                              "rather than in the order of the corpus"))
+    parser.add_argument("--skip-cleaning", dest="skip_cleaning",
+                        action="store_true",
+                        help=("Reuse the cleaned corpora of a previous run and "
+                              "only split them"))
+    parser.add_argument("--near-duplicates", dest="near_duplicates",
+                        default=near_duplicates,
+                        choices=["keep", "remove", "group"],
+                        help=("What to do with the near duplicates across the "
+                              "Leipzig, Swisstext and Twitter corpora: keep "
+                              "them, remove them (except the first of each "
+                              "cluster), or keep each cluster in a single set "
+                              f"[Default: {near_duplicates}]"))
+    parser.add_argument("--near-dedup-threshold", dest="near_dedup_threshold",
+                        default=near_dedup_threshold, type=float,
+                        help=("Minimum estimated similarity of two near "
+                              f"duplicates [Default: {near_dedup_threshold}]"))
+    parser.add_argument("-s", "--seed", dest="seed", type=int,
+                        help="Seed for the random splitting")
+    return parser.parse_args()
+
+def main():
+    options = parse_args()
+    if options.seed is not None:
+        random.seed(options.seed)
+
+    corpora = {"leipzig": options.leipzig, "swisstext": options.swisstext,
+               "twitter": options.twitter, "whatsapp": options.whatsapp}
+    Path(options.cleaned_dir).mkdir(parents=True, exist_ok=True)
+    cleaned = {}
+    for name, path in corpora.items():
+        if options.skip_cleaning:
+            cleaned[name] = os.path.join(options.cleaned_dir, name + ".txt")
+        else:
+            cleaned[name] = clean_corpus(name, path, options)
+
+    leipzig_sentences = read_cleaned(cleaned["leipzig"])
+    swisstext_sentences = read_cleaned(cleaned["swisstext"])
+    twitter_sentences = read_cleaned(cleaned["twitter"])
+    whatsapp_sentences = read_cleaned(cleaned["whatsapp"])
+
+    leipzig_clusters = swisstext_clusters = twitter_clusters = None
+    cluster_seed = 0
+    if options.near_duplicates != "keep":
+        clusters, offsets = near_duplicate_clusters(
+            [leipzig_sentences, swisstext_sentences, twitter_sentences],
+            options)
+        if options.near_duplicates == "remove":
+            leipzig_sentences = remove_near_duplicates(
+                leipzig_sentences, clusters[0], offsets[0])
+            swisstext_sentences = remove_near_duplicates(
+                swisstext_sentences, clusters[1], offsets[1])
+            twitter_sentences = remove_near_duplicates(
+                twitter_sentences, clusters[2], offsets[2])
+            num_removed = offsets[-1] + len(clusters[-1]) - \
+                          len(leipzig_sentences) - len(swisstext_sentences) - \
+                          len(twitter_sentences)
+            print(f"Near duplicates removed : {num_removed}")
+        else:
+            leipzig_clusters, swisstext_clusters, twitter_clusters = clusters
+            cluster_seed = random.getrandbits(32)
+
+    leipzig_sets = split_sets(leipzig_sentences, 0.8, 0.1, leipzig_clusters,
+                              cluster_seed)
+    print("Leipzig")
+    for i, name in enumerate(["Train", "Valid", "Test"]):
+        print(f"{name} : {len(leipzig_sets[i])}")
+    swisstext_sets = split_sets(swisstext_sentences, 0.8, 0.1,
+                                swisstext_clusters, cluster_seed)
+    print("Swisstext")
+    for i, name in enumerate(["Train", "Valid", "Test"]):
+        print(f"{name} : {len(swisstext_sets[i])}")
+    twitter_sets = split_sets(twitter_sentences, 0.8, 0.1, twitter_clusters,
+                              cluster_seed)
+    print("Twitter")
+    for i, name in enumerate(["Train", "Valid", "Test"]):
+        print(f"{name} : {len(twitter_sets[i])}")
+
+    ### merging ###
+
+    print("Swisstext / Leipzig")
+    sl_sets = dict()
+    sl_sets["train"] = list(set(leipzig_sets[0] + swisstext_sets[0]))
+    random.shuffle(sl_sets["train"])
+    print(f"Train : {len(sl_sets['train'])}")
+    sl_sets["valid"] = list(set(leipzig_sets[1] + swisstext_sets[1]))
+    random.shuffle(sl_sets["valid"])
+    print(f"Valid : {len(sl_sets['valid'])}")
+    sl_sets["test"] = list(set(leipzig_sets[2] + swisstext_sets[2]))
+    random.shuffle(sl_sets["test"])
+    print(f"Test : {len(sl_sets['test'])}")
+    sl_sets["test_20k"] = sl_sets["test"][:20000]
+
+    print("Twitter / Swisstext / Leipzig")
+    tsl_sets = dict()
+    tsl_sets["train"] = list(set(sl_sets["train"] + twitter_sets[0]))
+    random.shuffle(tsl_sets["train"])
+    print(f"Train : {len(tsl_sets['train'])}")
+    tsl_sets["valid"] = list(set(sl_sets["valid"] + twitter_sets[1]))
+    random.shuffle(tsl_sets["valid"])
+    print(f"Valid : {len(tsl_sets['valid'])}")
+    tsl_sets["test"] = list(set(sl_sets["test"] + twitter_sets[2]))
+    random.shuffle(tsl_sets["test"])
+    print(f"Test : {len(tsl_sets['test'])}")
+    tsl_sets["test_20k"] = tsl_sets["test"][:20000]
+
+    print("Whatsapp")
+    w_sentences = list(set(whatsapp_sentences))
+    print(f"Full : {len(w_sentences)}")
+
+    ### Saving on disk ###
+
+    Path(options.output_dir_sl).mkdir(parents=True, exist_ok=True)
+    Path(options.output_dir_tsl).mkdir(parents=True, exist_ok=True)
+    Path(options.output_dir_whatsapp).mkdir(parents=True, exist_ok=True)
+
+    for name in ["train", "valid", "test", "test_20k"]:
+        path = os.path.join(options.output_dir_sl, name + ".csv")
+        with open(path, "w", encoding="utf8") as f:
+            f.write('\n'.join(sl_sets[name]) + '\n')
+
+    for name in ["train", "valid", "test", "test_20k"]:
+        path = os.path.join(options.output_dir_tsl, name + ".csv")
+        with open(path, "w", encoding="utf8") as f:
+            f.write('\n'.join(tsl_sets[name]) + '\n')
 
-for name in ["train", "valid", "test", "test_20k"]:
-    path = os.path.join(output_dir_tsl, name + ".csv")
+    path = os.path.join(options.output_dir_whatsapp, "full.csv")
     with open(path, "w", encoding="utf8") as f:
-        f.write('\n'.join(tsl_sets[name]) + '\n')
+        f.write('\n'.join(w_sentences) + '\n')
 
-path = os.path.join(output_dir_whatsapp, "full.csv")
-with open(path, "w", encoding="utf8") as f:
-    f.write('\n'.join(w_sentences) + '\n')
+if __name__ == "__main__":
+    main()
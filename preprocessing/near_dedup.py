@@ -0,0 +1,464 @@
+# This script finds the near duplicates of a corpus, i.e. the sentences that
+# only differ by a few characters (punctuation, case, a removed url, a typo...),
+# which are not caught by the exact deduplication with set(). It writes the
+# corpus without the near duplicates (the first sentence of each cluster is
+# kept) and/or the cluster of each sentence, which can be used to put all the
+# sentences of a cluster in the same set (see assign_splits).
+#
+# The near duplicates are found with MinHash/LSH: each sentence is normalised
+# (lowercased, urls and mentions removed, only letters and digits, or left as
+# it is if nothing remains) and represented by its character shingles. The
+# MinHash signature of a sentence has num_perm values and is split into bands,
+# and the sentences that have the same hash for a band are candidates, which
+# are kept if the similarity estimated from their signatures is at least the
+# threshold. The clusters are the connected components of the pairs that are
+# kept, and the id of a cluster is the index of its first sentence.
+#
+# The signatures are computed in chunks by a pool of processes and written to
+# the work directory as soon as they are done. The clustering then loads one
+# band at a time and only uses numpy arrays (about 40 bytes per sentence), so
+# that it scales to tens of millions of sentences.
+
+import argparse
+import csv
+import io
+import multiprocessing
+import os
+import re
+import sys
+import tempfile
+from functools import partial
+import numpy as np
+from tqdm import tqdm
+from preprocessing.pipeline import map_chunks, read_chunks
+
+###  Default settings  #########################################################
+num_perm = 128
+num_bands = 16
+shingle_size = 5
+similarity_threshold = 0.7
+chunk_size = 10000
+num_workers = multiprocessing.cpu_count()
+seed = 1
+################################################################################
+
+# urls and mentions, which often differ between otherwise identical tweets
+ignored_regex = re.compile(r"https?\S*|www\.\S*|@\S*")
+non_word_regex = re.compile(r"[\W_]+")
+
+shingle_prime = np.uint64(0x100000001b3)
+band_prime = np.uint64(0x9e3779b97f4a7c15)
+
+def normalise(sentence):
+    sentence = ignored_regex.sub(" ", sentence.lower())
+    return non_word_regex.sub(" ", sentence).strip()
+
+def mix64(x):
+    """Finaliser of splitmix64, which spreads the bits of uint64 hashes"""
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+class MinHasher:
+    """MinHash signatures of the character shingles of sentences. The
+    permutations are multiply-shift hash functions h(x) = (a * x + b) >> 32 of
+    the 64 bits hash of each shingle.
+    """
+
+    # maximum number of shingles hashed at once, which bounds the memory of the
+    # shingles x permutations matrix (32 MB with 128 permutations)
+    max_shingles = 1 << 15
+
+    def __init__(self, num_perm=num_perm, shingle_size=shingle_size, seed=seed):
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(0, 2**64, num_perm, dtype=np.uint64,
+                              endpoint=False) | np.uint64(1)
+        self.b = rng.integers(0, 2**64, num_perm, dtype=np.uint64,
+                              endpoint=False)
+
+    def shingle_hashes(self, sentences):
+        """Hash the shingles of all the sentences at once. The sentences shorter
+        than a shingle are padded, so that each sentence has at least one. The
+        sentences without any letter or digit (e.g. only punctuation, emojis or a
+        url) are hashed as they are, since their normalised forms are all empty,
+        which would make them a single cluster.
+
+        Parameters
+            sentences | List[str]
+                Sentences to hash
+
+        Returns
+            hashes | np.ndarray[uint64]
+                Hashes of the shingles of all the sentences, one after the other
+            offsets | np.ndarray[int64]
+                Index of the first shingle of each sentence, followed by the
+                number of shingles
+        """
+        k = self.shingle_size
+        texts = [(normalise(x) or x).ljust(k, "\0") for x in sentences]
+        codes = np.frombuffer("".join(texts).encode("utf-32-le"),
+                              dtype=np.uint32).astype(np.uint64)
+        lengths = np.array([len(x) for x in texts], dtype=np.int64)
+        num_shingles = lengths - k + 1
+        offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+        np.cumsum(num_shingles, out=offsets[1:])
+        # hash of the shingle starting at each character, including the ones
+        # that overlap two sentences, which are dropped below
+        n = len(codes) - k + 1
+        hashes = np.zeros(n, dtype=np.uint64)
+        for j in range(k):
+            hashes = hashes * shingle_prime + codes[j:j+n]
+        starts = np.cumsum(lengths) - lengths
+        positions = np.arange(offsets[-1]) + \
+                    np.repeat(starts - offsets[:-1], num_shingles)
+        return mix64(hashes[positions]), offsets
+
+    def signatures(self, sentences):
+        """MinHash signature of each sentence, as an array of shape
+        (len(sentences), num_perm)
+        """
+        signatures = np.empty((len(sentences), self.num_perm), dtype=np.uint32)
+        if len(sentences) == 0:
+            return signatures
+        hashes, offsets = self.shingle_hashes(sentences)
+        counts = np.diff(offsets)
+        # The sentences are grouped by number of shingles and the shingles of
+        # the shorter sentences of a group are padded with their last one, which
+        # doesn't change the minimums. Taking the minimums of a padded block is
+        # much faster than np.minimum.reduceat.
+        order = np.argsort(counts, kind="stable")
+        sorted_counts = counts[order]
+        buffer = np.empty(self.max_shingles * self.num_perm, dtype=np.uint64)
+        start = 0
+        while start < len(order):
+            # the following sentences with at most max_shingles padded shingles
+            sizes = np.arange(1, len(order) - start + 1) * sorted_counts[start:]
+            end = start + max(1, np.searchsorted(sizes, self.max_shingles,
+                                                 side="right"))
+            group = order[start:end]
+            length = sorted_counts[end-1]
+            positions = offsets[group, None] + \
+                        np.minimum(np.arange(length), counts[group, None] - 1)
+            size = len(group) * length * self.num_perm
+            if size > len(buffer):
+                buffer = np.empty(size, dtype=np.uint64)
+            permuted = buffer[:size].reshape(len(group), length, self.num_perm)
+            np.multiply(hashes[positions][:, :, None], self.a, out=permuted)
+            permuted += self.b
+            # the shift keeps the order, hence is only applied to the minimums
+            signatures[group] = permuted.min(axis=1) >> np.uint64(32)
+            start = end
+        return signatures
+
+def band_hashes(signatures, num_bands):
+    """Hash of each band of the signatures, as an array of shape
+    (len(signatures), num_bands). The bands have num_perm // num_bands rows.
+    """
+    rows = signatures.shape[1] // num_bands
+    bands = signatures[:, :num_bands*rows].astype(np.uint64) \
+            .reshape(len(signatures), num_bands, rows)
+    hashes = np.zeros((len(signatures), num_bands), dtype=np.uint64)
+    for j in range(rows):
+        hashes = (hashes ^ bands[:, :, j]) * band_prime
+    return mix64(hashes)
+
+def hash_chunk(sentences, hasher, num_bands=num_bands):
+    """Signatures and band hashes of a chunk of sentences. This is the work done
+    by each process.
+    """
+    signatures = hasher.signatures(sentences)
+    return signatures, band_hashes(signatures, num_bands)
+
+### clustering ###
+
+def find_roots(parent):
+    """Compress the paths of the union-find forest in place, so that each
+    sentence points to the root of its tree, and return it.
+    """
+    while True:
+        grandparent = parent[parent]
+        if np.array_equal(grandparent, parent):
+            return parent
+        parent[:] = grandparent
+
+def union(parent, first, second):
+    """Merge the trees of each pair (first[i], second[i]). The root of a tree is
+    always its smallest index, i.e. the first sentence of the cluster.
+    """
+    while len(first) > 0:
+        find_roots(parent)
+        first_roots = parent[first]
+        second_roots = parent[second]
+        differ = first_roots != second_roots
+        first, second = first[differ], second[differ]
+        lower = np.minimum(first_roots[differ], second_roots[differ])
+        upper = np.maximum(first_roots[differ], second_roots[differ])
+        # a root merged with several trees at once takes the smallest one, the
+        # others are merged in the next iteration
+        np.minimum.at(parent, upper, lower)
+
+def candidate_pairs(band):
+    """Pairs of sentences with the same hash in the band, as the first sentence
+    with that hash and each of the others.
+    """
+    order = np.argsort(band, kind="stable")
+    sorted_band = band[order]
+    is_first = np.empty(len(band), dtype=bool)
+    is_first[:1] = True
+    np.not_equal(sorted_band[1:], sorted_band[:-1], out=is_first[1:])
+    first = order[np.flatnonzero(is_first)][np.cumsum(is_first) - 1]
+    return first[~is_first], order[~is_first]
+
+def similar_pairs(signatures, first, second, threshold, batch_size=100000):
+    """Keep the pairs whose similarity, estimated from their signatures, is at
+    least the threshold
+    """
+    keep = np.empty(len(first), dtype=bool)
+    for i in range(0, len(first), batch_size):
+        a = signatures[first[i:i+batch_size]]
+        b = signatures[second[i:i+batch_size]]
+        keep[i:i+batch_size] = (a == b).mean(axis=1) >= threshold
+    return first[keep], second[keep]
+
+def cluster_signatures(bands, signatures, threshold=similarity_threshold):
+    """Cluster the sentences from their band hashes and signatures.
+
+    Parameters
+        bands | Iterable[np.ndarray[uint64]]
+            Hashes of each band, one array per band with a hash per sentence
+        signatures | np.ndarray[uint32]
+            Signatures of the sentences, which can be memory mapped
+        threshold | float
+            Minimum estimated similarity of two near duplicates
+
+    Returns
+        np.ndarray[int64]
+            Cluster of each sentence, i.e. the index of the first sentence of
+            the cluster
+    """
+    parent = np.arange(len(signatures), dtype=np.int64)
+    for band in bands:
+        first, second = candidate_pairs(band)
+        # the pairs that are already in the same cluster aren't checked again
+        find_roots(parent)
+        new = parent[first] != parent[second]
+        first, second = similar_pairs(signatures, first[new], second[new],
+                                      threshold)
+        union(parent, first, second)
+    return find_roots(parent)
+
+def cluster_chunks(chunks, threshold=similarity_threshold, num_perm=num_perm,
+                   num_bands=num_bands, shingle_size=shingle_size,
+                   num_workers=num_workers, work_dir=None, desc=None):
+    """Find the clusters of near duplicates among the sentences of the chunks.
+    The signatures are computed by a pool of processes and stored in the work
+    directory, so that only one chunk of sentences is held at a time.
+
+    Parameters
+        chunks | Iterable[List[str]]
+            Chunks of sentences
+        threshold | float
+            Minimum estimated similarity of two near duplicates
+        num_perm | int
+            Number of values of the signatures
+        num_bands | int
+            Number of bands of the LSH, where more bands find more candidates
+        shingle_size | int
+            Number of characters of the shingles
+        num_workers | int
+            Number of processes computing the signatures
+        work_dir | str, optional
+            Directory of the signatures, a temporary directory if None
+        desc | str, optional
+            Description shown in the progress bar
+
+    Returns
+        np.ndarray[int64]
+            Cluster of each sentence, i.e. the index of the first sentence of
+            the cluster
+    """
+    if work_dir is None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            return cluster_chunks(chunks, threshold, num_perm, num_bands,
+                                  shingle_size, num_workers, tmp_dir, desc)
+    os.makedirs(work_dir, exist_ok=True)
+    hasher = MinHasher(num_perm, shingle_size)
+    signatures_path = os.path.join(work_dir, "signatures.bin")
+    band_paths = [os.path.join(work_dir, f"band_{i}.bin")
+                  for i in range(num_bands)]
+
+    num_sentences = 0
+    signatures_f = open(signatures_path, "wb")
+    band_fs = [open(path, "wb") for path in band_paths]
+    try:
+        with tqdm(desc=desc, unit=" sentences", file=sys.stderr) as pbar:
+            for signatures, bands in map_chunks(
+                    partial(hash_chunk, hasher=hasher, num_bands=num_bands),
+                    chunks, num_workers=num_workers):
+                signatures_f.write(signatures.tobytes())
+                for i, f in enumerate(band_fs):
+                    f.write(bands[:, i].tobytes())
+                num_sentences += len(signatures)
+                pbar.update(len(signatures))
+    finally:
+        signatures_f.close()
+        for f in band_fs:
+            f.close()
+
+    if num_sentences == 0:
+        return np.zeros(0, dtype=np.int64)
+    signatures = np.memmap(signatures_path, dtype=np.uint32, mode="r",
+                           shape=(num_sentences, num_perm))
+    bands = (np.fromfile(path, dtype=np.uint64) for path in band_paths)
+    clusters = cluster_signatures(tqdm(bands, total=num_bands, unit=" bands",
+                                       file=sys.stderr),
+                                  signatures, threshold)
+    del signatures
+    return clusters
+
+def cluster_sentences(sentences, chunk_size=chunk_size, **kwargs):
+    """Find the clusters of near duplicates among the sentences of a list. The
+    keyword arguments are those of cluster_chunks.
+    """
+    chunks = (sentences[i:i+chunk_size]
+              for i in range(0, len(sentences), chunk_size))
+    return cluster_chunks(chunks, **kwargs)
+
+def is_representative(clusters):
+    """Whether each sentence is the first of its cluster, i.e. the sentence kept
+    when the near duplicates are removed.
+    """
+    return clusters == np.arange(len(clusters))
+
+### splitting into sets ###
+
+def cluster_uniform(clusters, seed=0):
+    """A number in [0, 1) for each cluster, which only depends on the cluster
+    and the seed, hence is the same for all its sentences in every call.
+    """
+    offset = np.uint64(seed * int(band_prime) % 2**64)
+    x = np.asarray(clusters).astype(np.uint64) + offset
+    return (mix64(x) >> np.uint64(11)).astype(np.float64) / 2**53
+
+def assign_splits(clusters, train_proportion, valid_proportion, seed=0):
+    """Assign each sentence to the train (0), validation (1) or test (2) set,
+    where all the sentences of a cluster are in the same set. The proportions
+    are those of the clusters, hence only approximately those of the sentences.
+
+    Parameters
+        clusters | np.ndarray[int64]
+            Cluster of each sentence
+        train_proportion | float
+            Proportion of the clusters in the training set
+        valid_proportion | float
+            Proportion of the clusters in the validation set
+        seed | int
+            Seed of the assignment
+
+    Returns
+        np.ndarray[int64]
+            Set of each sentence
+    """
+    breaks = [train_proportion, train_proportion + valid_proportion]
+    return np.searchsorted(breaks, cluster_uniform(clusters, seed),
+                           side="right")
+
+### command line ###
+
+def write_outputs(input_path, clusters, output_path=None, clusters_path=None,
+                  chunk_size=chunk_size, column=0):
+    """Read the input again and write the sentences without near duplicates
+    and/or each sentence with its cluster.
+    """
+    out_f = open(output_path, "w", encoding="utf8") \
+            if output_path is not None else None
+    clusters_f = open(clusters_path, "w", encoding="utf8", newline="") \
+                 if clusters_path is not None else None
+    try:
+        offset = 0
+        for chunk in read_chunks(input_path, chunk_size=chunk_size,
+                                 column=column):
+            chunk_clusters = clusters[offset:offset+len(chunk)]
+            if out_f is not None:
+                keep = chunk_clusters == np.arange(offset, offset+len(chunk))
+                out_f.write("".join(x + "\n" for x, k in zip(chunk, keep) if k))
+            if clusters_f is not None:
+                buffer = io.StringIO()
+                csv.writer(buffer, delimiter="\t", lineterminator="\n") \
+                   .writerows(zip(chunk, chunk_clusters.tolist()))
+                clusters_f.write(buffer.getvalue())
+            offset += len(chunk)
+    finally:
+        if out_f is not None:
+            out_f.close()
+        if clusters_f is not None:
+            clusters_f.close()
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", dest="input", required=True,
+                        help="TSV file of the sentences")
+    parser.add_argument("-o", "--output", dest="output",
+                        help=("Output file of the sentences without the near "
+                              "duplicates, one per line"))
+    parser.add_argument("--clusters", dest="clusters",
+                        help=("Output TSV file of each sentence with its "
+                              "cluster"))
+    parser.add_argument("--column", dest="column", default=0, type=int,
+                        help="Column of the sentences [Default: 0]")
+    parser.add_argument("--threshold", dest="threshold", type=float,
+                        default=similarity_threshold,
+                        help=("Minimum estimated similarity of two near "
+                              f"duplicates [Default: {similarity_threshold}]"))
+    parser.add_argument("--num-perm", dest="num_perm", type=int,
+                        default=num_perm,
+                        help=("Number of values of the MinHash signatures "
+                              f"[Default: {num_perm}]"))
+    parser.add_argument("--bands", dest="num_bands", type=int,
+                        default=num_bands,
+                        help=("Number of bands of the LSH, where more bands find "
+                              "more candidates (at least one band with the "
+                              "same hash) but are slower "
+                              f"[Default: {num_bands}]"))
+    parser.add_argument("--shingle-size", dest="shingle_size", type=int,
+                        default=shingle_size,
+                        help=("Number of characters of the shingles "
+                              f"[Default: {shingle_size}]"))
+    parser.add_argument("-c", "--chunk-size", dest="chunk_size", type=int,
+                        default=chunk_size,
+                        help=("Number of sentences hashed at once by a process "
+                              f"[Default: {chunk_size}]"))
+    parser.add_argument("-w", "--workers", dest="num_workers", type=int,
+                        default=num_workers,
+                        help=f"Number of processes [Default: {num_workers}]")
+    parser.add_argument("--work-dir", dest="work_dir",
+                        help=("Directory of the signatures, a temporary "
+                              "directory if not given"))
+    options = parser.parse_args()
+    if options.output is None and options.clusters is None:
+        parser.error("at least one of --output and --clusters is required")
+    if not 0 < options.num_bands <= options.num_perm:
+        parser.error("--bands must be between 1 and --num-perm")
+    return options
+
+def main():
+    options = parse_args()
+    chunks = read_chunks(options.input, chunk_size=options.chunk_size,
+                         column=options.column)
+    clusters = cluster_chunks(chunks, threshold=options.threshold,
+                              num_perm=options.num_perm,
+                              num_bands=options.num_bands,
+                              shingle_size=options.shingle_size,
+                              num_workers=options.num_workers,
+                              work_dir=options.work_dir, desc="hashing")
+    num_clusters = int(is_representative(clusters).sum())
+    print(f"Sentences : {len(clusters)}")
+    print(f"Clusters : {num_clusters}")
+    print(f"Near duplicates : {len(clusters) - num_clusters}")
+    write_outputs(options.input, clusters, options.output, options.clusters,
+                  chunk_size=options.chunk_size, column=options.column)
+
+if __name__ == "__main__":
+    main()
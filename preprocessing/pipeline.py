@@ -0,0 +1,186 @@
+"""Streaming and parallel processing of large text files.
+
+The sentences are read in chunks, processed by a pool of processes and written as
+soon as they are done, so that the memory stays bounded regardless of the size of the
+file. At most a few chunks per process are in flight at any time.
+"""
+
+import csv
+import sys
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    as_completed,
+    wait,
+)
+
+from tqdm import tqdm
+
+# Some sentences are longer than the default limit of the csv module.
+csv.field_size_limit(sys.maxsize)
+
+
+def read_row_chunks(path, chunk_size=10000, delimiter="\t"):
+    """Read the rows of a CSV/TSV file (without header) lazily in chunks. Empty lines
+    are skipped.
+
+    Parameters
+        path | str
+            Path to the file, - for stdin
+        chunk_size | int
+            Number of rows per chunk
+        delimiter | str
+            Delimiter of the columns
+    """
+    fd = sys.stdin if path == "-" else open(path, "r", encoding="utf8", newline="")
+    try:
+        chunk = []
+        for row in csv.reader(fd, delimiter=delimiter):
+            if len(row) == 0:
+                continue
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if len(chunk) > 0:
+            yield chunk
+    finally:
+        if fd is not sys.stdin:
+            fd.close()
+
+
+def read_chunks(path, chunk_size=10000, column=0, delimiter="\t"):
+    """Read the given column of a CSV/TSV file (without header) lazily in chunks of
+    sentences. Rows without that column are skipped.
+
+    Parameters
+        path | str
+            Path to the file, - for stdin
+        chunk_size | int
+            Number of rows per chunk
+        column | int
+            Index of the column that contains the sentences
+        delimiter | str
+            Delimiter of the columns
+    """
+    for rows in read_row_chunks(path, chunk_size=chunk_size, delimiter=delimiter):
+        chunk = [row[column] for row in rows if len(row) > column]
+        if len(chunk) > 0:
+            yield chunk
+
+
+def map_chunks(fn, chunks, num_workers=1, ordered=True, max_pending=None):
+    """Apply the function to every chunk, with a pool of processes if there is more
+    than one worker. Unlike Pool.imap, the chunks are only read as the results are
+    consumed, so that the whole file is never held in memory.
+
+    Parameters
+        fn | Callable[[List[str]], List[str]]
+            Function applied to each chunk, which must be picklable (e.g. a module
+            level function or a functools.partial of one)
+        chunks | Iterable[List[str]]
+            Chunks of sentences
+        num_workers | int
+            Number of processes, where 1 processes the chunks in the current process
+        ordered | bool
+            Whether the results are in the order of the chunks. Otherwise they are
+            returned as soon as they are done, which avoids waiting for slow chunks.
+        max_pending | int, optional
+            Maximum number of chunks in flight [Default: 2 * num_workers]
+    """
+    if num_workers <= 1:
+        yield from map(fn, chunks)
+        return
+    if max_pending is None:
+        max_pending = 2 * num_workers
+    with ProcessPoolExecutor(num_workers) as executor:
+        if ordered:
+            queue = deque()
+            for chunk in chunks:
+                queue.append(executor.submit(fn, chunk))
+                if len(queue) >= max_pending:
+                    yield queue.popleft().result()
+            while len(queue) > 0:
+                yield queue.popleft().result()
+        else:
+            pending = set()
+            for chunk in chunks:
+                pending.add(executor.submit(fn, chunk))
+                if len(pending) >= max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            for future in as_completed(pending):
+                yield future.result()
+
+
+def process_file(
+    input_path,
+    output_path,
+    fn,
+    chunk_size=10000,
+    num_workers=1,
+    ordered=True,
+    column=0,
+    delimiter="\t",
+    desc=None,
+):
+    """Process the sentences of a file with the given function and write the
+    resulting sentences to the output file, one per line, as soon as each chunk is
+    done.
+
+    Parameters
+        input_path | str
+            Path to the CSV/TSV file of the sentences, - for stdin
+        output_path | str
+            Path to the output file, - for stdout
+        fn | Callable[[List[str]], List[str]]
+            Function applied to each chunk of sentences (see map_chunks)
+        chunk_size | int
+            Number of sentences per chunk
+        num_workers | int
+            Number of processes
+        ordered | bool
+            Whether the output keeps the order of the input
+        column | int
+            Index of the column that contains the sentences
+        delimiter | str
+            Delimiter of the columns
+        desc | str, optional
+            Description shown in the progress bar
+
+    Returns
+        num_read | int
+            Number of sentences read
+        num_written | int
+            Number of sentences written
+    """
+    num_read = 0
+    num_written = 0
+
+    def counted_chunks():
+        nonlocal num_read
+        for chunk in read_chunks(
+            input_path, chunk_size=chunk_size, column=column, delimiter=delimiter
+        ):
+            num_read += len(chunk)
+            yield chunk
+
+    out_fd = (
+        sys.stdout if output_path == "-" else open(output_path, "w", encoding="utf8")
+    )
+    try:
+        with tqdm(desc=desc, unit=" sentences", file=sys.stderr) as pbar:
+            for result in map_chunks(
+                fn, counted_chunks(), num_workers=num_workers, ordered=ordered
+            ):
+                for sentence in result:
+                    out_fd.write(sentence)
+                    out_fd.write("\n")
+                num_written += len(result)
+                pbar.update(len(result))
+    finally:
+        if out_fd is not sys.stdout:
+            out_fd.close()
+    return num_read, num_written
@@ -1,39 +1,276 @@
-from bert_lid import *
-import pandas as pd
-from tqdm import tqdm
-import math
+# This script predicts with BertLid the probability that each sentence of a TSV
+# file is Swiss German. The predictions are appended as last column to the
+# output file, and the sentences above the threshold are written to the
+# filtered output.
+#
+# The input is read in chunks and the output is written after every chunk,
+# along with a progress file (<output>.progress). If the script is interrupted,
+# running it again with the same arguments resumes after the last chunk that was
+# written. The predictions can be stored in a cache (--cache), which is keyed by
+# the hash of the sentences, so that the sentences scored in an earlier run (of
+# any file) aren't scored again.
 
+import argparse
+import csv
+import hashlib
+import io
+import json
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from bert_lid import BertLid
+from tqdm import tqdm
+from preprocessing.pipeline import read_row_chunks
 
-###  Settings  #################################################################
+###  Default settings  #########################################################
 dataset_path = "data/whatsapp.csv"
 out_path = "data/whatsapp_predicted.csv"
 out_path_filtered = "data/whatsapp_over_99.csv"
 prediction_threshold = 0.99
-###############################################################################
+chunk_size = 10000
+batch_size = 500
+num_workers = 1
+################################################################################
+
+
+class PredictionCache:
+    """Predictions stored in an SQLite database, keyed by the hash of the
+    sentence.
+    """
+
+    # maximum number of variables in a query of SQLite
+    max_variables = 500
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS predictions "
+                                "(hash BLOB PRIMARY KEY, prediction REAL)")
+
+    @staticmethod
+    def key(sentence):
+        return hashlib.blake2b(sentence.encode("utf8"), digest_size=16).digest()
+
+    def get(self, sentences):
+        """Returns the predictions of the given sentences that are in the cache,
+        as a dict sentence -> prediction.
+        """
+        keys = {self.key(x): x for x in sentences}
+        key_list = list(keys.keys())
+        predictions = dict()
+        for i in range(0, len(key_list), self.max_variables):
+            batch = key_list[i:i+self.max_variables]
+            query = "SELECT hash, prediction FROM predictions WHERE hash IN " + \
+                    "(" + ", ".join(["?"] * len(batch)) + ")"
+            for key, prediction in self.connection.execute(query, batch):
+                predictions[keys[key]] = prediction
+        return predictions
+
+    def put(self, predictions):
+        """Stores the predictions given as a dict sentence -> prediction"""
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO predictions VALUES (?, ?)",
+            [(self.key(x), p) for x, p in predictions.items()])
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+### scoring ###
+
+# model of the process, created by init_worker
+lid = None
+
+def init_worker(num_threads=None):
+    global lid
+    if num_threads is not None:
+        import torch
+        torch.set_num_threads(num_threads)
+    lid = BertLid()
+
+def predict_batch(sentences):
+    predictions = [float(x) for x in lid.predict_label(sentences)]
+    if len(sentences) != len(predictions):
+        raise Exception("predictions and sentences_list must have the " +
+                        "same length")
+    return predictions
+
+def predict_chunk(sentences, batch_size=batch_size, cache=None, executor=None):
+    """Predict the sentences of a chunk. The sentences in the cache are not
+    scored again, and the others are sorted by length before being split into
+    batches, which reduces the padding.
+
+    Parameters
+        sentences | List[str]
+            Sentences of the chunk
+        batch_size | int
+            Number of sentences scored at once
+        cache | PredictionCache
+            Cache of the predictions, which is updated with the new ones
+        executor | concurrent.futures.Executor
+            Executor whose processes have been initialised by init_worker, among
+            which the batches are distributed. None to score them in this
+            process.
+
+    Returns
+        predictions | List[float]
+            Prediction of each sentence
+    """
+    predictions = cache.get(sentences) if cache is not None else dict()
+    # each distinct sentence is only scored once
+    missing = sorted(set(x for x in sentences if x not in predictions), key=len)
+    batches = [missing[i:i+batch_size]
+               for i in range(0, len(missing), batch_size)]
+    if executor is None:
+        results = map(predict_batch, batches)
+    else:
+        results = executor.map(predict_batch, batches)
+    new_predictions = dict()
+    for batch, batch_predictions in zip(batches, results):
+        new_predictions.update(zip(batch, batch_predictions))
+    if cache is not None and len(new_predictions) > 0:
+        cache.put(new_predictions)
+    predictions.update(new_predictions)
+    return [predictions[x] for x in sentences]
+
+### progress ###
+
+def load_progress(path, options):
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf8") as f:
+        progress = json.load(f)
+    if progress["input"] != options.input:
+        raise Exception(f"{path} belongs to the input {progress['input']}, " +
+                        "use --restart to start over")
+    return progress
+
+def save_progress(path, progress):
+    # replaced at once, hence the file is never half written
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf8") as f:
+        json.dump(progress, f)
+    os.replace(tmp_path, path)
+
+def open_output(path, offset):
+    """Open the output in binary mode, truncated to the offset (None to create
+    a new file). Anything after the offset was written after the last progress.
+    """
+    if path is None:
+        return None
+    if offset is None:
+        return open(path, "wb")
+    f = open(path, "r+b")
+    f.truncate(offset)
+    f.seek(offset)
+    return f
+
+def write_rows(f, rows):
+    buffer = io.StringIO()
+    csv.writer(buffer, delimiter="\t", lineterminator="\n").writerows(rows)
+    f.write(buffer.getvalue().encode("utf8"))
+    f.flush()
+    os.fsync(f.fileno())
 
-df = pd.read_csv(dataset_path, sep="\t", header=None)
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", dest="input", default=dataset_path,
+                        help=("TSV file with the sentences in the first column "
+                              f"[Default: {dataset_path}]"))
+    parser.add_argument("-o", "--output", dest="output", default=out_path,
+                        help=("Output TSV file with the predictions "
+                              f"[Default: {out_path}]"))
+    parser.add_argument("-f", "--filtered-output", dest="filtered_output",
+                        default=out_path_filtered,
+                        help=("Output TSV file with the sentences above the "
+                              "threshold, empty to skip it "
+                              f"[Default: {out_path_filtered}]"))
+    parser.add_argument("--threshold", dest="threshold", type=float,
+                        default=prediction_threshold,
+                        help=("Minimum prediction of the filtered sentences "
+                              f"[Default: {prediction_threshold}]"))
+    parser.add_argument("-c", "--chunk-size", dest="chunk_size", type=int,
+                        default=chunk_size,
+                        help=("Number of sentences written at once, after which "
+                              f"the progress is saved [Default: {chunk_size}]"))
+    parser.add_argument("-b", "--batch-size", dest="batch_size", type=int,
+                        default=batch_size,
+                        help=("Number of sentences scored at once "
+                              f"[Default: {batch_size}]"))
+    parser.add_argument("-w", "--workers", dest="num_workers", type=int,
+                        default=num_workers,
+                        help=("Number of processes, each with its own model, "
+                              f"among which the batches are distributed "
+                              f"[Default: {num_workers}]"))
+    parser.add_argument("-t", "--threads", dest="num_threads", type=int,
+                        help="Number of threads of each process")
+    parser.add_argument("--cache", dest="cache",
+                        help=("SQLite database of the predictions, which is "
+                              "created if it doesn't exist"))
+    parser.add_argument("--restart", dest="restart", action="store_true",
+                        help="Ignore the progress of a previous run")
+    return parser.parse_args()
 
-sentences = list(df.iloc[:, 0].values)
+def main():
+    options = parse_args()
+    filtered_path = options.filtered_output or None
+    progress_path = options.output + ".progress"
+    progress = None if options.restart else load_progress(progress_path, options)
+    if progress is None:
+        progress = {"input": options.input, "rows": 0, "output_offset": None,
+                    "filtered_offset": None}
+    elif progress["rows"] > 0:
+        if filtered_path is not None and progress["filtered_offset"] is None:
+            raise Exception("The previous run had no filtered output, " +
+                            "use --restart to start over")
+        print(f"Resuming after {progress['rows']} rows")
 
-lid = BertLid()
+    out_f = open_output(options.output, progress["output_offset"])
+    filtered_f = open_output(filtered_path, progress["filtered_offset"])
+    cache = PredictionCache(options.cache) if options.cache else None
+    if options.num_workers > 1:
+        executor = ProcessPoolExecutor(options.num_workers,
+                                       initializer=init_worker,
+                                       initargs=(options.num_threads,))
+    else:
+        executor = None
+        init_worker(options.num_threads)
 
-predictions = []
-interval = 500
-for i in tqdm(range(math.ceil(len(sentences)/interval))):
-    left = i*interval
-    right = (i+1)*interval
-    batch = sentences[left:right]
-    if len(batch) > 0:
-        predictions.extend(lid.predict_label(batch))
-if len(sentences) != len(predictions):
-    raise Exception("predictions and sentences_list must have the " +
-                    "same length")
+    try:
+        rows_to_skip = progress["rows"]
+        pbar = tqdm(initial=rows_to_skip, unit=" sentences")
+        for rows in read_row_chunks(options.input, chunk_size=options.chunk_size):
+            if rows_to_skip >= len(rows):
+                rows_to_skip -= len(rows)
+                continue
+            rows = rows[rows_to_skip:]
+            rows_to_skip = 0
 
-df["predictions"] = predictions
+            predictions = predict_chunk([row[0] for row in rows],
+                                        batch_size=options.batch_size,
+                                        cache=cache, executor=executor)
+            write_rows(out_f, [row + [prediction]
+                               for row, prediction in zip(rows, predictions)])
+            if filtered_f is not None:
+                write_rows(filtered_f, [row for row, prediction
+                                        in zip(rows, predictions)
+                                        if prediction >= options.threshold])
 
-df.to_csv(out_path, sep="\t", header=None, index=False)
+            progress["rows"] += len(rows)
+            progress["output_offset"] = out_f.tell()
+            if filtered_f is not None:
+                progress["filtered_offset"] = filtered_f.tell()
+            save_progress(progress_path, progress)
+            pbar.update(len(rows))
+        pbar.close()
+    finally:
+        out_f.close()
+        if filtered_f is not None:
+            filtered_f.close()
+        if cache is not None:
+            cache.close()
+        if executor is not None:
+            executor.shutdown()
 
-if out_path_filtered is not None:
-    df = df[df.predictions >= prediction_threshold]
-    df = df.drop(["predictions"], axis=1)
-    df.to_csv(out_path_filtered, sep="\t", header=None, index=False)
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 import numpy as np
+from preprocessing.near_dedup import assign_splits
 
-def split_dataset(df, train_proportion, valid_proportion):
+def split_dataset(df, train_proportion, valid_proportion, groups=None, seed=0):
     """Split a dataframe into a train, validation, and test set. The size of the
     test set will be 1.0 minus the given train and valid proportion.
 
@@ -13,11 +14,23 @@ def split_dataset(df, train_proportion, valid_proportion):
         valid_proportion - float
             A value between 0.0 and 1.0 indicating the proportion of sentences
             to take for the validation set.
+        groups - array-like, optional
+            The group of each row, e.g. its cluster of near duplicates (see
+            preprocessing.near_dedup). All the rows of a group end up in the
+            same set, which only depends on the group and the seed, so that
+            the groups are in the same set for every dataframe that is split.
+            The proportions are then those of the groups.
+        seed - int
+            The seed of the assignment of the groups
 
     Returns
         List[pandas.core.frame.DataFrame]
             A list [train, valid, test] containing the corresponding dataframes
     """
+    if groups is not None:
+        splits = assign_splits(np.asarray(groups), train_proportion,
+                               valid_proportion, seed=seed)
+        return [df[splits == i].sample(frac=1) for i in range(3)]
     shuffled = df.sample(frac=1)
     first_break = train_proportion
     second_break = train_proportion + valid_proportion
@@ -0,0 +1,372 @@
+import argparse
+import csv
+import json
+import math
+import sys
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Optional
+
+import torch
+import torch.nn.functional as F
+from transformers import PreTrainedModel, PreTrainedTokenizer, PreTrainedTokenizerFast
+
+from checkpoint import load_pretrained
+from dataset import encode_lines
+from kv_cache import expand_past, forward_with_past
+
+max_tokens = 4096
+chunk_size = 1000
+num_threads = torch.get_num_threads()
+
+
+def common_prefix_length(sequences: List[List[int]]) -> int:
+    shortest = min(sequences, key=len)
+    for i, token in enumerate(shortest):
+        if any(seq[i] != token for seq in sequences):
+            return i
+    return len(shortest)
+
+
+class SentenceScorer:
+    """
+    Scores sentences with a causal language model, giving the log-probability of each
+    sentence and of each of its tokens.
+
+    The model is loaded once and used for all calls. The sentences of a call are
+    batched by length, with up to max_tokens tokens (including padding) per batch.
+    When prefixes are shared, the sentences are instead ordered alphabetically by
+    their tokens and the common prefix of each batch is only computed once.
+    """
+
+    def __init__(
+        self,
+        model: PreTrainedModel,
+        tokeniser: PreTrainedTokenizer,
+        device: torch.device,
+        fast_tokeniser: Optional[PreTrainedTokenizerFast] = None,
+        max_tokens: int = max_tokens,
+        share_prefixes: bool = False,
+    ):
+        """
+        Args:
+            model (PreTrainedModel): Causal language model, e.g. GPT2LMHeadModel
+            tokeniser (PreTrainedTokenizer): Tokeniser of the model
+            device (torch.device): Device on which the model is run
+            fast_tokeniser (PreTrainedTokenizerFast, optional): Fast version of the
+                tokeniser to encode the sentences in batches.
+            max_tokens (int): Maximum number of tokens per batch, including the
+                padding [Default: 4096]
+            share_prefixes (bool): Whether to compute common prefixes of the sentences
+                only once [Default: False]
+        """
+        self.model = model.to(device)
+        self.model.eval()
+        self.tokeniser = tokeniser
+        self.fast_tokeniser = fast_tokeniser
+        self.device = device
+        self.max_tokens = max_tokens
+        self.share_prefixes = share_prefixes
+        # Every sentence starts with the start token, so that its first token can be
+        # predicted as well.
+        self.start_token_id = (
+            tokeniser.bos_token_id
+            if tokeniser.bos_token_id is not None
+            else tokeniser.eos_token_id
+        )
+        self.max_len = model.config.n_positions
+
+    @classmethod
+    def from_checkpoint(
+        cls, path: str, device: torch.device, **kwargs
+    ) -> "SentenceScorer":
+        """
+        Loads the scorer from a checkpoint directory. See the constructor for the
+        remaining arguments.
+        """
+        pretrained = load_pretrained(path)
+        if pretrained["masked_lm"]:
+            raise Exception(
+                "Scoring sentences requires a causal language model, not {}".format(
+                    pretrained["kind"]
+                )
+            )
+        fast_tokeniser_class = pretrained["fast_tokeniser_class"]
+        fast_tokeniser = (
+            None
+            if fast_tokeniser_class is None
+            else fast_tokeniser_class.from_pretrained(path)
+        )
+        return cls(
+            pretrained["model"],
+            pretrained["tokeniser"],
+            device,
+            fast_tokeniser=fast_tokeniser,
+            **kwargs,
+        )
+
+    def encode(self, sentences: List[str]) -> List[List[int]]:
+        """
+        Encodes the sentences with the start token, truncated to the maximum length of
+        the model.
+        """
+        if self.fast_tokeniser is None:
+            encoded = [
+                self.tokeniser.encode(sentence, add_special_tokens=False)
+                for sentence in sentences
+            ]
+        else:
+            encoded = next(
+                encode_lines(iter([sentences]), self.tokeniser, self.fast_tokeniser)
+            )
+        return [[self.start_token_id] + enc[: self.max_len - 1] for enc in encoded]
+
+    def create_batches(self, encoded: List[List[int]]) -> List[List[int]]:
+        """
+        Groups the sentences into batches of at most max_tokens tokens with padding.
+        """
+        if self.share_prefixes:
+            # Sentences with common prefixes end up next to each other.
+            order = sorted(range(len(encoded)), key=encoded.__getitem__)
+        else:
+            order = sorted(range(len(encoded)), key=lambda i: len(encoded[i]))
+        batches = []
+        batch: List[int] = []
+        max_len = 0
+        for i in order:
+            new_max_len = max(max_len, len(encoded[i]))
+            if len(batch) > 0 and new_max_len * (len(batch) + 1) > self.max_tokens:
+                batches.append(batch)
+                batch = []
+                new_max_len = len(encoded[i])
+            batch.append(i)
+            max_len = new_max_len
+        if len(batch) > 0:
+            batches.append(batch)
+        return batches
+
+    @torch.no_grad()
+    def score_batch(self, sequences: List[List[int]]) -> List[List[float]]:
+        """
+        Computes the log-probabilities of all tokens (except the start token) of the
+        encoded sentences.
+        """
+        # The common prefix (apart from its last token, which is needed as the input for
+        # the prediction of the next token) is computed once for the whole batch.
+        num_shared = (
+            common_prefix_length(sequences) - 1
+            if self.share_prefixes and len(sequences) > 1
+            else 0
+        )
+        past = None
+        prefix_scores: List[float] = []
+        if num_shared > 0:
+            prefix = torch.tensor(
+                [sequences[0][: num_shared + 1]], dtype=torch.long, device=self.device
+            )
+            logits, past = forward_with_past(self.model, prefix[:, :-1])
+            log_probs = F.log_softmax(logits[0].float(), dim=-1)
+            prefix_scores = (
+                log_probs.gather(1, prefix[0, 1:].unsqueeze(1)).squeeze(1).tolist()
+            )
+            past = expand_past(past, len(sequences))
+
+        suffixes = [seq[num_shared:] for seq in sequences]
+        max_len = max(len(suffix) for suffix in suffixes)
+        inputs = torch.zeros(
+            (len(suffixes), max_len), dtype=torch.long, device=self.device
+        )
+        # The mask covers the shared prefix as well as the inputs.
+        attention_mask = torch.zeros(
+            (len(suffixes), num_shared + max_len), dtype=torch.long, device=self.device
+        )
+        for i, suffix in enumerate(suffixes):
+            inputs[i, : len(suffix)] = torch.tensor(suffix, dtype=torch.long)
+            attention_mask[i, : num_shared + len(suffix)] = 1
+        logits, _ = forward_with_past(
+            self.model, inputs, past=past, attention_mask=attention_mask
+        )
+        log_probs = F.log_softmax(logits[:, :-1].float(), dim=-1)
+        scores = log_probs.gather(2, inputs[:, 1:].unsqueeze(2)).squeeze(2).cpu()
+        return [
+            prefix_scores + scores[i, : len(suffix) - 1].tolist()
+            for i, suffix in enumerate(suffixes)
+        ]
+
+    def score(self, sentences: List[str]) -> List[Dict]:
+        """
+        Scores the sentences.
+
+        Args:
+            sentences (List[str]): Sentences to score
+
+        Returns:
+            results (List[Dict]): Results in the order of the sentences, with the
+                sentence, its tokens, the log-probability of each token, the
+                log-probability of the sentence and its perplexity.
+        """
+        encoded = self.encode(sentences)
+        token_scores: List[List[float]] = [[] for _ in sentences]
+        for batch in self.create_batches(encoded):
+            batch_scores = self.score_batch([encoded[i] for i in batch])
+            for i, scores in zip(batch, batch_scores):
+                token_scores[i] = scores
+        results = []
+        for sentence, enc, scores in zip(sentences, encoded, token_scores):
+            log_prob = sum(scores)
+            results.append(
+                OrderedDict(
+                    sentence=sentence,
+                    tokens=self.tokeniser.convert_ids_to_tokens(enc[1:]),
+                    token_scores=scores,
+                    log_prob=log_prob,
+                    perplexity=(
+                        math.exp(-log_prob / len(scores))
+                        if len(scores) > 0
+                        else float("nan")
+                    ),
+                )
+            )
+        return results
+
+
+def read_sentences(path: str, chunk_size: int = chunk_size) -> Iterator[List[str]]:
+    """
+    Reads the sentences (first column of a TSV file) in chunks, where - reads them
+    from stdin. Empty lines are kept as empty sentences, so that every line of the
+    input has a result.
+    """
+    fd = sys.stdin if path == "-" else open(path, "r", encoding="utf8")
+    try:
+        reader = csv.reader(fd, delimiter="\t", quoting=csv.QUOTE_NONE, quotechar="")
+        chunk = []
+        for line in reader:
+            chunk.append(line[0] if len(line) > 0 else "")
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if len(chunk) > 0:
+            yield chunk
+    finally:
+        if fd is not sys.stdin:
+            fd.close()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-c",
+        "--checkpoint",
+        dest="checkpoint",
+        required=True,
+        type=str,
+        help="Path to the checkpoint of the (causal) language model",
+    )
+    parser.add_argument(
+        "-i",
+        "--input",
+        dest="input",
+        default="-",
+        type=str,
+        help="Path to TSV file of the sentences to score [Default: - (stdin)]",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        dest="output",
+        default="-",
+        type=str,
+        help="Path to the output file [Default: - (stdout)]",
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        dest="format",
+        default="tsv",
+        choices=["tsv", "jsonl"],
+        help=(
+            "Format of the output, either a TSV file with the sentence, its "
+            "log-probability and perplexity, or JSON lines that also contain the "
+            "scores of each token [Default: tsv]"
+        ),
+    )
+    parser.add_argument(
+        "--max-tokens",
+        dest="max_tokens",
+        default=max_tokens,
+        type=int,
+        help=(
+            "Maximum number of tokens (including padding) per batch "
+            "[Default: {}]".format(max_tokens)
+        ),
+    )
+    parser.add_argument(
+        "--chunk-size",
+        dest="chunk_size",
+        default=chunk_size,
+        type=int,
+        help=(
+            "Number of sentences that are read and batched together "
+            "[Default: {}]".format(chunk_size)
+        ),
+    )
+    parser.add_argument(
+        "--share-prefixes",
+        dest="share_prefixes",
+        action="store_true",
+        help=(
+            "Batch sentences with common prefixes together and compute the prefixes "
+            "only once"
+        ),
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        dest="num_threads",
+        default=num_threads,
+        type=int,
+        help="Number of threads used on the CPU [Default: {}]".format(num_threads),
+    )
+    parser.add_argument(
+        "--no-cuda",
+        dest="no_cuda",
+        action="store_true",
+        help="Do not use CUDA even if it's available",
+    )
+    return parser.parse_args()
+
+
+def main():
+    options = parse_args()
+    torch.set_num_threads(options.num_threads)
+    use_cuda = torch.cuda.is_available() and not options.no_cuda
+    device = torch.device("cuda" if use_cuda else "cpu")
+    scorer = SentenceScorer.from_checkpoint(
+        options.checkpoint,
+        device,
+        max_tokens=options.max_tokens,
+        share_prefixes=options.share_prefixes,
+    )
+    out_fd = (
+        sys.stdout
+        if options.output == "-"
+        else open(options.output, "w", encoding="utf8")
+    )
+    for sentences in read_sentences(options.input, chunk_size=options.chunk_size):
+        for result in scorer.score(sentences):
+            if options.format == "jsonl":
+                out_fd.write(json.dumps(result, ensure_ascii=False))
+                out_fd.write("\n")
+            else:
+                out_fd.write(
+                    "{sentence}\t{log_prob}\t{perplexity}\n".format(
+                        sentence=result["sentence"],
+                        log_prob=result["log_prob"],
+                        perplexity=result["perplexity"],
+                    )
+                )
+    if out_fd is not sys.stdout:
+        out_fd.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,11 @@
 import argparse
+import contextlib
+import itertools
+import math
 import os
 import time
 from collections import OrderedDict
-from typing import Dict, Optional
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
 
 import lavd
 import torch
@@ -12,36 +15,61 @@ import torch.multiprocessing as mp
 import torch.nn as nn
 import torch.optim as optim
 from torch.nn.parallel import DistributedDataParallel
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, IterableDataset
 from torch.utils.data.distributed import DistributedSampler
 from transformers import (
     AdamW,
     BertConfig,
     BertForMaskedLM,
     BertTokenizer,
+    BertTokenizerFast,
     GPT2Config,
     GPT2LMHeadModel,
     GPT2Tokenizer,
+    GPT2TokenizerFast,
     XLNetTokenizer,
     get_linear_schedule_with_warmup,
 )
 
 from checkpoint import (
+    CheckpointWriter,
     default_checkpoint,
+    get_rng_state,
     load_checkpoint,
+    load_training_state,
     log_epoch_stats,
     log_experiment,
     log_results,
     log_top_checkpoints,
     metrics,
-    save_checkpoint,
+    set_rng_state,
+)
+from dataset import (
+    BlockCollate,
+    BucketBatchSampler,
+    ResumableDistributedSampler,
+    SentenceDataset,
+    ShardedSampler,
+    StreamingTextDataset,
+    TextDataset,
+    TokenMasker,
+    masking_strategies,
+    num_loss_tokens,
+    prepare_batch,
+    sentence_data_loader,
 )
-from dataset import TextDataset, mask_tokens
 
 batch_size = 1
 num_workers = mp.cpu_count()
 num_gpus = torch.cuda.device_count()
 num_epochs = 100
+shuffle_buffer = 10000
+max_tokens = 4096
+accumulation_steps = 1
+keep_best = 5
+default_non_finite = "abort"
+check_steps = 100
+default_masking = "token"
 
 lr = 5e-5
 adam_eps = 1e-8
@@ -51,6 +79,19 @@ seed = 1234
 default_model = "bert"
 
 
+def check_non_finite(count: torch.Tensor, name: str, batch: Optional[int] = None):
+    """
+    Aborts if any non-finite loss or gradient has been counted, which requires a
+    synchronisation with the device.
+    """
+    if count.item() > 0:
+        raise Exception(
+            "Non-finite loss or gradient encountered in {name}{batch}".format(
+                name=name, batch="" if batch is None else " at batch {}".format(batch)
+            )
+        )
+
+
 def run_epoch(
     data_loader: DataLoader,
     model: nn.Module,
@@ -62,6 +103,15 @@ def run_epoch(
     amp_scaler: Optional[amp.GradScaler] = None,
     masked_lm: bool = True,
     name: str = "",
+    accumulation_steps: int = 1,
+    lr_scheduler: Optional[optim.lr_scheduler._LRScheduler] = None,
+    start_batch: int = 0,
+    previous_loss: Optional[Tuple[float, int]] = None,
+    checkpoint_steps: Optional[int] = None,
+    save_progress: Optional[Callable[[int, Tuple[float, int]], None]] = None,
+    non_finite: str = default_non_finite,
+    check_steps: int = check_steps,
+    masking: str = default_masking,
 ) -> Dict:
     # Disables autograd during validation mode
     torch.set_grad_enabled(train)
@@ -72,67 +122,249 @@ def run_epoch(
 
     sampler = (
         data_loader.sampler  # type: ignore
-        if isinstance(data_loader.sampler, DistributedSampler)  # type: ignore
+        if isinstance(data_loader.sampler, (DistributedSampler, ShardedSampler))
         else None
     )
-    if sampler is not None:
+    if isinstance(sampler, DistributedSampler):
         sampler.set_epoch(epoch)
+    batch_sampler = (
+        data_loader.batch_sampler
+        if isinstance(data_loader.batch_sampler, BucketBatchSampler)
+        else None
+    )
+    if batch_sampler is not None:
+        batch_sampler.set_epoch(epoch)
+    dataset = data_loader.dataset
+    # A streamed dataset has no length and is sharded by the dataset itself instead of
+    # a sampler.
+    streaming = isinstance(dataset, IterableDataset)
+    if streaming:
+        dataset.set_epoch(epoch)  # type: ignore
+    num_replicas = 1
+    if sampler is not None:
+        num_replicas = sampler.num_replicas  # type: ignore
+    elif batch_sampler is not None:
+        num_replicas = batch_sampler.num_replicas
+    elif streaming:
+        num_replicas = dataset.num_replicas  # type: ignore
 
-    losses = []
+    # The losses are accumulated on the device, since reading each of them would
+    # synchronise the GPU with the CPU at every step. The loss of each batch is the mean
+    # over its tokens, which is turned back into the sum of the negative
+    # log-likelihoods, so that the result is the exact mean over all tokens, regardless
+    # of the batch size and the number of processes.
+    nll_sum = torch.zeros((), dtype=torch.double, device=device)
+    num_nll_tokens = torch.zeros((), dtype=torch.double, device=device)
+    # The loss of the batches before resuming is the total of all processes, hence it
+    # is only added by the first one.
+    is_first = num_replicas == 1 or dist.get_rank() == 0
+    previous = torch.tensor(
+        previous_loss if previous_loss is not None and is_first else (0.0, 0.0),
+        dtype=torch.double,
+        device=device,
+    )
+    nll_sum += previous[0]
+    num_nll_tokens += previous[1]
+    num_batches_run = 0
+    num_non_finite = torch.zeros((), dtype=torch.long, device=device)
+    # Updates with non-finite gradients (but finite losses) when aborting on them.
+    num_non_finite_grads = torch.zeros((), dtype=torch.long, device=device)
+    num_tokens = torch.zeros((), dtype=torch.long, device=device)
+    # Number of explicit synchronisations between the GPU and the CPU.
+    num_syncs = 0
+    start_time = time.time()
     pbar = logger.progress_bar(
-        name, total=len(data_loader.dataset), leave=False, dynamic_ncols=True
+        name,
+        total=None if streaming else len(dataset),  # type: ignore
+        leave=False,
+        dynamic_ncols=True,
     )
+    # When resuming in the middle of an epoch, the batches that have already been
+    # processed are skipped by the samplers. A streamed dataset has to go through them.
+    batches: Iterator[Tuple[int, Any]] = enumerate(data_loader, start=start_batch)
+    if start_batch > 0:
+        if sampler is not None:
+            num_skipped = start_batch * data_loader.batch_size  # type: ignore
+            sampler.skip(num_skipped)  # type: ignore
+            pbar.update(num_skipped * num_replicas)
+        elif batch_sampler is not None:
+            batch_sampler.skip(start_batch)
+        else:
+            batches = itertools.islice(enumerate(data_loader), start_batch, None)
     tokeniser = data_loader.dataset.tokeniser  # type: ignore
-    for d in data_loader:
-        d = d.to(device)
-        inputs, labels = mask_tokens(d, tokeniser) if masked_lm else (d, d)
-        # The last batch may not be a full batch
-        curr_batch_size = inputs.size(0)
-
-        # Automatically run it in mixed precision (FP16) if a scaler is given
-        with amp.autocast(enabled=amp_scaler is not None):
-            output = (
-                model(inputs, masked_lm_labels=labels)
-                if masked_lm
-                else model(inputs, labels=labels)
+    # Parameter through which a non-finite loss makes the gradients non-finite.
+    first_param = next(p for p in model.parameters() if p.requires_grad)
+    # The lookup of the special tokens is only created once for the whole epoch.
+    masker = TokenMasker(tokeniser, strategy=masking) if masked_lm else None
+    # The shards of a streamed dataset may have a different number of batches per
+    # process, so the processes join the ones that are still running instead of waiting
+    # for each other forever.
+    uneven_shards = streaming and isinstance(model, DistributedDataParallel)
+    join_context = model.join() if uneven_shards else contextlib.nullcontext()
+    # The streamed dataset has no length, hence an incomplete accumulation at the end
+    # of the epoch is discarded.
+    num_batches = None if streaming else len(data_loader)
+    num_updates = 0
+    if train:
+        optimiser.zero_grad()
+    with join_context:
+        for i, d in batches:
+            inputs, labels, attention_mask = prepare_batch(
+                d, tokeniser, device, masked_lm=masked_lm, masker=masker
             )
-        loss = output[0]
-        losses.append(loss.item())
-        if torch.isnan(loss) or torch.isinf(loss):
-            breakpoint()
-        if train:
-            optimiser.zero_grad()
-            if amp_scaler is None:
-                loss.backward()
-                # Clip gradients to avoid exploding gradients
-                nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
-                optimiser.step()
-            else:
-                amp_scaler.scale(loss).backward()
-                amp_scaler.unscale_(optimiser)
-                # Clip gradients to avoid exploding gradients
-                nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
-                amp_scaler.step(optimiser)
-                amp_scaler.update()
-
-        pbar.update(
-            curr_batch_size
-            if sampler is None
-            else curr_batch_size * sampler.num_replicas  # type: ignore
-        )
+            # The last batch may not be a full batch
+            curr_batch_size = inputs.size(0)
+            num_tokens += (
+                inputs.numel() if attention_mask is None else attention_mask.sum()
+            )
+
+            # Automatically run it in mixed precision (FP16) if a scaler is given
+            with amp.autocast(enabled=amp_scaler is not None):
+                output = (
+                    model(
+                        inputs, attention_mask=attention_mask, masked_lm_labels=labels
+                    )
+                    if masked_lm
+                    else model(inputs, attention_mask=attention_mask, labels=labels)
+                )
+            loss = output[0]
+            num_batches_run += 1
+            batch_tokens = num_loss_tokens(labels, masked_lm=masked_lm)
+            # Non-finite losses are excluded from the average and counted instead.
+            # A batch without any tokens to predict has a NaN loss, but is not counted.
+            is_finite = torch.isfinite(loss.detach())
+            is_included = is_finite & (batch_tokens > 0)
+            nll_sum += torch.where(
+                is_included,
+                loss.detach().double() * batch_tokens,
+                nll_sum.new_zeros(()),
+            )
+            num_nll_tokens += torch.where(
+                is_included, batch_tokens, batch_tokens.new_zeros(())
+            )
+            num_non_finite += ~is_finite & (batch_tokens > 0)
+            if non_finite == "abort" and (i + 1) % check_steps == 0:
+                num_syncs += 1
+                check_non_finite(num_non_finite + num_non_finite_grads, name, i + 1)
+            if train:
+                # The gradients of multiple batches are accumulated before updating
+                # the weights. The last accumulation of the epoch may be shorter.
+                accumulation_start = i - i % accumulation_steps
+                accumulation_len = (
+                    accumulation_steps
+                    if num_batches is None
+                    else min(accumulation_steps, num_batches - accumulation_start)
+                )
+                is_update_step = i - accumulation_start == accumulation_len - 1
+                # The gradients are only synchronised between the processes when the
+                # weights are updated.
+                sync_context = (
+                    model.no_sync()  # type: ignore
+                    if not is_update_step and isinstance(model, DistributedDataParallel)
+                    else contextlib.nullcontext()
+                )
+                backward_loss = loss / accumulation_len
+                if non_finite == "skip":
+                    # A non-finite loss does not necessarily have non-finite gradients,
+                    # hence they are made non-finite, so that the update is skipped on
+                    # all processes. Nothing is added to the gradients otherwise.
+                    backward_loss = backward_loss + torch.where(
+                        is_finite | (batch_tokens == 0),
+                        loss.new_zeros(()),
+                        loss.new_full((), math.nan),
+                    ) * first_param.view(-1)[0].to(loss.dtype)
+                with sync_context:
+                    if amp_scaler is None:
+                        backward_loss.backward()
+                    else:
+                        amp_scaler.scale(backward_loss).backward()
+                if is_update_step:
+                    if amp_scaler is not None:
+                        amp_scaler.unscale_(optimiser)
+                    # Clip gradients to avoid exploding gradients
+                    grad_norm = nn.utils.clip_grad_norm_(
+                        model.parameters(), max_norm=1.0
+                    )
+                    if amp_scaler is not None:
+                        # The scaler skips the update if the gradients are not finite,
+                        # which requires a synchronisation.
+                        num_syncs += 1
+                        amp_scaler.step(optimiser)
+                        amp_scaler.update()
+                    elif non_finite == "skip":
+                        # Checking the gradients requires a synchronisation for every
+                        # update. The gradients are the same across the processes, so
+                        # either all of them or none skip the update.
+                        num_syncs += 1
+                        if math.isfinite(grad_norm):
+                            optimiser.step()
+                    else:
+                        # The gradients are only checked with the losses, every
+                        # check_steps batches, which aborts the training.
+                        num_non_finite_grads += ~torch.isfinite(grad_norm)
+                        optimiser.step()
+                    optimiser.zero_grad()
+                    # The learning rate is adjusted after every update of the weights.
+                    if lr_scheduler is not None:
+                        lr_scheduler.step()
+                    num_updates += 1
+                    if (
+                        save_progress is not None
+                        and checkpoint_steps is not None
+                        and num_updates % checkpoint_steps == 0
+                    ):
+                        num_syncs += 1
+                        # A checkpoint after a non-finite loss or gradient would not
+                        # be usable to resume the training.
+                        if non_finite == "abort":
+                            check_non_finite(
+                                num_non_finite + num_non_finite_grads, name, i + 1
+                            )
+                        # The progress contains the loss of all processes, since only
+                        # the first one saves it.
+                        partial_loss = torch.stack([nll_sum, num_nll_tokens])
+                        if uneven_shards and num_replicas > 1:
+                            # Some processes may already have run out of batches, so
+                            # they cannot be synchronised. The loss of this process
+                            # since resuming is extrapolated to all of them instead.
+                            partial_loss = (
+                                partial_loss - previous
+                            ) * num_replicas + previous
+                        elif num_replicas > 1:
+                            dist.all_reduce(partial_loss)
+                        nll_sum_total, num_nll_tokens_total = partial_loss.tolist()
+                        save_progress(i + 1, (nll_sum_total, num_nll_tokens_total))
 
+            pbar.update(curr_batch_size * num_replicas)
+
+    if train:
+        optimiser.zero_grad()
     pbar.close()
 
-    loss = torch.mean(torch.tensor(losses, device=device))
-    # Gather the loss onto the primary process to have accurate metrics.
-    if sampler is not None:
-        gathered_losses = [
-            torch.zeros_like(loss) for _ in range(sampler.num_replicas)  # type: ignore
-        ]
-        dist.all_gather(gathered_losses, loss)
-        loss = torch.mean(torch.tensor(gathered_losses))
+    if non_finite == "abort":
+        check_non_finite(num_non_finite + num_non_finite_grads, name)
+    # Sum the negative log-likelihoods and the counts of all processes at once.
+    if num_replicas > 1:
+        totals = torch.stack(
+            [nll_sum, num_nll_tokens, num_tokens.double(), num_non_finite.double()]
+        )
+        dist.all_reduce(totals)
+        nll_sum, num_nll_tokens = totals[0], totals[1]
+        num_tokens, num_non_finite = totals[2].long(), totals[3].long()
+    loss = nll_sum / num_nll_tokens
     perplexity = torch.exp(loss)
-    return OrderedDict(loss=loss.item(), perplexity=perplexity.item())
+    time_elapsed = time.time() - start_time
+    # The time of an optimiser step (including the accumulated batches) for training,
+    # and of a single batch for validation.
+    num_steps = num_updates if train else num_batches_run
+    return OrderedDict(
+        loss=loss.item(),
+        perplexity=perplexity.item(),
+        tokens_per_second=num_tokens.item() / time_elapsed,
+        step_time=time_elapsed / max(num_steps, 1),
+        host_syncs=num_syncs,
+        non_finite=num_non_finite.item(),
+    )
 
 
 def train(
@@ -148,6 +380,15 @@ def train(
     model_kind: str = default_model,
     amp_scaler: Optional[amp.GradScaler] = None,
     masked_lm: bool = True,
+    accumulation_steps: int = 1,
+    lr_schedule: Optional[Dict] = None,
+    checkpoint_steps: Optional[int] = None,
+    training_state: Optional[Dict] = None,
+    keep_last: Optional[int] = None,
+    keep_best: int = 5,
+    non_finite: str = default_non_finite,
+    check_steps: int = check_steps,
+    masking: str = default_masking,
 ):
     start_epoch = checkpoint["epoch"]
     train_stats = checkpoint["train"]
@@ -175,6 +416,53 @@ def train(
     )
 
     tokeniser = train_data_loader.dataset.tokeniser  # type: ignore
+    # Multi-gpu models wrap the original model. To make the checkpoint
+    # compatible with the original model, the state dict of .module is saved.
+    model_unwrapped = (
+        model.module if isinstance(model, DistributedDataParallel) else model
+    )
+
+    # The checkpoints are written in the background while the training continues.
+    checkpoint_writer = CheckpointWriter(logger, keep_last=keep_last)
+
+    def save_training_checkpoint(
+        epoch: int,
+        batch: int = 0,
+        loss: Tuple[float, int] = (0.0, 0),
+        step: Optional[int] = None,
+    ):
+        checkpoint_writer.save(
+            model_unwrapped,
+            tokeniser,
+            stats=OrderedDict(
+                epoch=epoch,
+                train=train_stats,
+                validation=validation_results_dict,
+                outdated_validation=outdated_validations,
+                model=OrderedDict(kind=model_kind),
+                lr_scheduler=OrderedDict(
+                    lr_schedule or {}, state=lr_scheduler.state_dict()
+                ),
+            ),
+            step=step,
+            training_state=OrderedDict(
+                optimiser=optimiser.state_dict(),
+                amp_scaler=None if amp_scaler is None else amp_scaler.state_dict(),
+                rng=get_rng_state(),
+                # Number of batches of the next epoch that have already been processed
+                # and the sum of their negative log-likelihoods and number of tokens.
+                batch=batch,
+                nll_sum=loss[0],
+                num_nll_tokens=loss[1],
+            ),
+        )
+
+    start_batch = 0 if training_state is None else training_state["batch"]
+    previous_loss = (
+        None
+        if training_state is None
+        else (training_state["nll_sum"], training_state["num_nll_tokens"])
+    )
     for epoch in range(num_epochs):
         actual_epoch = start_epoch + epoch + 1
         epoch_text = "[{current:>{pad}}/{end}] Epoch {epoch}".format(
@@ -193,18 +481,35 @@ def train(
             model,
             optimiser,
             device=device,
-            epoch=epoch,
+            epoch=actual_epoch,
             train=True,
             name="Train",
             logger=logger,
             amp_scaler=amp_scaler,
             masked_lm=masked_lm,
+            accumulation_steps=accumulation_steps,
+            lr_scheduler=lr_scheduler,
+            start_batch=start_batch,
+            previous_loss=previous_loss,
+            checkpoint_steps=checkpoint_steps,
+            # The epoch is not finished, hence the checkpoint belongs to the previous
+            # one, with the progress of the current epoch.
+            save_progress=lambda batch, loss: save_training_checkpoint(
+                actual_epoch - 1, batch=batch, loss=loss
+            ),
+            non_finite=non_finite,
+            check_steps=check_steps,
+            masking=masking,
         )
+        # Only the first epoch after resuming starts in the middle.
+        start_batch = 0
+        previous_loss = None
         train_stats["stats"]["loss"].append(train_result["loss"])
         train_stats["stats"]["perplexity"].append(train_result["perplexity"])
+        # The scheduler is stepped after every update, so this is the learning rate
+        # reached at the end of the epoch.
         epoch_lr = lr_scheduler.get_last_lr()[0]  # type: ignore
         train_stats["lr"].append(epoch_lr)
-        lr_scheduler.step()
         logger.end("Train")
 
         validation_results = []
@@ -212,17 +517,23 @@ def train(
             val_name = val_data_loader.dataset.name
             val_text = "Validation: {}".format(val_name)
             logger.start(val_text)
+            # The validation uses the model without the DDP wrapper, since the shards
+            # may have a different number of batches and nothing needs to be
+            # synchronised except the final results.
             validation_result = run_epoch(
                 val_data_loader,
-                model,
+                model_unwrapped,
                 optimiser,
                 device=device,
-                epoch=epoch,
+                epoch=actual_epoch,
                 train=False,
                 name=val_text,
                 logger=logger,
                 amp_scaler=amp_scaler,
                 masked_lm=masked_lm,
+                non_finite=non_finite,
+                check_steps=check_steps,
+                masking=masking,
             )
             validation_results.append(
                 OrderedDict(name=val_name, stats=validation_result)
@@ -236,24 +547,7 @@ def train(
             logger.end(val_text)
 
         with logger.spinner("Checkpoint", placement="right"):
-            # Multi-gpu models wrap the original model. To make the checkpoint
-            # compatible with the original model, the state dict of .module is saved.
-            model_unwrapped = (
-                model.module if isinstance(model, DistributedDataParallel) else model
-            )
-            save_checkpoint(
-                logger,
-                model_unwrapped,
-                tokeniser,
-                stats=OrderedDict(
-                    epoch=actual_epoch,
-                    train=train_stats,
-                    validation=validation_results_dict,
-                    outdated_validation=outdated_validations,
-                    model=OrderedDict(kind=model_kind),
-                ),
-                step=actual_epoch,
-            )
+            save_training_checkpoint(actual_epoch, step=actual_epoch)
 
         with logger.spinner("Logging Data", placement="right"):
             log_results(
@@ -275,7 +569,8 @@ def train(
                     for val_name, val_result in validation_results_dict.items()
                 }
             )
-            log_top_checkpoints(logger, val_stats, metrics)
+            best_epochs = log_top_checkpoints(logger, val_stats, metrics, k=keep_best)
+            checkpoint_writer.set_best(best_epochs)
 
         time_difference = time.time() - start_time
         epoch_results = [
@@ -286,6 +581,9 @@ def train(
         )
         logger.end(epoch_text, prefix=False)
 
+    with logger.spinner("Writing Checkpoints", placement="right"):
+        checkpoint_writer.close()
+
 
 def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser()
@@ -368,8 +666,9 @@ def build_parser() -> argparse.ArgumentParser:
         dest="lr_warmup",
         default=lr_warmup,
         type=int,
-        help="Number of warmup steps for the Learning rate [Default: {}]".format(
-            lr_warmup
+        help=(
+            "Number of optimiser steps to linearly warm up the learning rate, "
+            "after which it decays linearly to zero [Default: {}]".format(lr_warmup)
         ),
     )
     parser.add_argument(
@@ -429,11 +728,186 @@ def build_parser() -> argparse.ArgumentParser:
         type=str,
         help="Directory with the vocabulary to use (only for models from scratch)",
     )
+    parser.add_argument(
+        "--cache-dir",
+        dest="cache_dir",
+        type=str,
+        help=(
+            "Directory to cache the tokenised datasets, which are reused by "
+            "subsequent runs and shared amongst the processes"
+        ),
+    )
+    parser.add_argument(
+        "--batch-encoding",
+        dest="batch_encoding",
+        action="store_true",
+        help=(
+            "Encode the datasets in batches with the fast tokeniser, or with a pool "
+            "of processes if no fast tokeniser is available"
+        ),
+    )
+    parser.add_argument(
+        "--masking",
+        dest="masking",
+        default=default_masking,
+        choices=masking_strategies,
+        help=(
+            "How the tokens are chosen for the masked language modelling, either "
+            "each token separately, whole words or spans of whole words "
+            "[Default: {}]".format(default_masking)
+        ),
+    )
+    parser.add_argument(
+        "--mask-in-workers",
+        dest="mask_in_workers",
+        action="store_true",
+        help=(
+            "Mask the tokens for the masked language models in the DataLoader "
+            "workers instead of on the device"
+        ),
+    )
+    parser.add_argument(
+        "--streaming",
+        dest="streaming",
+        action="store_true",
+        help=(
+            "Read and tokenise the training text lazily instead of loading it into "
+            "memory, for corpora that do not fit into memory"
+        ),
+    )
+    parser.add_argument(
+        "--shuffle-buffer",
+        dest="shuffle_buffer",
+        default=shuffle_buffer,
+        type=int,
+        help=(
+            "Number of blocks kept in the buffer to shuffle the streamed training "
+            "text [Default: {}]".format(shuffle_buffer)
+        ),
+    )
+    parser.add_argument(
+        "--dataset-mode",
+        dest="dataset_mode",
+        default="blocks",
+        choices=["blocks", "sentences"],
+        help=(
+            "How the text is split into samples, either concatenated and split into "
+            "blocks of fixed size, or kept as separate sentences that are batched by "
+            "length [Default: blocks]"
+        ),
+    )
+    parser.add_argument(
+        "--max-tokens",
+        dest="max_tokens",
+        default=max_tokens,
+        type=int,
+        help=(
+            "Maximum number of tokens (including padding) per batch per GPU, "
+            "only used with --dataset-mode sentences [Default: {}]".format(max_tokens)
+        ),
+    )
+    parser.add_argument(
+        "--accumulation-steps",
+        dest="accumulation_steps",
+        default=accumulation_steps,
+        type=int,
+        help=(
+            "Number of batches whose gradients are accumulated before updating the "
+            "weights. Ignored if --effective-batch-size or --effective-batch-tokens "
+            "is given [Default: {}]".format(accumulation_steps)
+        ),
+    )
+    parser.add_argument(
+        "--checkpoint-steps",
+        dest="checkpoint_steps",
+        type=int,
+        help=(
+            "Number of optimiser steps after which a checkpoint is saved to the "
+            "latest directory of the experiment, in addition to the one at the end "
+            "of every epoch. Training can be resumed from it with --checkpoint"
+        ),
+    )
+    parser.add_argument(
+        "--keep-last",
+        dest="keep_last",
+        type=int,
+        help=(
+            "Number of most recent epoch checkpoints to keep, in addition to the "
+            "best ones. If not given, all checkpoints are kept"
+        ),
+    )
+    parser.add_argument(
+        "--keep-best",
+        dest="keep_best",
+        default=keep_best,
+        type=int,
+        help=(
+            "Number of best checkpoints per validation and metric that are listed "
+            "and kept [Default: {}]".format(keep_best)
+        ),
+    )
+    parser.add_argument(
+        "--non-finite",
+        dest="non_finite",
+        default=default_non_finite,
+        choices=["skip", "abort"],
+        help=(
+            "What to do when a loss or gradient is not finite (NaN or infinity), "
+            "either abort the training, checked every --check-steps batches, or "
+            "skip the update and exclude the loss from the average, which requires "
+            "the GPU to synchronise with the CPU for every update "
+            "[Default: {}]".format(default_non_finite)
+        ),
+    )
+    parser.add_argument(
+        "--check-steps",
+        dest="check_steps",
+        default=check_steps,
+        type=int,
+        help=(
+            "Number of batches after which the losses and gradients are checked for "
+            "non-finite values when aborting on them. Checking requires the GPU to synchronise "
+            "with the CPU [Default: {}]".format(check_steps)
+        ),
+    )
+    parser.add_argument(
+        "--epoch-steps",
+        dest="epoch_steps",
+        type=int,
+        help=(
+            "Number of optimiser steps per epoch for the learning rate schedule, "
+            "required with --streaming, since the length of the streamed data is "
+            "unknown"
+        ),
+    )
+    effective_batch_group = parser.add_mutually_exclusive_group()
+    effective_batch_group.add_argument(
+        "--effective-batch-size",
+        dest="effective_batch_size",
+        type=int,
+        help=(
+            "Number of sequences per weight update across all GPUs. The number of "
+            "accumulation steps is derived from it"
+        ),
+    )
+    effective_batch_group.add_argument(
+        "--effective-batch-tokens",
+        dest="effective_batch_tokens",
+        type=int,
+        help=(
+            "Number of tokens per weight update across all GPUs. The number of "
+            "accumulation steps is derived from it, assuming full blocks or, "
+            "with --dataset-mode sentences, full batches of --max-tokens"
+        ),
+    )
     return parser
 
 
 def main():
     options = build_parser().parse_args()
+    assert (
+        not options.streaming or options.dataset_mode == "blocks"
+    ), "--streaming only supports --dataset-mode blocks"
     use_cuda = torch.cuda.is_available() and not options.no_cuda
     if use_cuda:
         # Somehow this fixes an unknown error on Windows.
@@ -497,12 +971,17 @@ def run(gpu_id, options, distributed=False):
     model_kind = checkpoint["model"].get("kind") or options.model_kind
     use_special = True
     masked_lm = True
+    # The fast (Rust) version of the tokeniser, which is only used for the batch
+    # encoding of the datasets.
+    fast_tokeniser_class = None
     if model_kind == "bert":
         if pre_trained is None:
             pre_trained = "bert-base-german-cased"
         config = BertConfig.from_pretrained(pre_trained)
         model = BertForMaskedLM.from_pretrained(pre_trained, config=config)
         tokeniser = BertTokenizer.from_pretrained(pre_trained)
+        tokeniser_path = pre_trained
+        fast_tokeniser_class = BertTokenizerFast
     elif model_kind == "bert-scratch":
         # The pre_trained here is only for the configuartion (num layers etc.)
         # But the weights are not loaded
@@ -511,6 +990,8 @@ def run(gpu_id, options, distributed=False):
         # Use either the provided vocabulary or the pre_trained one.
         vocab = options.vocab or pre_trained
         tokeniser = BertTokenizer.from_pretrained(vocab)
+        tokeniser_path = vocab
+        fast_tokeniser_class = BertTokenizerFast
         config = BertConfig.from_pretrained(pre_trained)
         config.vocab_size = tokeniser.vocab_size
         model = BertForMaskedLM(config)
@@ -520,6 +1001,8 @@ def run(gpu_id, options, distributed=False):
         config = GPT2Config.from_pretrained(pre_trained)
         model = GPT2LMHeadModel.from_pretrained(pre_trained, config=config)
         tokeniser = GPT2Tokenizer.from_pretrained(pre_trained)
+        tokeniser_path = pre_trained
+        fast_tokeniser_class = GPT2TokenizerFast
         masked_lm = False
         use_special = False
     elif model_kind == "gpt2-german":
@@ -538,6 +1021,7 @@ def run(gpu_id, options, distributed=False):
             bos_token="<endoftext>",
             eos_token="<endoftext>",
         )
+        tokeniser_path = pre_trained
         masked_lm = False
         use_special = False
     elif model_kind == "gpt2-scratch":
@@ -548,6 +1032,8 @@ def run(gpu_id, options, distributed=False):
         # Use either the provided vocabulary or the pre_trained one.
         vocab = options.vocab or pre_trained
         tokeniser = GPT2Tokenizer.from_pretrained(vocab)
+        tokeniser_path = vocab
+        fast_tokeniser_class = GPT2TokenizerFast
         config = GPT2Config.from_pretrained(pre_trained)
         config.vocab_size = tokeniser.vocab_size
         model = GPT2LMHeadModel(config)
@@ -556,32 +1042,97 @@ def run(gpu_id, options, distributed=False):
     else:
         raise Exception("No model available for {}".format(model_kind))
     model = model.to(device)
+    fast_tokeniser = (
+        fast_tokeniser_class.from_pretrained(tokeniser_path)
+        if options.batch_encoding and fast_tokeniser_class is not None
+        else None
+    )
 
     # Primary process has loaded the model and the other can now load the cached
     # version.
     if distributed and gpu_id == 0:
         torch.distributed.barrier()
 
-    train_dataset = TextDataset(
-        options.train_text,
-        tokeniser,
+    # When caching the datasets, only the primary process tokenises them and the rest
+    # waits to load the cached version.
+    if distributed and options.cache_dir is not None and gpu_id != 0:
+        torch.distributed.barrier()
+
+    dataset_options = dict(
         use_special=use_special,
         manual_special=model_kind == "gpt2-german",
+        cache_dir=options.cache_dir,
+        batch_encoding=options.batch_encoding,
+        fast_tokeniser=fast_tokeniser,
+        num_workers=options.num_workers,
     )
-    train_sampler = (
-        DistributedSampler(train_dataset, num_replicas=options.num_gpus, rank=gpu_id)
-        if distributed
+    # The masking for the masked language models is either done in the DataLoader
+    # workers, or for each batch on the device.
+    masker = (
+        TokenMasker(tokeniser, strategy=options.masking)
+        if masked_lm and options.mask_in_workers
         else None
     )
-    train_data_loader = DataLoader(
-        train_dataset,
-        batch_size=options.batch_size,
-        # Only shuffle when not using a sampler
-        shuffle=train_sampler is None,
-        num_workers=options.actual_num_workers,
-        sampler=train_sampler,
-        pin_memory=True,
-    )
+    # The word boundaries for the whole-word and span masking are stored with the
+    # blocks.
+    word_boundaries = masked_lm and options.masking != "token"
+    block_collate = None if masker is None else BlockCollate(masker)
+    if options.streaming:
+        train_dataset = StreamingTextDataset(
+            options.train_text,
+            tokeniser,
+            use_special=use_special,
+            manual_special=model_kind == "gpt2-german",
+            shuffle_buffer=options.shuffle_buffer,
+            seed=options.seed,
+            rank=gpu_id,
+            num_replicas=options.num_gpus if distributed else 1,
+        )
+        # The streamed dataset shards and shuffles itself.
+        train_data_loader = DataLoader(
+            train_dataset,
+            batch_size=options.batch_size,
+            num_workers=options.actual_num_workers,
+            collate_fn=block_collate,
+            pin_memory=True,
+        )
+    elif options.dataset_mode == "sentences":
+        train_dataset = SentenceDataset(
+            options.train_text, tokeniser, **dataset_options
+        )
+        train_data_loader = sentence_data_loader(
+            train_dataset,
+            max_tokens=options.max_tokens,
+            num_workers=options.actual_num_workers,
+            shuffle=True,
+            seed=options.seed,
+            rank=gpu_id,
+            num_replicas=options.num_gpus if distributed else 1,
+            masker=masker,
+        )
+    else:
+        train_dataset = TextDataset(
+            options.train_text,
+            tokeniser,
+            word_boundaries=word_boundaries,
+            **dataset_options,
+        )
+        # The order of the samples is determined by the seed and the epoch, so that
+        # training can be resumed in the middle of an epoch.
+        train_sampler = ResumableDistributedSampler(
+            train_dataset,
+            num_replicas=options.num_gpus if distributed else 1,
+            rank=gpu_id,
+            seed=options.seed,
+        )
+        train_data_loader = DataLoader(
+            train_dataset,
+            batch_size=options.batch_size,
+            num_workers=options.actual_num_workers,
+            sampler=train_sampler,
+            collate_fn=block_collate,
+            pin_memory=True,
+        )
 
     validation_data_loaders = []
     for val_file in options.validation_text:
@@ -595,35 +1146,58 @@ def run(gpu_id, options, distributed=False):
         else:
             name = None
             file_path = vals[0]
-        validation_dataset = TextDataset(
-            file_path,
-            tokeniser,
-            name=name,
-            use_special=use_special,
-            manual_special=model_kind == "gpt2-german",
-        )
-        validation_sampler = (
-            DistributedSampler(
-                validation_dataset, num_replicas=options.num_gpus, rank=gpu_id
+        if options.dataset_mode == "sentences":
+            validation_dataset = SentenceDataset(
+                file_path, tokeniser, name=name, **dataset_options
+            )
+            validation_data_loader = sentence_data_loader(
+                validation_dataset,
+                max_tokens=options.max_tokens,
+                num_workers=options.actual_num_workers,
+                shuffle=False,
+                rank=gpu_id,
+                num_replicas=options.num_gpus if distributed else 1,
+                even=False,
+                masker=masker,
+            )
+        else:
+            validation_dataset = TextDataset(
+                file_path,
+                tokeniser,
+                name=name,
+                word_boundaries=word_boundaries,
+                **dataset_options,
+            )
+            # Every block is validated exactly once, unlike with the
+            # DistributedSampler, which repeats some to even out the shards.
+            validation_sampler = ShardedSampler(
+                validation_dataset,
+                num_replicas=options.num_gpus if distributed else 1,
+                rank=gpu_id,
+            )
+            validation_data_loader = DataLoader(
+                validation_dataset,
+                batch_size=options.batch_size,
+                num_workers=options.actual_num_workers,
+                sampler=validation_sampler,
+                collate_fn=block_collate,
+                pin_memory=True,
             )
-            if distributed
-            else None
-        )
-        validation_data_loader = DataLoader(
-            validation_dataset,
-            batch_size=options.batch_size,
-            # Only shuffle when not using a sampler
-            shuffle=validation_sampler is None,
-            num_workers=options.actual_num_workers,
-            sampler=validation_sampler,
-            pin_memory=True,
-        )
         validation_data_loaders.append(validation_data_loader)
 
+    # Primary process has created the cached datasets and the others can now load them.
+    if distributed and options.cache_dir is not None and gpu_id == 0:
+        torch.distributed.barrier()
+
     initial_lr = options.lr
     # Only restore the learning rate if resuming from a checkpoint and not manually
-    # resetting the learning rate.
-    if len(checkpoint["train"]["lr"]) > 0 and not options.reset_lr:
+    # resetting the learning rate. Checkpoints that contain the state of the scheduler
+    # restore it from there instead.
+    if (
+        len(checkpoint["train"]["lr"]) > 0
+        and "lr_scheduler" not in checkpoint
+        and not options.reset_lr
+    ):
         initial_lr = checkpoint["train"]["lr"][-1]
 
     no_decay = ["bias", "LayerNorm.weight"]
@@ -646,13 +1220,78 @@ def run(gpu_id, options, distributed=False):
         },
     ]
     optimiser = AdamW(optimiser_grouped_parameters, lr=initial_lr, eps=options.adam_eps)
-    lr_scheduler = get_linear_schedule_with_warmup(
-        optimiser,
-        num_warmup_steps=options.lr_warmup,
-        num_training_steps=options.num_epochs,
+    # The state of the optimiser needs to be restored before the scheduler is created,
+    # since it contains the initial learning rate of the schedule.
+    training_state = (
+        None if options.checkpoint is None else load_training_state(options.checkpoint)
     )
+    if training_state is not None:
+        optimiser.load_state_dict(training_state["optimiser"])
+        if options.reset_lr:
+            for param_group in optimiser.param_groups:
+                param_group["lr"] = initial_lr
+                param_group["initial_lr"] = initial_lr
 
     amp_scaler = amp.GradScaler() if use_cuda and options.fp16 else None
+    if (
+        amp_scaler is not None
+        and training_state is not None
+        and training_state["amp_scaler"] is not None
+    ):
+        amp_scaler.load_state_dict(training_state["amp_scaler"])
+
+    # The accumulation steps are derived from the nominal batch sizes rather than the
+    # actual ones, so that all processes perform the same number of steps.
+    num_replicas = options.num_gpus if distributed else 1
+    if options.dataset_mode == "sentences":
+        # Sentences are batched by tokens, so there is no fixed number of sequences.
+        sequences_per_step = None
+        tokens_per_step = options.max_tokens * num_replicas
+    else:
+        sequences_per_step = options.batch_size * num_replicas
+        tokens_per_step = sequences_per_step * train_dataset.block_size
+    if options.effective_batch_size is not None:
+        assert (
+            sequences_per_step is not None
+        ), "--effective-batch-size is not supported with --dataset-mode sentences"
+        accumulation_steps = math.ceil(
+            options.effective_batch_size / sequences_per_step
+        )
+    elif options.effective_batch_tokens is not None:
+        accumulation_steps = math.ceil(options.effective_batch_tokens / tokens_per_step)
+    else:
+        accumulation_steps = options.accumulation_steps
+    accumulation_steps = max(accumulation_steps, 1)
+    options.actual_accumulation_steps = accumulation_steps
+
+    # The learning rate is scheduled per optimiser step. The data loader already only
+    # contains the batches of the current process.
+    if options.streaming:
+        assert (
+            options.epoch_steps is not None
+        ), "--epoch-steps is required with --streaming, since the length is unknown"
+        epoch_steps = options.epoch_steps
+    else:
+        epoch_steps = math.ceil(len(train_data_loader) / accumulation_steps)
+    lr_schedule = OrderedDict(
+        num_warmup_steps=options.lr_warmup,
+        num_training_steps=epoch_steps * options.num_epochs,
+    )
+    # Continue the schedule of the checkpoint, unless the learning rate is reset.
+    scheduler_checkpoint = checkpoint.get("lr_scheduler")
+    if scheduler_checkpoint is not None and not options.reset_lr:
+        lr_schedule = OrderedDict(
+            num_warmup_steps=scheduler_checkpoint["num_warmup_steps"],
+            num_training_steps=scheduler_checkpoint["num_training_steps"],
+        )
+    lr_scheduler = get_linear_schedule_with_warmup(optimiser, **lr_schedule)
+    if scheduler_checkpoint is not None and not options.reset_lr:
+        lr_scheduler.load_state_dict(scheduler_checkpoint["state"])
+        # The optimiser only receives the restored learning rate at the next step.
+        for param_group, group_lr in zip(
+            optimiser.param_groups, lr_scheduler.get_last_lr()
+        ):
+            param_group["lr"] = group_lr
 
     if distributed:
         model = DistributedDataParallel(
@@ -669,7 +1308,10 @@ def run(gpu_id, options, distributed=False):
     ]
     experiment = OrderedDict(
         model_kind=model_kind,
-        train=OrderedDict(path=train_dataset.path, size=len(train_dataset)),
+        train=OrderedDict(
+            path=train_dataset.path,
+            size="streamed" if options.streaming else len(train_dataset),
+        ),
         validation=validation_details,
         options=options,
     )
@@ -684,7 +1326,8 @@ def run(gpu_id, options, distributed=False):
         torch.distributed.barrier()
     spinner.stop()
 
-    if options.checkpoint is not None:
+    # A checkpoint in the middle of the first epoch has no results to show yet.
+    if options.checkpoint is not None and checkpoint["epoch"] > 0:
         resume_text = "Resuming from - Epoch {epoch}".format(epoch=checkpoint["epoch"])
         logger.set_prefix(resume_text)
         epoch_results = [
@@ -707,6 +1350,11 @@ def run(gpu_id, options, distributed=False):
         ]
         log_epoch_stats(logger, epoch_results, metrics)
 
+    # Restore the random number generators last, since building the datasets and the
+    # model may have consumed random numbers.
+    if training_state is not None:
+        set_rng_state(training_state["rng"])
+
     train(
         logger,
         model,
@@ -720,6 +1368,15 @@ def run(gpu_id, options, distributed=False):
         model_kind=model_kind,
         amp_scaler=amp_scaler,
         masked_lm=masked_lm,
+        accumulation_steps=accumulation_steps,
+        lr_schedule=lr_schedule,
+        checkpoint_steps=options.checkpoint_steps,
+        training_state=training_state,
+        keep_last=options.keep_last,
+        keep_best=options.keep_best,
+        non_finite=options.non_finite,
+        check_steps=options.check_steps,
+        masking=options.masking,
     )
 
 